@@ -0,0 +1,140 @@
+'''
+Benchmark of fetch_all against a local fake Stash server (see fake_stash.py), reporting files and
+requests per second, peak memory and the time spent in each stage of the fetch.
+
+A full scan is measured first; if --incremental is given, a commit changing that many files is
+then added to every repository and the incremental scan is measured as well. Todos are stored in
+a dedicated database, dropped along with its parse cache at the start of each run so the full scan
+never reuses parses from earlier runs; a MongoDB server is required.
+
+Usage:
+    python bench_fetch.py [--projects=N] [--repos=N] [--files=N] [--branches=N] [--latency=S]
+        [--error-rate=R] [--download-workers=N] [--repo-workers=N] [--parse-workers=N]
+        [--incremental=N] [--mongo-uri=URI]
+'''
+from StringIO import StringIO
+from fake_stash import FakeStashData, FakeStashServer
+from urlparse import urlsplit
+import collections
+import optparse
+import os
+import pymongo
+import resource
+import sys
+import time
+
+
+#===================================================================================================
+# bench
+#===================================================================================================
+def bench(name, server, storage, fetch_options, stream):
+    '''
+    Runs fetch_all over all projects served by the given server, and prints its results.
+    '''
+    from update import fetch_all
+
+    requests_before = sum(server.requests.itervalues())
+    downloads_before = server.requests['browse']
+    bytes_before = server.bytes_sent
+
+    log = StringIO()
+    start_time = time.time()
+    list(fetch_all(server.url, server.data.projects.keys(), stream=log, **fetch_options))
+    elapsed = time.time() - start_time
+
+    requests = sum(server.requests.itervalues()) - requests_before
+    downloads = server.requests['browse'] - downloads_before
+    megabytes = (server.bytes_sent - bytes_before) / 1024.0 / 1024.0
+    print >> stream, '%s: %.2f s' % (name, elapsed)
+    print >> stream, '  files:    %6d  (%8.1f files/s)' % (downloads, downloads / elapsed)
+    print >> stream, '  requests: %6d  (%8.1f requests/s, %.1f MB)' % (
+        requests, requests / elapsed, megabytes)
+
+    # stages are summed over all repositories, which are fetched concurrently
+    run, = storage.get_fetch_metrics(kind='fetch_all', limit=1)
+    stage_seconds = collections.defaultdict(float)
+    for entry in run['metrics']['stages']:
+        stage_seconds[entry['stage']] += entry['seconds']
+    print >> stream, '  stages (summed over repos): %s' % ', '.join(
+        '%s %.2fs' % x for x in sorted(stage_seconds.iteritems()))
+    cache = run['metrics']['cache']
+    print >> stream, '  parse cache: %d hits, %d misses' % (cache['hits'], cache['misses'])
+
+    if 'ERROR:' in log.getvalue():
+        print >> stream, '  (some repositories failed, see the log below)'
+        print >> stream, log.getvalue()
+
+
+#===================================================================================================
+# get_peak_rss
+#===================================================================================================
+def get_peak_rss():
+    '''
+    Returns the peak resident memory of this process and of the largest of its finished children
+    (the parse workers), in MB.
+    '''
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is given in kilobytes on Linux
+    return own / 1024.0, children / 1024.0
+
+
+#===================================================================================================
+# main
+#===================================================================================================
+def main(argv, stream=sys.stdout):
+    parser = optparse.OptionParser()
+    parser.add_option('--projects', type=int, default=2)
+    parser.add_option('--repos', type=int, default=5)
+    parser.add_option('--files', type=int, default=500)
+    parser.add_option('--branches', type=int, default=0)
+    parser.add_option('--latency', type=float, default=0.01)
+    parser.add_option('--error-rate', type=float, default=0.0)
+    parser.add_option('--download-workers', type=int, default=16)
+    parser.add_option('--repo-workers', type=int, default=8)
+    parser.add_option('--parse-workers', type=int, default=0)
+    parser.add_option('--incremental', type=int, default=0)
+    parser.add_option('--mongo-uri', default='mongodb://localhost:27017/todos-bench')
+    options, _ = parser.parse_args(argv)
+
+    # MongoStorage reads the database from the environment
+    os.environ['MONGOLAB_URI'] = options.mongo_uri
+    from update import MongoStorage, parse_branch_rules
+
+    data = FakeStashData(options.projects, options.repos, options.files,
+        branches=options.branches)
+    server = FakeStashServer(data, latency=options.latency, error_rate=options.error_rate)
+    server.start()
+    try:
+        # the whole database is dropped, parse cache included, so every run starts cold
+        db_name = urlsplit(options.mongo_uri).path[1:]
+        pymongo.Connection(options.mongo_uri).drop_database(db_name)
+        storage = MongoStorage()
+        print >> stream, 'Fake Stash: %d repos of %d files, %.3f s latency, %.0f%% errors' % (
+            options.projects * options.repos, options.files, options.latency,
+            options.error_rate * 100)
+
+        fetch_options = dict(
+            download_workers=options.download_workers,
+            repo_workers=options.repo_workers,
+            parse_workers=options.parse_workers,
+            branch_rules=parse_branch_rules('master,release/*'),
+        )
+        bench('Full scan', server, storage, fetch_options, stream)
+
+        if options.incremental:
+            data.add_commits(options.incremental)
+            bench('Incremental scan (%d files per repo)' % options.incremental, server, storage,
+                fetch_options, stream)
+
+        print >> stream, 'Peak RSS: %.1f MB (largest parse worker: %.1f MB)' % get_peak_rss()
+    finally:
+        server.stop()
+    return 0
+
+
+#===================================================================================================
+# entry point
+#===================================================================================================
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
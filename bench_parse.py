@@ -0,0 +1,115 @@
+'''
+Benchmark of the todo extraction done by IterToDos over a synthetic corpus of test files.
+
+Compares parsing every file completely (as done before the lexical pre-filter was introduced)
+with the default IterToDos (which skips files without "ToDo"). Results of both methods are 
+checked to be the same.
+
+Usage:
+    python bench_parse.py [--files=N] [--functions=N] [--todo-ratio=R] [--seed=N]
+'''
+from update import IterToDos, _ParseToDos
+import optparse
+import random
+import sys
+import time
+
+
+#===================================================================================================
+# make_test_file
+#===================================================================================================
+def make_test_file(rand, functions, todos):
+    '''
+    Returns the source of a test file with the given number of test functions, `todos` of them
+    decorated with @ToDo, mixing module level functions and methods.
+    '''
+    todo_indexes = set(rand.sample(xrange(functions), todos))
+    lines = [
+        'from pytest_helpers import parametrize',
+        'from coilib50.basic.todo import ToDo' if todos else 'import os',
+        '',
+        '',
+    ]
+    indent = ''
+    for index in xrange(functions):
+        if index % 10 == 0:
+            if index % 20 == 0:
+                indent = ''
+            else:
+                lines += ['class TestGroup%d(object):' % index, '']
+                indent = '    '
+        args = 'self' if indent else ''
+        if index in todo_indexes:
+            lines.append(indent + '@ToDo((2013, %d, %d), days=%d)' % (
+                rand.randint(1, 12), rand.randint(1, 28), rand.randint(1, 60)))
+        elif index % 3 == 0:
+            lines.append(indent + '@parametrize("value", [1, 2, 3])')
+        lines.append(indent + 'def test_%d(%s):' % (index, args))
+        lines.append(indent + '    """')
+        lines.append(indent + '    Checks case number %d.' % index)
+        lines.append(indent + '    """')
+        for statement in xrange(rand.randint(3, 15)):
+            lines.append(indent + '    value_%d = [x * %d for x in range(%d)]' % (
+                statement, statement, index))
+            lines.append(indent + '    assert sum(value_%d) >= 0, "sum failed"' % statement)
+        lines.append('')
+        lines.append('')
+    return '\n'.join(lines)
+
+
+#===================================================================================================
+# make_corpus
+#===================================================================================================
+def make_corpus(files, functions, todo_ratio, seed=0):
+    '''
+    Returns a list of test file sources. `todo_ratio` is the fraction of files with todos.
+    '''
+    rand = random.Random(seed)
+    result = []
+    for _ in xrange(files):
+        todos = rand.randint(1, 3) if rand.random() < todo_ratio else 0
+        result.append(make_test_file(rand, functions, todos))
+    return result
+
+
+#===================================================================================================
+# bench
+#===================================================================================================
+def bench(name, function, corpus, stream):
+    start_time = time.time()
+    result = [function(x) for x in corpus]
+    elapsed = time.time() - start_time
+    print >> stream, '%-20s %8.3f s  %10.1f files/s' % (name, elapsed, len(corpus) / elapsed)
+    return result, elapsed
+
+
+#===================================================================================================
+# main
+#===================================================================================================
+def main(argv, stream=sys.stdout):
+    parser = optparse.OptionParser()
+    parser.add_option('--files', type=int, default=1000)
+    parser.add_option('--functions', type=int, default=20)
+    parser.add_option('--todo-ratio', type=float, default=0.05)
+    parser.add_option('--seed', type=int, default=0)
+    options, _ = parser.parse_args(argv)
+
+    corpus = make_corpus(options.files, options.functions, options.todo_ratio, options.seed)
+    size = sum(len(x) for x in corpus)
+    print >> stream, 'Corpus: %d files, %.1f MB, %.0f%% with todos' % (
+        len(corpus), size / 1024.0 / 1024.0, options.todo_ratio * 100)
+
+    full, full_elapsed = bench('full parse', _ParseToDos, corpus, stream)
+    filtered, filtered_elapsed = bench('pre-filter', lambda x: list(IterToDos(x)), corpus, stream)
+
+    assert filtered == full, 'pre-filter results differ from full parse'
+
+    print >> stream, 'Speedup: pre-filter %.1fx' % (full_elapsed / filtered_elapsed)
+    return 0
+
+
+#===================================================================================================
+# entry point
+#===================================================================================================
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -2,8 +2,33 @@
 Class to centralize dashboard's global configuration access, such as git repo url, authentication,
 etc.
 '''
+import multiprocessing
 import os
+import tempfile
 
 git_repo_url = os.environ['TODO_DASHBOARD_GIT_URL']
 auth = tuple(os.environ['TODO_DASHBOARD_AUTH'].split(':'))
-search_projects = os.environ['TODO_DASHBOARD_PROJECTS'].split(os.sep)
\ No newline at end of file
+search_projects = os.environ['TODO_DASHBOARD_PROJECTS'].split(os.sep)
+engine = os.environ.get('TODO_DASHBOARD_ENGINE', 'threads')
+# greenlets are cheap, so the gevent engine defaults to many more workers; contents are parsed by
+# the fetching greenlets, as process pools don't mix with gevent's monkey patching
+if engine == 'gevent':
+    default_workers = {'download': 256, 'repo': 64, 'parse': 0}
+else:
+    default_workers = {'download': 16, 'repo': 8, 'parse': multiprocessing.cpu_count()}
+download_workers = int(
+    os.environ.get('TODO_DASHBOARD_DOWNLOAD_WORKERS', default_workers['download']))
+repo_workers = int(os.environ.get('TODO_DASHBOARD_REPO_WORKERS', default_workers['repo']))
+parse_workers = int(os.environ.get('TODO_DASHBOARD_PARSE_WORKERS', default_workers['parse']))
+git_mirrors_dir = os.environ.get('TODO_DASHBOARD_GIT_MIRRORS')
+git_clone_url_format = os.environ.get('TODO_DASHBOARD_GIT_CLONE_URL')
+branches = os.environ.get('TODO_DASHBOARD_BRANCHES', 'master')
+rate_limits = os.environ.get('TODO_DASHBOARD_RATE_LIMITS', '')
+markers = os.environ.get('TODO_DASHBOARD_MARKERS', 'todo')
+file_patterns = os.environ.get('TODO_DASHBOARD_FILES', 'test_*.py')
+# snapshots of the todos served by the dashboard, shared by its processes; empty to disable them
+snapshot_dir = os.environ.get('TODO_DASHBOARD_SNAPSHOT_DIR',
+    os.path.join(tempfile.gettempdir(), 'todo-dashboard'))
+snapshot_interval = float(os.environ.get('TODO_DASHBOARD_SNAPSHOT_INTERVAL', 10.0))
+# token webhooks must give to queue fetches (see dashboard.hook); hooks are rejected without it
+hook_secret = os.environ.get('TODO_DASHBOARD_HOOK_SECRET', '')
@@ -1,10 +1,21 @@
 from flask.templating import render_template
 from flask import request, escape, Response
-from update import MongoStorage, StashServer, fetch_all, fetch_single
+from metrics import format_prometheus
+from progress import LogEvents, ProgressEvents
+from snapshot import SnapshotStore
+from update import (BRANCH_REF_PREFIX, DEFAULT_BRANCH, EXCLUDED_SLUGS, MongoStorage, StashServer, 
+    UpdateQueue, fetch_all, fetch_single, get_fetch_options)
+import atexit
+import base64
 import datetime
 import flask
-import operator
+import hashlib
+import hmac
+import itertools
+import json
 import os
+import threading
+import urllib
 from StringIO import StringIO
 
 #===================================================================================================
@@ -12,65 +23,509 @@ from StringIO import StringIO
 #===================================================================================================
 app = flask.Flask('todo-dashboard')
 
+#===================================================================================================
+# get_storage
+#===================================================================================================
+_storage = None
+
+def get_storage():
+    '''
+    Returns the MongoStorage shared by all requests of this process: its connection is thread-safe
+    and keeps a pool of sockets, so there's no need to reconnect (and recreate indexes) per request.
+    '''
+    global _storage
+    if _storage is None:
+        _storage = MongoStorage()
+    return _storage
+
+
+#===================================================================================================
+# get_todos_view
+#===================================================================================================
+_snapshots = None
+
+def get_todos_view(storage):
+    '''
+    Returns where pages and the api read todos from: a snapshot of the stored todos shared by all
+    processes (see snapshot.SnapshotStore), or the storage itself if snapshots are disabled (see 
+    config.snapshot_dir) or until the first snapshot is loaded. 
+    
+    Both answer the same queries; pages must be cached by the generation of the returned view, as
+    a snapshot may lag behind the storage.
+    '''
+    global _snapshots
+    if _snapshots is None:
+        import config
+        _snapshots = SnapshotStore(config.snapshot_dir, config.snapshot_interval)
+        atexit.register(_snapshots.close)
+    if not _snapshots.directory:
+        return storage
+    snapshot = _snapshots.get(storage)
+    if snapshot is None:
+        return storage
+    return snapshot
+
+
+#===================================================================================================
+# RenderCache
+#===================================================================================================
+class RenderCache(object):
+    '''
+    Caches rendered pages by generation of the stored data (see MongoStorage.get_generation), 
+    and by request arguments.
+    
+    All pages are discarded as soon as a new generation is seen, since they are stale. Between
+    fetches the number of pages is still bounded by `max_pages`, as the number of distinct 
+    arguments (pages and filters) is unbounded.
+    '''
+    
+    def __init__(self, max_pages=256):
+        self._max_pages = max_pages
+        self._generation = None
+        self._pages = {}
+        self._lock = threading.Lock()
+        
+        
+    @classmethod
+    def make_etag(cls, generation, key):
+        return hashlib.sha1(repr((generation, key))).hexdigest()
+        
+        
+    def get(self, generation, key):
+        with self._lock:
+            if generation != self._generation:
+                return None
+            return self._pages.get(key)
+        
+        
+    def put(self, generation, key, page):
+        with self._lock:
+            if generation != self._generation:
+                self._generation = generation
+                self._pages.clear()
+            if len(self._pages) >= self._max_pages:
+                self._pages.clear()
+            self._pages[key] = page
+            
+            
+    def render(self, generation, key, render_function):
+        '''
+        Returns a response with the page for the given generation and key, calling 
+        `render_function()` only if it is not cached yet. 
+        
+        Responses carry an ETag, answering with 304 if the client already has the page.
+        '''
+        etag = self.make_etag(generation, key)
+        if request.if_none_match.contains(etag):
+            response = flask.make_response('', 304)
+        else:
+            page = self.get(generation, key)
+            if page is None:
+                page = render_function()
+                self.put(generation, key, page)
+            response = flask.make_response(page)
+            
+        response.set_etag(etag)
+        # clients must revalidate before showing a cached page, which is cheap with the etag 
+        response.cache_control.no_cache = True
+        return response
+            
+            
+_render_cache = RenderCache()
+
+#===================================================================================================
+# get_todo_filters
+#===================================================================================================
+PAGE_SIZE = 100
+FILTER_ARGS = ['repo', 'project', 'branch', 'due_from', 'due_until', 'overdue']
+
+def get_todo_filters():
+    '''
+    Returns the todo filters given in the query string as keyword arguments suitable for 
+    MongoStorage.query_todos. Dates are given as YYYY-MM-DD; "overdue" only keeps todos due 
+    before today.
+    '''
+    result = {}
+    for name in FILTER_ARGS:
+        value = request.args.get(name)
+        if not value:
+            continue
+        if name == 'overdue':
+            today = get_today()
+            result['due_until'] = min(result.get('due_until', today), today)
+            continue
+        if name.startswith('due_'):
+            try:
+                value = datetime.datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                flask.abort(400)
+            if name == 'due_until':
+                # the date given by the user is inclusive
+                value += datetime.timedelta(days=1)
+        result[name] = value
+    return result
+
+
+def get_today():
+    '''
+    Returns the start of the current day: todos due before it are overdue.
+    '''
+    return datetime.datetime.combine(datetime.date.today(), datetime.time())
+
+
 #===================================================================================================
 # /
 #===================================================================================================
 @app.route('/')
 def index():
+    storage = get_storage()
+    view = get_todos_view(storage)
+    # pages change with the day, as todos become overdue
+    key = ('index', get_today(), tuple(sorted(request.args.iteritems(multi=True))))
+    return _render_cache.render(view.get_generation(), key, lambda: render_index(storage, view))
+    
+
+def render_index(storage, view):
     import config 
     
-    storage = MongoStorage()
+    filters = get_todo_filters()
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        flask.abort(400)
+    order_by = request.args.get('sort') or 'position'
+    if order_by not in ('position', 'due'):
+        flask.abort(400)
     
-    entries = list(storage.iter_all_todos())
-    entries = sorted(entries, key=operator.itemgetter('repo'))
-    href_format = config.git_repo_url + '/projects/{proj}/repos/{slug}/browse/{filename}#{lineno}'
-    for entry in entries:
-        for todo in entry['todos']:
-            proj, slug = StashServer.split_repo_name(entry['repo'])
-            format_params = entry.copy()
-            format_params.update(proj=proj, slug=slug, lineno=todo['lineno'])
-            todo['href'] = href_format.format(**format_params)
-            if todo['days']: 
-                todo['days_as_timedelta'] = datetime.timedelta(days=todo['days'])
+    todos = view.query_todos(skip=(page - 1) * PAGE_SIZE, limit=PAGE_SIZE, order_by=order_by,
+        **filters)
+    count = view.count_todos(**filters)
+    page_count = max(1, (count + PAGE_SIZE - 1) // PAGE_SIZE)
+    
+    href_format = config.git_repo_url + \
+        '/projects/{proj}/repos/{slug}/browse/{filename}{at}#{lineno}'
+    for todo in todos:
+        proj, slug = StashServer.split_repo_name(todo['repo'])
+        if todo['branch'] != DEFAULT_BRANCH:
+            at = '?' + urllib.urlencode({'at': BRANCH_REF_PREFIX + todo['branch']})
+        else:
+            at = ''
+        todo['href'] = href_format.format(proj=proj, slug=slug, filename=todo['filename'], 
+            at=at, lineno=todo['lineno'])
 
     date, elapsed = storage.get_last_fetch_all_status()
-              
-    return render_template('dashboard.html', entries=entries, date=date, elapsed=elapsed)
+    
+    # filters and order are passed back as received, so paging links keep them
+    args = dict(
+        (name, request.args[name]) for name in FILTER_ARGS + ['sort'] if request.args.get(name))
+    
+    return render_template('dashboard.html', todos=todos, date=date, elapsed=elapsed, 
+        page=page, page_count=page_count, count=count, args=args, today=get_today())
 
 
+#===================================================================================================
+# /api/todos
+#===================================================================================================
+API_MAX_LIMIT = 10000
+
+@app.route('/api/todos')
+def api_todos():
+    '''
+    Streams todos matching the filters given in the query string (see get_todo_filters).
+    
+    The format is given by the "format" argument: "json" (default) returns an object with a
+    "todos" list and a "next" cursor (null on the last page); "ndjson" returns one todo per line,
+    each containing the "cursor" that resumes right after it. 
+    
+    Pagination uses the "after" argument, set to a cursor received previously, and "limit", the 
+    maximum number of todos returned.
+    '''
+    view = get_todos_view(get_storage())
+    
+    format_name = request.args.get('format', 'json')
+    if format_name not in ('json', 'ndjson'):
+        flask.abort(400)
+    limit = request.args.get('limit', 1000, type=int)
+    if not 0 < limit <= API_MAX_LIMIT:
+        flask.abort(400)
+    after = request.args.get('after')
+    if after is not None:
+        try:
+            after = decode_cursor(after)
+        except (TypeError, ValueError):
+            flask.abort(400)
+    filters = get_todo_filters()
+    
+    generation = view.get_generation()
+    key = ('api_todos', tuple(sorted(request.args.iteritems(multi=True))))
+    etag = RenderCache.make_etag(generation, key)
+    if request.if_none_match.contains(etag):
+        response = flask.make_response('', 304)
+    else:
+        # one extra todo is read to know if there is a next page
+        todos = itertools.islice(view.iter_todos(after=after, **filters), limit + 1)
+        if format_name == 'json':
+            response = Response(generate_json(todos, limit), mimetype='application/json')
+        else:
+            response = Response(generate_ndjson(todos, limit), mimetype='application/x-ndjson')
+    
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+def generate_json(todos, limit):
+    yield '{"todos": ['
+    cursor = None
+    for index, todo in enumerate(todos):
+        if index == limit:
+            break
+        cursor = encode_cursor(todo)
+        if index > 0:
+            yield ', '
+        yield dump_todo(todo)
+    else:
+        # no more todos after this page
+        cursor = None
+    yield '], "next": %s}' % json.dumps(cursor)
+    
+    
+def generate_ndjson(todos, limit):
+    for todo in itertools.islice(todos, limit):
+        todo['cursor'] = encode_cursor(todo)
+        yield dump_todo(todo) + '\n'
+    
+    
+def dump_todo(todo):
+    def default(value):
+        if isinstance(value, datetime.datetime):
+            return value.isoformat()
+        raise TypeError(repr(value))
+    
+    todo.pop('_id', None)
+    return json.dumps(todo, default=default, sort_keys=True)
+    
+    
+def encode_cursor(todo):
+    position = [todo['repo'], todo['branch'], todo['filename'], todo['lineno']]
+    return base64.urlsafe_b64encode(json.dumps(position))
+
+
+def decode_cursor(cursor):
+    repo, branch, filename, lineno = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    return repo, branch, filename, int(lineno)
+    
+    
+#===================================================================================================
+# /api/summary
+#===================================================================================================
+@app.route('/api/summary')
+def api_summary():
+    '''
+    Returns the number of todos and of overdue todos matching the filters given in the query 
+    string (see get_todo_filters) in each project or repository, as given by the "by" argument 
+    ("project" by default).
+    '''
+    view = get_todos_view(get_storage())
+    group_by = request.args.get('by', 'project')
+    if group_by not in ('project', 'repo'):
+        flask.abort(400)
+    filters = get_todo_filters()
+    today = get_today()
+    
+    def render():
+        return json.dumps({'groups': view.count_todos_by(group_by, today, **filters)})
+    key = ('api_summary', today, tuple(sorted(request.args.iteritems(multi=True))))
+    response = _render_cache.render(view.get_generation(), key, render)
+    response.mimetype = 'application/json'
+    return response
+    
+    
+#===================================================================================================
+# /metrics
+#===================================================================================================
+@app.route('/metrics')
+def prometheus_metrics():
+    '''
+    Metrics of the last run of each kind of fetch, in Prometheus' text format (see FetchMetrics).
+    '''
+    storage = get_storage()
+    runs = []
+    for kind in ['fetch_all', 'fetch_single', 'fetch_worker']:
+        runs += storage.get_fetch_metrics(kind=kind, limit=1)
+    return Response(format_prometheus(runs), mimetype='text/plain; version=0.0.4')
+    
+    
 #===================================================================================================
 # /fetch
 #===================================================================================================
 @app.route('/fetch', methods=['GET', 'POST'])
 @app.route('/fetch/<project>/<slug>', methods=['GET', 'POST'])
 def fetch(project=None, slug=None):
+    '''
+    Fetches a single repository, returning its log, or starts fetching all repositories in the 
+    background, streaming their progress events (see progress.ProgressEvents) as newline 
+    delimited json or Server-Sent Events.
+    '''
     import config
     
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
         auth = (username, password)
-        stream = StringIO()
         if project is not None and slug is not None:
             repo_name = '{}/{}'.format(project, slug)
-            fetch_single(config.git_repo_url, repo_name, auth, stream=stream)
+            stream = StringIO()
+            fetch_single(config.git_repo_url, repo_name, auth, stream=stream, 
+                **get_web_fetch_options(config))
             return '<pre>{}</pre>'.format(escape(stream.getvalue()))
         else:
-            def generate():
-                '''
-                Incrementally generate data to return it to the browser as soon as it is available.
-                '''
-                read_bytes = 0
-                for _ in fetch_all(config.git_repo_url, config.search_projects, auth, stream=stream):
-                    stream.seek(read_bytes)
-                    contents = stream.read()
-                    yield '<pre>{}</pre>'.format(escape(contents))
-                    read_bytes += len(contents)
-                    
-            return Response(generate())
+            # the format is given by the "format" field, or else negotiated
+            format_name = request.form.get('format') or request.accept_mimetypes.best_match(
+                ['application/x-ndjson', 'text/event-stream'], default='application/x-ndjson')
+            format_name = FETCH_FORMATS.get(format_name, format_name)
+            if format_name not in ('ndjson', 'sse'):
+                flask.abort(400)
+            
+            events = start_fetch_all(config, auth)
+            if events is None:
+                return Response('A fetch is already running\n', status=409, 
+                    mimetype='text/plain')
+            if format_name == 'sse':
+                response = Response(generate_sse(events), mimetype='text/event-stream')
+            else:
+                response = Response(generate_ndjson_events(events), 
+                    mimetype='application/x-ndjson')
+            # progress must reach the client as it happens, not when a proxy's buffer fills
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['X-Accel-Buffering'] = 'no'
+            return response
     else:
         return render_template('login.html')
     
+    
+FETCH_FORMATS = {'application/x-ndjson': 'ndjson', 'text/event-stream': 'sse'}
+
+def get_web_fetch_options(config, repo_workers=False):
+    '''
+    Returns the options of fetches run by the dashboard (see get_fetch_options): contents are 
+    parsed by the fetching threads, as forking a pool of processes from a threaded web server 
+    copies threads and sockets the children can't use, besides competing with its requests.
+    '''
+    options = get_fetch_options(config, repo_workers=repo_workers)
+    options['parse_workers'] = 0
+    return options
+
+
+# seconds without events after which a keep-alive is sent, so idle connections aren't closed
+FETCH_KEEPALIVE = 15.0
+
+_fetch_all_lock = threading.Lock()
+_fetch_all_events = None
+
+def start_fetch_all(config, auth):
+    '''
+    Starts fetch_all in a background thread, returning the ProgressEvents it writes to, or None if
+    a fetch started by this process is already running.
+    
+    The fetch doesn't depend on the client that started it: if the client disconnects, the fetch
+    runs to its end, its events being dropped once their buffer is full.
+    '''
+    global _fetch_all_events
+    with _fetch_all_lock:
+        if _fetch_all_events is not None:
+            return None
+        events = _fetch_all_events = ProgressEvents()
+        
+    def run():
+        global _fetch_all_events
+        try:
+            for _ in fetch_all(config.git_repo_url, config.search_projects, auth, 
+                               stream=LogEvents(events.put), progress=events.put,
+                               **get_web_fetch_options(config, repo_workers=True)):
+                pass
+        except Exception as e:
+            app.logger.exception('Error fetching all repositories')
+            events.put({'type': 'error', 'repo': None, 'message': str(e)})
+        finally:
+            with _fetch_all_lock:
+                _fetch_all_events = None
+            events.close()
+    
+    thread = threading.Thread(target=run, name='fetch_all')
+    thread.daemon = True
+    thread.start()
+    return events
+    
+    
+def generate_ndjson_events(events):
+    for event in events.iter_events(timeout=FETCH_KEEPALIVE):
+        if event is None:
+            event = {'type': 'keepalive'}
+        yield json.dumps(event) + '\n'
+        
+        
+def generate_sse(events):
+    '''
+    Generates events as Server-Sent Events, named by their type.
+    '''
+    for event in events.iter_events(timeout=FETCH_KEEPALIVE):
+        if event is None:
+            yield ': keepalive\n\n'
+        else:
+            yield 'event: %s\ndata: %s\n\n' % (event['type'], json.dumps(event))
+    
+
+#===================================================================================================
+# /hook
+#===================================================================================================
+def fetch_from_hook(repo_name):
+    import config
+    
+    stream = StringIO()
+    fetch_single(config.git_repo_url, repo_name, config.auth, stream=stream, 
+        **get_web_fetch_options(config))
+    app.logger.info(stream.getvalue())
+    
+    
+_update_queue = UpdateQueue(fetch_from_hook)
+
+@app.route('/hook', methods=['POST'])
+@app.route('/hook/<project>/<slug>', methods=['POST'])
+def hook(project=None, slug=None):
+    '''
+    Push webhook: queues the repository to be fetched in the background and returns immediately.
+    
+    The repository is given in the url or, for Stash's webhooks, in the posted json 
+    ({"repository": {"slug": ..., "project": {"key": ...}}}). Only repositories scanned by 
+    fetch_all are accepted.
+    
+    Hooks must give the secret configured in TODO_DASHBOARD_HOOK_SECRET, in the X-Hook-Token 
+    header or the "token" parameter; all of them are rejected if it's not configured.
+    '''
+    import config
+    
+    token = request.headers.get('X-Hook-Token') or request.args.get('token') or u''
+    if not config.hook_secret or \
+            not hmac.compare_digest(token.encode('utf-8'), config.hook_secret):
+        flask.abort(403)
+    
+    if project is None or slug is None:
+        payload = request.get_json(force=True, silent=True) or {}
+        try:
+            repository = payload['repository']
+            project = repository['project']['key']
+            slug = repository['slug']
+        except (KeyError, TypeError):
+            flask.abort(400)
+        if not isinstance(project, basestring) or not isinstance(slug, basestring):
+            flask.abort(400)
+            
+    if project not in config.search_projects or slug in EXCLUDED_SLUGS:
+        flask.abort(404)
+    repo_name = '{}/{}'.format(project, slug)
+    _update_queue.push(repo_name)
+    return flask.make_response('Queued {}\n'.format(repo_name), 202)
+    
 
 #===================================================================================================
 # main
@@ -0,0 +1,416 @@
+'''
+A local HTTP server that imitates the parts of Stash's REST api used by StashServer, serving
+synthetic projects, repositories, branches, commits and test files. Used to measure and test
+fetches without a real Stash instance (see bench_fetch.py).
+
+Usage:
+    python fake_stash.py [--port=N] [--projects=N] [--repos=N] [--files=N] [--latency=S]
+'''
+from SocketServer import ThreadingMixIn
+from bench_parse import make_test_file
+import BaseHTTPServer
+import bisect
+import collections
+import difflib
+import hashlib
+import json
+import optparse
+import random
+import re
+import sys
+import threading
+import time
+import urlparse
+
+
+#===================================================================================================
+# make_diff_hunks
+#===================================================================================================
+def make_diff_hunks(old_contents, new_contents, context_lines=3):
+    '''
+    Returns the hunks of the changes between two versions of a file, as given by 
+    RepoSource.get_diff_hunks.
+    '''
+    old_lines = old_contents.splitlines()
+    new_lines = new_contents.splitlines()
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    hunks = []
+    for group in matcher.get_grouped_opcodes(context_lines):
+        lines = []
+        for tag, old_begin, old_end, new_begin, new_end in group:
+            if tag == 'equal':
+                lines += [(' ', x) for x in old_lines[old_begin:old_end]]
+            else:
+                lines += [('-', x) for x in old_lines[old_begin:old_end]]
+                lines += [('+', x) for x in new_lines[new_begin:new_end]]
+        hunks.append((group[0][1] + 1, group[0][3] + 1, lines))
+    return hunks
+
+
+#===================================================================================================
+# FakeRepo
+#===================================================================================================
+class FakeRepo(object):
+    '''
+    History of a synthetic repository: a linear list of commits, each changing some of its files.
+    The first commit adds all files.
+    '''
+
+    def __init__(self, name, filenames, seed):
+        self.name = name
+        self.filenames = sorted(filenames)
+        self._rand = random.Random(repr(seed))
+        self.commits = []
+        self._versions = dict((x, [0]) for x in self.filenames)  # filename => indexes of commits
+        self._add_commit()
+
+
+    def _add_commit(self):
+        index = len(self.commits)
+        self.commits.append(hashlib.sha1('%s:%d' % (self.name, index)).hexdigest())
+        return index
+
+
+    def add_commit(self, changed_files):
+        '''
+        Adds a commit changing the given number of files, chosen at random. Returns its hash.
+        '''
+        index = self._add_commit()
+        for filename in self._rand.sample(self.filenames, min(changed_files, len(self.filenames))):
+            self._versions[filename].append(index)
+        return self.commits[index]
+
+
+    def get_commit_index(self, commit):
+        '''
+        Returns the index of the given commit, or of the last commit if None.
+        '''
+        if commit is None:
+            return len(self.commits) - 1
+        return self.commits.index(commit)
+
+
+    def get_version(self, filename, commit):
+        '''
+        Returns the index of the commit that last changed the file at the given commit, or None if
+        the file doesn't exist.
+        '''
+        versions = self._versions.get(filename)
+        if versions is None:
+            return None
+        return versions[bisect.bisect_right(versions, self.get_commit_index(commit)) - 1]
+
+
+    def iter_changes(self, since, until):
+        '''
+        Iterates over the files changed after commit `since` up to commit `until`.
+        '''
+        since_index = self.get_commit_index(since) if since is not None else -1
+        for filename in self.filenames:
+            if self.get_version(filename, until) > since_index:
+                yield filename
+
+
+#===================================================================================================
+# FakeStashData
+#===================================================================================================
+class FakeStashData(object):
+    '''
+    Synthetic contents of a Stash server: `projects` projects ("PROJ0", ...) with `repos`
+    repositories each ("repo0", ...), each with `files` files. A fraction `test_ratio` of the files
+    are test files, with `functions` test functions each; a fraction `todo_ratio` of the test files
+    have todos (see bench_parse.make_test_file).
+
+    Besides master, each repository has `branches` release branches ("release/0", ...), pointing
+    to earlier commits once commits are added (see add_commits).
+    '''
+
+    def __init__(self, projects=2, repos=5, files=200, test_ratio=0.5, functions=20,
+                 todo_ratio=0.05, branches=0, seed=0):
+        self.functions = functions
+        self.todo_ratio = todo_ratio
+        self.branches = branches
+        self.seed = seed
+        self.projects = collections.OrderedDict()
+        for project_index in xrange(projects):
+            project = 'PROJ%d' % project_index
+            self.projects[project] = collections.OrderedDict()
+            for repo_index in xrange(repos):
+                slug = 'repo%d' % repo_index
+                filenames = []
+                for file_index in xrange(files):
+                    if file_index < files * test_ratio:
+                        filenames.append('tests/test_%d.py' % file_index)
+                    else:
+                        filenames.append('src/module_%d.py' % file_index)
+                repo_name = '%s/%s' % (project, slug)
+                self.projects[project][slug] = FakeRepo(repo_name, filenames, (seed, repo_name))
+
+
+    def get_repo(self, project, slug):
+        return self.projects[project][slug]
+
+
+    def iter_repos(self):
+        for repos in self.projects.itervalues():
+            for repo in repos.itervalues():
+                yield repo
+
+
+    def add_commits(self, changed_files):
+        '''
+        Adds a commit changing `changed_files` files to every repository.
+        '''
+        for repo in self.iter_repos():
+            repo.add_commit(changed_files)
+
+
+    def get_branches(self, repo):
+        '''
+        Returns a list of (ref, commit) of the branches of a repository.
+        '''
+        result = [('refs/heads/master', repo.commits[-1])]
+        for index in xrange(self.branches):
+            commit = repo.commits[max(0, len(repo.commits) - 2 - index)]
+            result.append(('refs/heads/release/%d' % index, commit))
+        return result
+
+
+    def get_contents(self, repo, filename, commit):
+        '''
+        Returns the contents of a file at the given commit, or None if it doesn't exist.
+        '''
+        version = repo.get_version(filename, commit)
+        if version is None:
+            return None
+        rand = random.Random(repr((self.seed, repo.name, filename, version)))
+        if filename.startswith('tests/'):
+            todos = rand.randint(1, 3) if rand.random() < self.todo_ratio else 0
+            return make_test_file(rand, self.functions, todos)
+        return '# %s version %d\n' % (filename, version)
+
+
+#===================================================================================================
+# FakeStashServer
+#===================================================================================================
+class FakeStashServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    Serves the given FakeStashData over HTTP, answering each request after `latency` seconds.
+    A fraction `error_rate` of the requests fail with 503, to exercise retries.
+
+    Requests are counted by endpoint in `requests`, and bytes sent in `bytes_sent`.
+    '''
+
+    daemon_threads = True
+    request_queue_size = 256
+    allow_reuse_address = True
+
+    MAX_PAGE_SIZE = 1000
+
+    def __init__(self, data, latency=0.0, error_rate=0.0, host='127.0.0.1', port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), _FakeStashHandler)
+        self.data = data
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = collections.defaultdict(int)
+        self.bytes_sent = 0
+        self._rand = random.Random(data.seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return 'http://%s:%d' % (host, port)
+
+
+    def start(self):
+        '''
+        Starts serving requests in a background thread.
+        '''
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+    def record_request(self, endpoint, size):
+        '''
+        Counts a request, returning True if it should fail (see error_rate).
+        '''
+        with self._lock:
+            self.requests[endpoint] += 1
+            self.bytes_sent += size
+            return self._rand.random() < self.error_rate
+
+
+#===================================================================================================
+# _FakeStashHandler
+#===================================================================================================
+class _FakeStashHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    ROUTES = [
+        (re.compile(r'^/rest/api/1.0/projects/([^/]+)/repos$'), 'repos'),
+        (re.compile(r'^/rest/api/1.0/projects/([^/]+)/repos/([^/]+)/branches$'), 'branches'),
+        (re.compile(r'^/rest/api/1.0/projects/([^/]+)/repos/([^/]+)/files$'), 'files'),
+        (re.compile(r'^/rest/api/1.0/projects/([^/]+)/repos/([^/]+)/changes$'), 'changes'),
+        (re.compile(r'^/rest/api/1.0/projects/([^/]+)/repos/([^/]+)/commits/([^/]+)/diff$'), 
+            'diff'),
+        (re.compile(r'^/projects/([^/]+)/repos/([^/]+)/browse/(.+)$'), 'browse'),
+    ]
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        for regex, endpoint in self.ROUTES:
+            match = regex.match(url.path)
+            if match is not None:
+                break
+        else:
+            return self.send(404, 'not found', endpoint=None)
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        try:
+            status, body = getattr(self, 'get_' + endpoint)(params, *match.groups())
+        except (KeyError, ValueError) as e:
+            status, body = 404, str(e)
+        self.send(status, body, endpoint)
+
+
+    def send(self, status, body, endpoint):
+        if not isinstance(body, basestring):
+            body = json.dumps(body)
+            content_type = 'application/json'
+        else:
+            content_type = 'text/plain'
+        if self.server.record_request(endpoint, len(body)):
+            status, body = 503, 'service unavailable'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass  # requests are counted by the server instead
+
+
+    def make_page(self, params, values):
+        start = int(params.get('start', 0))
+        limit = min(int(params.get('limit', 25)), self.server.MAX_PAGE_SIZE)
+        page_values = values[start:start + limit]
+        result = {
+            'start': start,
+            'size': len(page_values),
+            'limit': limit,
+            'values': page_values,
+            'isLastPage': start + limit >= len(values),
+        }
+        if not result['isLastPage']:
+            result['nextPageStart'] = start + limit
+        return 200, result
+
+
+    def get_repos(self, params, project):
+        slugs = self.server.data.projects[project].keys()
+        return self.make_page(params, [{'slug': x} for x in slugs])
+
+
+    def get_branches(self, params, project, slug):
+        repo = self.server.data.get_repo(project, slug)
+        branches = self.server.data.get_branches(repo)
+        return self.make_page(params, [{'id': x, 'latestChangeset': y} for x, y in branches])
+
+
+    def get_files(self, params, project, slug):
+        repo = self.server.data.get_repo(project, slug)
+        repo.get_commit_index(params.get('at'))  # raises ValueError if unknown
+        return self.make_page(params, repo.filenames)
+
+
+    def get_changes(self, params, project, slug):
+        repo = self.server.data.get_repo(project, slug)
+        changes = repo.iter_changes(params.get('since'), params['until'])
+        return self.make_page(params, [{'path': {'toString': x}} for x in changes])
+
+
+    def get_diff(self, params, project, slug, until):
+        repo = self.server.data.get_repo(project, slug)
+        data = self.server.data
+        tags = {' ': 'CONTEXT', '-': 'REMOVED', '+': 'ADDED'}
+        diffs = []
+        for filename in repo.iter_changes(params.get('since'), until):
+            old_contents = data.get_contents(repo, filename, params.get('since'))
+            new_contents = data.get_contents(repo, filename, until)
+            diff = {
+                'source': {'toString': filename} if old_contents is not None else None,
+                'destination': {'toString': filename} if new_contents is not None else None,
+                'hunks': [],
+            }
+            if old_contents is not None and new_contents is not None:
+                context_lines = int(params.get('contextLines', 10))
+                for old_start, new_start, lines in make_diff_hunks(old_contents, new_contents, 
+                                                                   context_lines):
+                    segments = []
+                    for tag, text in lines:
+                        if not segments or segments[-1]['type'] != tags[tag]:
+                            segments.append({'type': tags[tag], 'lines': []})
+                        segments[-1]['lines'].append({'line': text})
+                    diff['hunks'].append({
+                        'sourceLine': old_start, 
+                        'destinationLine': new_start, 
+                        'segments': segments,
+                    })
+            diffs.append(diff)
+        return 200, {'diffs': diffs}
+
+
+    def get_browse(self, params, project, slug, filename):
+        repo = self.server.data.get_repo(project, slug)
+        contents = self.server.data.get_contents(repo, urlparse.unquote(filename), params.get('at'))
+        if contents is None:
+            return 404, 'file not found'
+        return 200, contents
+
+
+#===================================================================================================
+# main
+#===================================================================================================
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option('--port', type=int, default=7990)
+    parser.add_option('--projects', type=int, default=2)
+    parser.add_option('--repos', type=int, default=5)
+    parser.add_option('--files', type=int, default=200)
+    parser.add_option('--branches', type=int, default=0)
+    parser.add_option('--latency', type=float, default=0.0)
+    parser.add_option('--error-rate', type=float, default=0.0)
+    options, _ = parser.parse_args(argv)
+
+    data = FakeStashData(options.projects, options.repos, options.files,
+        branches=options.branches)
+    server = FakeStashServer(data, latency=options.latency, error_rate=options.error_rate,
+        port=options.port)
+    print 'Serving %s (projects: %s)' % (server.url, ','.join(data.projects))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+#===================================================================================================
+# entry point
+#===================================================================================================
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,206 @@
+'''
+Metrics collected while fetching repositories: time spent in each stage of each repository,
+requests made to the Stash server and parse cache hits. Metrics of each run are stored by
+MongoStorage.add_fetch_metrics and exposed in Prometheus' text format by the dashboard.
+'''
+from contextlib import contextmanager
+import bisect
+import collections
+import threading
+import time
+
+
+#===================================================================================================
+# FetchMetrics
+#===================================================================================================
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class FetchMetrics(object):
+    '''
+    Collects the metrics of a fetch run. The same instance is shared by all threads of the run.
+
+    Stages of the fetch of each repository are:
+
+    * "sync": updating the local copy of the repository (see RepoSource.sync_repo);
+    * "branches": getting the heads of its branches;
+    * "listing": waiting for the listing of the files to scan;
+    * "diff": getting the changes of the files listed and their todos (see update.shift_todos);
+    * "download": waiting for the contents of files (downloads run concurrently, so this is the
+      time the fetch was blocked by them, not the time spent downloading). Downloads start while
+      files are still being listed, so this includes part of the listing time;
+    * "parse": extracting todos from contents;
+    * "storage": writing todos to the database.
+    '''
+
+    def __init__(self, clock=None):
+        self._clock = clock or time.time
+        self._lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        '''
+        Discards the metrics collected so far, so the same instance can collect the next run.
+        '''
+        with self._lock:
+            self._stage_seconds = collections.defaultdict(float)  # (repo, stage) => seconds
+            self._requests = collections.defaultdict(int)  # (endpoint, status) => count
+            self._bytes = collections.defaultdict(int)  # endpoint => bytes received
+            self._latencies = {}  # endpoint => (bucket counts, sum of latencies)
+            self._cache_hits = 0
+            self._cache_misses = 0
+
+
+    @contextmanager
+    def stage(self, repo_name, stage):
+        '''
+        Context manager that adds the time spent in its block to the given stage of a repository.
+        '''
+        start_time = self._clock()
+        try:
+            yield
+        finally:
+            self.add_stage_time(repo_name, stage, self._clock() - start_time)
+
+
+    def add_stage_time(self, repo_name, stage, seconds):
+        with self._lock:
+            self._stage_seconds[(repo_name, stage)] += seconds
+
+
+    def get_stage_times(self, repo_name):
+        '''
+        Returns a dict mapping stage => seconds spent in it by the given repository.
+        '''
+        with self._lock:
+            return dict(
+                (stage, seconds) for (repo, stage), seconds in self._stage_seconds.iteritems()
+                if repo == repo_name
+            )
+
+
+    def record_request(self, endpoint, status, latency, size):
+        '''
+        Records a request made to the server.
+
+        :param status: status code of the response, or None if no response was received.
+        :param latency: seconds until the response was received.
+        :param size: bytes received.
+        '''
+        with self._lock:
+            self._requests[(endpoint, status)] += 1
+            self._bytes[endpoint] += size
+            counts, total = self._latencies.get(endpoint, ([0] * (len(LATENCY_BUCKETS) + 1), 0.0))
+            counts[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+            self._latencies[endpoint] = (counts, total + latency)
+
+
+    def record_cache(self, hits, misses):
+        '''
+        Records lookups in the parse cache: files found in the cache and files that were parsed.
+        '''
+        with self._lock:
+            self._cache_hits += hits
+            self._cache_misses += misses
+
+
+    def to_dict(self):
+        '''
+        Returns the metrics collected as a dict that can be stored in the database (keys can't
+        contain repository names, so everything is given as lists of entries).
+        '''
+        with self._lock:
+            return {
+                'stages': [
+                    {'repo': repo, 'stage': stage, 'seconds': seconds}
+                    for (repo, stage), seconds in sorted(self._stage_seconds.iteritems())
+                ],
+                'requests': [
+                    {'endpoint': endpoint, 'status': status, 'count': count}
+                    for (endpoint, status), count in sorted(self._requests.iteritems())
+                ],
+                'bytes': [
+                    {'endpoint': endpoint, 'bytes': size}
+                    for endpoint, size in sorted(self._bytes.iteritems())
+                ],
+                'latencies': [
+                    {'endpoint': endpoint, 'counts': list(counts), 'sum': total}
+                    for endpoint, (counts, total) in sorted(self._latencies.iteritems())
+                ],
+                'cache': {'hits': self._cache_hits, 'misses': self._cache_misses},
+            }
+
+
+#===================================================================================================
+# format_prometheus
+#===================================================================================================
+def format_prometheus(runs):
+    '''
+    Returns the metrics of the given runs in Prometheus' text exposition format. Runs are given as
+    stored by MongoStorage.add_fetch_metrics, usually the last run of each kind ("fetch_all",
+    "fetch_single" or "fetch_worker"); their metrics are labeled with the kind.
+    '''
+    families = collections.OrderedDict()
+    def add(name, metric_type, help_text, labels, value, suffix=''):
+        if name not in families:
+            families[name] = (metric_type, help_text, [])
+        families[name][2].append((name + suffix, labels, value))
+
+    for run in runs:
+        kind = run['kind']
+        metrics = run['metrics']
+        add('todo_fetch_run_seconds', 'gauge', 'Duration of the last fetch run.',
+            [('kind', kind)], run['elapsed'])
+        add('todo_fetch_run_timestamp_seconds', 'gauge', 'Time the last fetch run started.',
+            [('kind', kind)], time.mktime(run['started'].timetuple()))
+
+        for entry in metrics['stages']:
+            add('todo_fetch_stage_seconds', 'gauge',
+                'Time spent by each repository in each stage of the last fetch run.',
+                [('kind', kind), ('repo', entry['repo']), ('stage', entry['stage'])],
+                entry['seconds'])
+
+        for entry in metrics['requests']:
+            status = str(entry['status']) if entry['status'] is not None else 'error'
+            add('todo_fetch_requests_total', 'counter',
+                'Requests made to the Stash server in the last fetch run.',
+                [('kind', kind), ('endpoint', entry['endpoint']), ('status', status)],
+                entry['count'])
+
+        for entry in metrics['bytes']:
+            add('todo_fetch_response_bytes_total', 'counter',
+                'Bytes received from the Stash server in the last fetch run.',
+                [('kind', kind), ('endpoint', entry['endpoint'])], entry['bytes'])
+
+        name = 'todo_fetch_request_latency_seconds'
+        for entry in metrics['latencies']:
+            labels = [('kind', kind), ('endpoint', entry['endpoint'])]
+            help_text = 'Latency of requests made to the Stash server in the last fetch run.'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), entry['counts']):
+                cumulative += count
+                add(name, 'histogram', help_text, labels + [('le', str(bound))], cumulative,
+                    '_bucket')
+            add(name, 'histogram', help_text, labels, entry['sum'], '_sum')
+            add(name, 'histogram', help_text, labels, cumulative, '_count')
+
+        cache = metrics['cache']
+        add('todo_fetch_parse_cache_hits_total', 'counter',
+            'Files whose todos were found in the parse cache in the last fetch run.',
+            [('kind', kind)], cache['hits'])
+        add('todo_fetch_parse_cache_misses_total', 'counter',
+            'Files parsed in the last fetch run.', [('kind', kind)], cache['misses'])
+
+    lines = []
+    for name, (metric_type, help_text, samples) in families.iteritems():
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        for sample_name, labels, value in samples:
+            label_text = ','.join('%s="%s"' % (x, _escape_label(y)) for x, y in labels)
+            lines.append('%s{%s} %s' % (sample_name, label_text, repr(float(value))))
+    return ''.join(x + '\n' for x in lines)
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,124 @@
+'''
+Progress events of fetches, as written by fetch and fetch_all when given a `progress` callable.
+
+Events are dicts with a "type" key:
+
+* "file": a file was scanned ("repo", "branch", "filename", "todos" found and "done", the number of
+  files of the branch scanned so far);
+* "branch": summary of the fetch of a branch ("repo", "branch", "changed" and "test" files,
+  "todos" found and "seconds" taken);
+* "error": the fetch of a repository failed ("repo", "message");
+* "repo": a repository was fetched by fetch_all ("repo", "state" "done" or "failed", "index",
+  "total", "percent" and "stages", the seconds spent in each stage);
+* "done": fetch_all finished ("repos", "seconds");
+* "log": a line of the text log of the fetch ("text"), written by LogEvents.
+'''
+import collections
+import threading
+
+
+#===================================================================================================
+# ProgressEvents
+#===================================================================================================
+class ProgressEvents(object):
+    '''
+    Thread-safe queue of progress events, written by the fetching threads (see put) and read by a
+    single consumer (see iter_events) until the fetch closes it.
+
+    Writers never block, so a slow or disconnected consumer can't stall the fetch; instead, at
+    most `max_events` events are buffered. When the queue is full, "file" events are dropped
+    first: other events only replace the oldest event if no "file" event is left to drop. The
+    consumer is told about dropped events by a "dropped" event with their "count".
+    '''
+
+    def __init__(self, max_events=1000):
+        self._max_events = max_events
+        self._events = collections.deque()
+        self._condition = threading.Condition()
+        self._dropped = 0
+        self._closed = False
+
+
+    def put(self, event):
+        with self._condition:
+            if self._closed:
+                return
+            if len(self._events) >= self._max_events:
+                self._dropped += 1
+                if event['type'] == 'file':
+                    return
+                for index, queued in enumerate(self._events):
+                    if queued['type'] == 'file':
+                        del self._events[index]
+                        break
+                else:
+                    self._events.popleft()
+            self._events.append(event)
+            self._condition.notify()
+
+
+    def close(self):
+        '''
+        Marks the end of the events: the consumer stops after reading the events still queued.
+        '''
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+    @property
+    def closed(self):
+        return self._closed
+
+
+    def iter_events(self, timeout=None):
+        '''
+        Iterates over the events as they are written, until the queue is closed. If `timeout` is
+        given, None is yielded each time no event is written for `timeout` seconds, so the
+        consumer can keep its connection alive.
+        '''
+        while True:
+            with self._condition:
+                if not self._events and not self._closed:
+                    self._condition.wait(timeout)
+                if self._dropped:
+                    event = {'type': 'dropped', 'count': self._dropped}
+                    self._dropped = 0
+                elif self._events:
+                    event = self._events.popleft()
+                elif self._closed:
+                    return
+                else:
+                    event = None
+            yield event
+
+
+#===================================================================================================
+# LogEvents
+#===================================================================================================
+class LogEvents(object):
+    '''
+    File-like object that writes each line of text written to it as a "log" event, so the text
+    log of a fetch can be passed as its `stream`.
+
+    Text is buffered only until the end of each line; lines must be written by a single thread at
+    a time.
+    '''
+
+    def __init__(self, progress):
+        self._progress = progress
+        self._buffer = []
+
+
+    def write(self, text):
+        lines = text.split('\n')
+        for line in lines[:-1]:
+            self._buffer.append(line)
+            self._progress({'type': 'log', 'text': ''.join(self._buffer)})
+            self._buffer = []
+        if lines[-1]:
+            self._buffer.append(lines[-1])
+
+
+    def flush(self):
+        pass
@@ -0,0 +1,514 @@
+'''
+Compact, read-only snapshots of all stored todos, so the dashboard can serve pages and the api
+from memory instead of querying MongoDB on each request.
+
+A snapshot of each generation of the stored data (see MongoStorage.get_generation) is written to a
+file once, by the first process that needs it, and memory-mapped by all processes serving the
+dashboard, so they share a single copy. Todos are stored column by column: strings (repositories,
+file names, functions...) are stored once in a sorted table, and todos refer to them by index.
+'''
+import array
+import datetime
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+
+#===================================================================================================
+# TodoSnapshot
+#===================================================================================================
+class TodoSnapshot(object):
+    '''
+    Snapshot of all todos of a generation, answering the same queries as MongoStorage
+    (iter_todos, query_todos, count_todos and count_todos_by) with the same results.
+
+    Snapshots are written by `write` and read by `load`, which maps the file in memory: todos are
+    only turned into dicts as they are returned. Files use the native byte order, as they are only
+    shared by the processes of a single machine.
+    '''
+
+    MAGIC = 'TODOSNP1'
+
+    # magic, generation, number of todos and of strings
+    _HEADER = struct.Struct('=8sqII')
+
+    STRING_FIELDS = ['project', 'repo', 'branch', 'filename', 'function_name', 'kind', 'text']
+
+    # columns, in the order they are stored: strings are stored as indexes in the string table
+    # (-1 for None), dates as seconds since the epoch and missing numbers as NaN. "due_order" is
+    # the permutation of todos sorted by due date
+    _COLUMNS = [(x, 'i') for x in STRING_FIELDS] + [
+        ('lineno', 'i'),
+        ('days', 'd'),
+        ('date', 'd'),
+        ('due', 'd'),
+        ('due_order', 'I'),
+    ]
+
+    _EPOCH = datetime.datetime(1970, 1, 1)
+
+    def __init__(self, buffer, generation):
+        '''
+        Use `load` instead.
+        '''
+        self._buffer = buffer
+        self.generation = generation
+        _magic, _generation, self._count, string_count = self._HEADER.unpack_from(buffer, 0)
+
+        offset = self._HEADER.size
+        self._string_offsets = array.array('I')
+        self._string_offsets.fromstring(buffer[offset:offset + (string_count + 1) * 4])
+        offset += len(self._string_offsets) * 4
+        self._strings_start = offset
+        offset = self._align(offset + self._string_offsets[-1])
+
+        self._column_offsets = {}
+        for name, typecode in self._COLUMNS:
+            self._column_offsets[name] = offset
+            offset = self._align(offset + self._count * array.array(typecode).itemsize)
+        self._columns = {}
+        self._columns_lock = threading.Lock()
+
+
+    @classmethod
+    def _align(cls, offset):
+        return (offset + 7) & ~7
+
+
+    #===============================================================================================
+    # writing and loading
+    #===============================================================================================
+    @classmethod
+    def write(cls, stream, generation, todos):
+        '''
+        Writes a snapshot of the given todos (as returned by MongoStorage.iter_all_todos) to
+        `stream`. Only the fields queried and shown by the dashboard are kept.
+        '''
+        # strings are first numbered as they are seen, then renumbered in sorted order, so
+        # comparing indexes is the same as comparing strings
+        string_ids = {}
+        columns = dict((name, array.array(typecode)) for name, typecode in cls._COLUMNS)
+        string_columns = [(x, columns[x]) for x in cls.STRING_FIELDS]
+        count = 0
+        for todo in todos:
+            for name, column in string_columns:
+                value = todo.get(name)
+                if value is None:
+                    column.append(-1)
+                else:
+                    column.append(string_ids.setdefault(value, len(string_ids)))
+            columns['lineno'].append(todo['lineno'])
+            columns['days'].append(cls._encode_number(todo.get('days')))
+            columns['date'].append(cls._encode_date(todo.get('date')))
+            columns['due'].append(cls._encode_date(todo.get('due')))
+            count += 1
+
+        encoded = sorted(
+            (value.encode('utf-8'), string_id) for value, string_id in string_ids.iteritems())
+        new_ids = [0] * len(encoded)
+        for index, (_, string_id) in enumerate(encoded):
+            new_ids[string_id] = index
+        new_ids.append(-1)  # so new_ids[-1] is -1
+        for name, column in string_columns:
+            columns[name] = array.array('i', [new_ids[x] for x in column])
+
+        # todos are stored in position order, as iterated by iter_todos
+        repos, branches, filenames, linenos = [
+            columns[x] for x in ('repo', 'branch', 'filename', 'lineno')]
+        position_order = sorted(xrange(count), 
+            key=lambda i: (repos[i], branches[i], filenames[i], linenos[i]))
+        for name, column in columns.items():
+            if name != 'due_order':
+                columns[name] = array.array(column.typecode, [column[i] for i in position_order])
+
+        # todos without a due date come first, as sorted by MongoDB
+        due = columns['due']
+        columns['due_order'].extend(sorted(xrange(count), key=lambda i: (
+            not math.isnan(due[i]), due[i] if not math.isnan(due[i]) else 0, i)))
+
+        string_offsets = array.array('I', [0])
+        for value, _ in encoded:
+            string_offsets.append(string_offsets[-1] + len(value))
+
+        data = [cls._HEADER.pack(cls.MAGIC, generation, count, len(encoded))]
+        data.append(string_offsets.tostring())
+        data.extend(value for value, _ in encoded)
+        size = sum(len(x) for x in data)
+        for name, _ in cls._COLUMNS:
+            data.append('\0' * (cls._align(size) - size))
+            data.append(columns[name].tostring())
+            size = cls._align(size) + len(data[-1])
+        stream.write(''.join(data))
+
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Maps the snapshot written to the given file in memory, raising ValueError if it is not a
+        valid snapshot.
+        '''
+        with open(filename, 'rb') as stream:
+            size = os.fstat(stream.fileno()).st_size
+            if size < cls._HEADER.size:
+                raise ValueError('Invalid snapshot: %s' % filename)
+            buffer = mmap.mmap(stream.fileno(), size, access=mmap.ACCESS_READ)
+
+        magic, generation, _count, _string_count = cls._HEADER.unpack_from(buffer, 0)
+        if magic != cls.MAGIC:
+            raise ValueError('Invalid snapshot: %s' % filename)
+        return cls(buffer, generation)
+
+
+    @classmethod
+    def _encode_date(cls, value):
+        if value is None:
+            return float('nan')
+        return (value - cls._EPOCH).total_seconds()
+
+
+    @classmethod
+    def _decode_date(cls, value):
+        if math.isnan(value):
+            return None
+        return cls._EPOCH + datetime.timedelta(seconds=value)
+
+
+    @classmethod
+    def _encode_number(cls, value):
+        if value is None:
+            return float('nan')
+        return float(value)
+
+
+    @classmethod
+    def _decode_number(cls, value):
+        if math.isnan(value):
+            return None
+        if value.is_integer():
+            return int(value)
+        return value
+
+
+    #===============================================================================================
+    # reading
+    #===============================================================================================
+    def _get_column(self, name):
+        '''
+        Returns an array with the values of the given column, read from the mapped file the first
+        time it is needed. Columns are small (a few bytes per todo), unlike the strings they refer
+        to, which stay in the mapped file.
+        '''
+        column = self._columns.get(name)
+        if column is None:
+            with self._columns_lock:
+                column = self._columns.get(name)
+                if column is None:
+                    typecode = dict(self._COLUMNS)[name]
+                    column = array.array(typecode)
+                    start = self._column_offsets[name]
+                    column.fromstring(self._buffer[start:start + self._count * column.itemsize])
+                    self._columns[name] = column
+        return column
+
+
+    def _get_string(self, index):
+        if index == -1:
+            return None
+        return self._get_encoded_string(index).decode('utf-8')
+
+
+    def _get_encoded_string(self, index):
+        start = self._strings_start + self._string_offsets[index]
+        end = self._strings_start + self._string_offsets[index + 1]
+        return self._buffer[start:end]
+
+
+    def _find_string(self, value):
+        '''
+        Returns the index of the given string in the string table, or None if no todo refers to it.
+        '''
+        encoded = self._encode_string(value)
+        string_count = len(self._string_offsets) - 1
+        index = self._bisect(lambda i: self._get_encoded_string(i) < encoded, 0, string_count)
+        if index < string_count and self._get_encoded_string(index) == encoded:
+            return index
+        return None
+
+
+    @classmethod
+    def _encode_string(cls, value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+
+    def _get_encoded_position(self, index):
+        '''
+        Returns the position of a todo, with strings encoded as they are sorted in the table.
+        '''
+        return (
+            self._get_encoded_string(self._get_column('repo')[index]),
+            self._get_encoded_string(self._get_column('branch')[index]),
+            self._get_encoded_string(self._get_column('filename')[index]),
+            self._get_column('lineno')[index],
+        )
+
+
+    def _get_todo(self, index):
+        result = dict(
+            (name, self._get_string(self._get_column(name)[index])) for name in self.STRING_FIELDS)
+        result['lineno'] = self._get_column('lineno')[index]
+        result['days'] = self._decode_number(self._get_column('days')[index])
+        result['date'] = self._decode_date(self._get_column('date')[index])
+        result['due'] = self._decode_date(self._get_column('due')[index])
+        return result
+
+
+    def _iter_indexes(self, repo, project, due_from, due_until, branch, after=None,
+                      order_by='position'):
+        '''
+        Iterates over the indexes of the todos matching the given filters (see
+        MongoStorage.query_todos), in the given order.
+        '''
+        start, stop = 0, self._count
+
+        # todos are sorted by position, so todos of a repository and todos after a position are
+        # contiguous ranges, found by bisection
+        if repo is not None:
+            repo_index = self._find_string(repo)
+            if repo_index is None:
+                return
+            repos = self._get_column('repo')
+            start = self._bisect(lambda i: repos[i] < repo_index, start, stop)
+            stop = self._bisect(lambda i: repos[i] <= repo_index, start, stop)
+        if after is not None:
+            after_repo, after_branch, after_filename, after_lineno = after
+            after = tuple(map(self._encode_string, [after_repo, after_branch, after_filename]))
+            after += (after_lineno,)
+            start = self._bisect(lambda i: self._get_encoded_position(i) <= after, start, stop)
+
+        conditions = []
+        for name, value in [('project', project), ('branch', branch)]:
+            if value is not None:
+                value_index = self._find_string(value)
+                if value_index is None:
+                    return
+                conditions.append((self._get_column(name), value_index))
+        due = self._get_column('due') if due_from is not None or due_until is not None else None
+        due_from = self._encode_date(due_from) if due_from is not None else -float('inf')
+        due_until = self._encode_date(due_until) if due_until is not None else float('inf')
+
+        if order_by == 'position':
+            indexes = xrange(start, stop)
+        elif order_by == 'due':
+            indexes = (x for x in self._get_column('due_order') if start <= x < stop)
+        else:
+            raise ValueError('Unknown order: %r' % (order_by,))
+
+        for index in indexes:
+            if any(column[index] != value for column, value in conditions):
+                continue
+            # comparisons with NaN (no due date) are always false
+            if due is not None and not due_from <= due[index] < due_until:
+                continue
+            yield index
+
+
+    @classmethod
+    def _bisect(cls, is_before, low, high):
+        '''
+        Returns the first index in [low, high) for which `is_before(index)` is false, given that
+        it's true for all indexes before it.
+        '''
+        while low < high:
+            middle = (low + high) // 2
+            if is_before(middle):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+    #===============================================================================================
+    # queries (see MongoStorage)
+    #===============================================================================================
+    def get_generation(self):
+        return self.generation
+
+
+    def iter_all_todos(self):
+        return (self._get_todo(x) for x in xrange(self._count))
+
+
+    def iter_todos(self, repo=None, project=None, due_from=None, due_until=None, branch=None,
+                   after=None):
+        indexes = self._iter_indexes(repo, project, due_from, due_until, branch, after)
+        return (self._get_todo(x) for x in indexes)
+
+
+    def query_todos(self, repo=None, project=None, due_from=None, due_until=None, branch=None,
+                    skip=0, limit=None, order_by='position'):
+        indexes = self._iter_indexes(repo, project, due_from, due_until, branch,
+            order_by=order_by)
+        result = []
+        for position, index in enumerate(indexes):
+            if position < skip:
+                continue
+            if limit is not None and len(result) >= limit:
+                break
+            result.append(self._get_todo(index))
+        return result
+
+
+    def count_todos(self, repo=None, project=None, due_from=None, due_until=None, branch=None):
+        if all(x is None for x in (repo, project, due_from, due_until, branch)):
+            return self._count
+        return sum(1 for _ in self._iter_indexes(repo, project, due_from, due_until, branch))
+
+
+    def count_todos_by(self, group_by, now, repo=None, project=None, due_from=None,
+                       due_until=None, branch=None):
+        if group_by not in ('project', 'repo'):
+            raise ValueError('Unknown group: %r' % (group_by,))
+
+        groups = self._get_column(group_by)
+        due = self._get_column('due')
+        now = self._encode_date(now)
+        counts = {}
+        for index in self._iter_indexes(repo, project, due_from, due_until, branch):
+            group_counts = counts.setdefault(groups[index], [0, 0])
+            group_counts[0] += 1
+            if due[index] < now:
+                group_counts[1] += 1
+        # indexes are sorted as the strings they refer to
+        return [
+            {group_by: self._get_string(x), 'count': count, 'overdue': overdue}
+            for x, (count, overdue) in sorted(counts.iteritems())
+        ]
+
+
+#===================================================================================================
+# SnapshotStore
+#===================================================================================================
+class SnapshotStore(object):
+    '''
+    Keeps the snapshot of the last generation of the stored todos, as files in `directory` shared
+    by all processes serving the dashboard (a directory must only be used for a single database).
+
+    Requests never wait for a snapshot, nor query the storage: they are served the last snapshot
+    loaded, whose generation is read from its header. The generation of the storage is checked at
+    most once every `min_interval` seconds, by a background thread that loads the snapshot of a
+    new generation, or builds it if no process did yet. While todos are being fetched the
+    generation changes often, so the previous snapshot is served until the new one is ready.
+
+    Each process only removes the files it wrote, once it wrote a newer one or it's closed: other
+    processes may still be about to load them.
+    '''
+
+    FILENAME_FORMAT = 'todos-%d.snapshot'
+
+    def __init__(self, directory, min_interval=10.0):
+        self.directory = directory
+        self._min_interval = min_interval
+        self._snapshot = None
+        self._checked_time = None
+        self._refreshing = False
+        self._written = []
+        self._lock = threading.Lock()
+
+
+    def get(self, storage):
+        '''
+        Returns the last snapshot loaded, or None if none was loaded yet, starting a background
+        refresh (see refresh) if the generation of the storage wasn't checked in `min_interval`
+        seconds.
+        '''
+        with self._lock:
+            now = time.time()
+            if not self._refreshing and (
+                    self._checked_time is None or now - self._checked_time >= self._min_interval):
+                self._checked_time = now
+                self._refreshing = True
+                thread = threading.Thread(target=self._refresh_in_background, args=(storage,),
+                    name='SnapshotStore')
+                thread.daemon = True
+                thread.start()
+            return self._snapshot
+
+
+    def refresh(self, storage):
+        '''
+        Loads the snapshot of the current generation of the given storage, building it if no
+        process did yet, and returns it.
+        '''
+        generation = storage.get_generation()
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.generation != generation:
+            filename = os.path.join(self.directory, self.FILENAME_FORMAT % generation)
+            try:
+                snapshot = TodoSnapshot.load(filename)
+            except (IOError, ValueError):
+                snapshot = self._build(storage, generation, filename)
+            with self._lock:
+                self._snapshot = snapshot
+        return snapshot
+
+
+    def _refresh_in_background(self, storage):
+        try:
+            self.refresh(storage)
+        except Exception:
+            logging.exception('Refreshing the snapshot failed')
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+    def close(self):
+        '''
+        Removes the files written by this store. Snapshots already loaded stay usable.
+        '''
+        with self._lock:
+            written, self._written = self._written, []
+        for filename in written:
+            self._remove(filename)
+
+
+    def _build(self, storage, generation, filename):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass  # created concurrently by another process
+
+        # the snapshot is written to a temporary file and then renamed, so other processes never
+        # see it half written
+        handle, temp_filename = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as stream:
+                TodoSnapshot.write(stream, generation, storage.iter_all_todos())
+            os.rename(temp_filename, filename)
+        except:
+            os.remove(temp_filename)
+            raise
+
+        # processes still using older snapshots keep them mapped until they load the new one
+        with self._lock:
+            older = [x for x in self._written if x != filename]
+            self._written = [filename]
+        for old_filename in older:
+            self._remove(old_filename)
+        return TodoSnapshot.load(filename)
+
+
+    @classmethod
+    def _remove(cls, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass  # removed by another process that wrote the same generation
@@ -0,0 +1,400 @@
+from dashboard import app, RenderCache
+from metrics import FetchMetrics
+from snapshot import SnapshotStore
+import dashboard
+import datetime
+import json
+import pytest
+import sys
+import threading
+import time
+import types
+
+
+#===================================================================================================
+# fixtures
+#===================================================================================================
+@pytest.fixture(autouse=True)
+def no_snapshots(monkeypatch):
+    '''
+    Todos are read from the storage given by each test, unless it enables snapshots.
+    '''
+    monkeypatch.setattr(dashboard, '_snapshots', SnapshotStore(None))
+
+
+#===================================================================================================
+# TestRenderCache
+#===================================================================================================
+class TestRenderCache(object):
+
+    def render(self, cache, generation, key, headers=None):
+        rendered = []
+        def render_function():
+            rendered.append(key)
+            return 'page %s at %d' % (key, generation)
+
+        with app.test_request_context('/', headers=headers or {}):
+            response = cache.render(generation, key, render_function)
+        return response, rendered
+
+
+    def test_render(self):
+        cache = RenderCache()
+
+        response, rendered = self.render(cache, 1, 'a')
+        assert rendered == ['a']
+        assert response.status_code == 200
+        assert response.data == 'page a at 1'
+        etag, _ = response.get_etag()
+
+        # cached
+        response, rendered = self.render(cache, 1, 'a')
+        assert rendered == []
+        assert response.data == 'page a at 1'
+
+        # not modified
+        response, rendered = self.render(cache, 1, 'a', headers={'If-None-Match': '"%s"' % etag})
+        assert rendered == []
+        assert response.status_code == 304
+
+        # new generation invalidates the page and its etag
+        response, rendered = self.render(cache, 2, 'a', headers={'If-None-Match': '"%s"' % etag})
+        assert rendered == ['a']
+        assert response.status_code == 200
+        assert response.data == 'page a at 2'
+        assert response.get_etag()[0] != etag
+
+
+    def test_max_pages(self):
+        cache = RenderCache(max_pages=2)
+        for key in ['a', 'b', 'c']:
+            self.render(cache, 1, key)
+        assert cache.get(1, 'c') is not None
+        assert cache.get(1, 'a') is None
+
+
+#===================================================================================================
+# TodosStorage
+#===================================================================================================
+class TodosStorage(object):
+    '''
+    Serves a fixed list of todos in place of MongoStorage.
+    '''
+
+    def __init__(self, todos):
+        self.todos = todos
+
+
+    def get_generation(self):
+        return 1
+
+
+    def iter_all_todos(self):
+        return iter(self.todos)
+
+
+    def iter_todos(self, repo=None, project=None, due_from=None, due_until=None, branch=None,
+                   after=None):
+        for todo in self.todos:
+            if repo is not None and todo['repo'] != repo:
+                continue
+            if branch is not None and todo['branch'] != branch:
+                continue
+            if due_from is not None and todo['due'] < due_from:
+                continue
+            if due_until is not None and todo['due'] >= due_until:
+                continue
+            position = (todo['repo'], todo['branch'], todo['filename'], todo['lineno'])
+            if after is not None and position <= after:
+                continue
+            yield dict(todo)
+
+
+#===================================================================================================
+# TestApiTodos
+#===================================================================================================
+class TestApiTodos(object):
+
+    @pytest.fixture(params=['storage', 'snapshot'])
+    def client(self, request, monkeypatch, tmpdir):
+        todos = [
+            {
+                'repo': 'proj/repo%d' % (i // 3),
+                'project': 'proj',
+                'branch': 'master',
+                'filename': 'test_foo.py',
+                'function_name': 'test_%d' % i,
+                'lineno': i,
+                'date': datetime.datetime(2013, 9, 1),
+                'days': i,
+                'due': datetime.datetime(2013, 9, 1) + datetime.timedelta(days=i),
+            }
+            for i in xrange(5)
+        ]
+        monkeypatch.setattr(dashboard, '_storage', TodosStorage(todos))
+        if request.param == 'snapshot':
+            snapshots = SnapshotStore(str(tmpdir))
+            snapshots.refresh(dashboard._storage)
+            monkeypatch.setattr(dashboard, '_snapshots', snapshots)
+        return app.test_client()
+
+
+    def test_json(self, client):
+        response = client.get('/api/todos?limit=3')
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert [x['function_name'] for x in data['todos']] == ['test_0', 'test_1', 'test_2']
+        assert data['todos'][1]['due'] == '2013-09-02T00:00:00'
+
+        response = client.get('/api/todos?limit=3&after=%s' % data['next'])
+        data = json.loads(response.data)
+        assert [x['function_name'] for x in data['todos']] == ['test_3', 'test_4']
+        assert data['next'] is None
+
+        data = json.loads(client.get('/api/todos?repo=proj/repo1').data)
+        assert [x['function_name'] for x in data['todos']] == ['test_3', 'test_4']
+
+
+    def test_ndjson(self, client):
+        response = client.get('/api/todos?format=ndjson&limit=2')
+        assert response.mimetype == 'application/x-ndjson'
+        lines = [json.loads(x) for x in response.data.splitlines()]
+        assert [x['function_name'] for x in lines] == ['test_0', 'test_1']
+
+        response = client.get('/api/todos?format=ndjson&after=%s' % lines[-1]['cursor'])
+        lines = [json.loads(x) for x in response.data.splitlines()]
+        assert [x['function_name'] for x in lines] == ['test_2', 'test_3', 'test_4']
+
+
+    def test_conditional_get(self, client):
+        response = client.get('/api/todos')
+        etag, _ = response.get_etag()
+        response = client.get('/api/todos', headers={'If-None-Match': '"%s"' % etag})
+        assert response.status_code == 304
+
+
+    def test_overdue(self, client, monkeypatch):
+        monkeypatch.setattr(dashboard, 'get_today', lambda: datetime.datetime(2013, 9, 3))
+        data = json.loads(client.get('/api/todos?overdue=1').data)
+        assert [x['function_name'] for x in data['todos']] == ['test_0', 'test_1']
+        
+        data = json.loads(client.get('/api/todos?overdue=1&due_until=2013-09-01').data)
+        assert [x['function_name'] for x in data['todos']] == ['test_0']
+        
+        
+    @pytest.mark.parametrize('query', ['format=xml', 'limit=0', 'after=xxx', 'due_from=2013'])
+    def test_bad_request(self, client, query):
+        assert client.get('/api/todos?' + query).status_code == 400
+
+
+#===================================================================================================
+# TestApiSummary
+#===================================================================================================
+class TestApiSummary(object):
+
+    def test_summary(self, monkeypatch):
+        calls = []
+        class Storage(object):
+            def get_generation(self):
+                return 1
+            def count_todos_by(self, group_by, now, **filters):
+                calls.append((group_by, now, filters))
+                return [{group_by: 'proj', 'count': 3, 'overdue': 1}]
+        monkeypatch.setattr(dashboard, '_storage', Storage())
+        monkeypatch.setattr(dashboard, 'get_today', lambda: datetime.datetime(2013, 9, 3))
+        
+        client = app.test_client()
+        response = client.get('/api/summary?branch=master')
+        assert response.mimetype == 'application/json'
+        assert json.loads(response.data) == {
+            'groups': [{'project': 'proj', 'count': 3, 'overdue': 1}],
+        }
+        assert calls == [('project', datetime.datetime(2013, 9, 3), {'branch': 'master'})]
+        
+        response = client.get('/api/summary?by=repo&overdue=1')
+        assert json.loads(response.data)['groups'][0]['repo'] == 'proj'
+        assert calls[-1] == ('repo', datetime.datetime(2013, 9, 3), 
+            {'due_until': datetime.datetime(2013, 9, 3)})
+        assert client.get('/api/summary?by=file').status_code == 400
+
+
+#===================================================================================================
+# TestMetrics
+#===================================================================================================
+class TestMetrics(object):
+
+    def test_metrics(self, monkeypatch):
+        runs = {
+            'fetch_all': [{
+                'kind': 'fetch_all',
+                'started': datetime.datetime(2013, 9, 1),
+                'elapsed': 12.0,
+                'metrics': FetchMetrics().to_dict(),
+            }],
+            'fetch_worker': [{
+                'kind': 'fetch_worker',
+                'started': datetime.datetime(2013, 9, 1),
+                'elapsed': 10.0,
+                'metrics': FetchMetrics().to_dict(),
+            }],
+        }
+        class Storage(object):
+            def get_fetch_metrics(self, kind=None, limit=10):
+                return runs.get(kind, [])[:limit]
+        monkeypatch.setattr(dashboard, '_storage', Storage())
+
+        response = app.test_client().get('/metrics')
+        assert response.status_code == 200
+        assert response.mimetype == 'text/plain'
+        lines = response.data.splitlines()
+        assert 'todo_fetch_run_seconds{kind="fetch_all"} 12.0' in lines
+        assert 'todo_fetch_run_seconds{kind="fetch_worker"} 10.0' in lines
+
+
+#===================================================================================================
+# TestFetchAll
+#===================================================================================================
+class TestFetchAll(object):
+
+    @pytest.fixture
+    def release(self, monkeypatch):
+        '''
+        Replaces fetch_all by a fetch of two repositories; the second waits until the returned
+        event is set.
+        '''
+        config = types.ModuleType('config')
+        config.git_repo_url = 'http://stash'
+        config.search_projects = ['proj']
+        monkeypatch.setitem(sys.modules, 'config', config)
+        monkeypatch.setattr(dashboard, 'get_fetch_options', 
+            lambda config, repo_workers: {'parse_workers': 4})
+
+        result = threading.Event()
+        self.finished = threading.Event()
+        def fetch_all(git_repo_url, search_projects, auth, stream, progress, parse_workers):
+            assert auth == ('user', 'pass')
+            # process pools aren't forked from the web server
+            assert parse_workers == 0
+            for index, repo_name in enumerate(['proj/repo1', 'proj/repo2']):
+                if index == 1:
+                    assert result.wait(5)
+                print >> stream, 'Fetching %s' % repo_name
+                progress({'type': 'file', 'repo': repo_name, 'filename': 'test_foo.py'})
+                progress({'type': 'repo', 'repo': repo_name, 'state': 'done'})
+                yield
+            progress({'type': 'done', 'repos': 2})
+            self.finished.set()
+        monkeypatch.setattr(dashboard, 'fetch_all', fetch_all)
+        return result
+
+
+    def post(self, client, **data):
+        data.update(username='user', password='pass')
+        return client.post('/fetch', data=data, buffered=False)
+
+
+    def test_ndjson(self, release):
+        release.set()
+        client = app.test_client()
+        response = self.post(client)
+        assert response.mimetype == 'application/x-ndjson'
+        events = [json.loads(x) for x in response.data.splitlines()]
+        assert [x['type'] for x in events] == ['log', 'file', 'repo'] * 2 + ['done']
+        assert events[0]['text'] == 'Fetching proj/repo1'
+
+
+    def test_sse(self, release):
+        release.set()
+        client = app.test_client()
+        response = self.post(client, format='sse')
+        assert response.mimetype == 'text/event-stream'
+        messages = response.data.split('\n\n')
+        assert messages[-1] == ''
+        assert messages[1] == 'event: file\ndata: %s' % json.dumps(
+            {'type': 'file', 'repo': 'proj/repo1', 'filename': 'test_foo.py'})
+        assert len(messages) == 8
+
+
+    def test_disconnect(self, release):
+        client = app.test_client()
+        response = self.post(client)
+        chunks = iter(response.response)
+        assert json.loads(next(chunks))['type'] == 'log'
+
+        # another fetch can't start while the first is running
+        assert self.post(client).status_code == 409
+
+        # the fetch continues after the client disconnects
+        response.close()
+        release.set()
+        assert self.finished.wait(5)
+
+        deadline = time.time() + 5
+        while dashboard._fetch_all_events is not None and time.time() < deadline:
+            time.sleep(0.01)
+        assert dashboard._fetch_all_events is None
+
+
+    def test_bad_format(self, release):
+        assert self.post(app.test_client(), format='xml').status_code == 400
+        assert dashboard._fetch_all_events is None
+
+
+#===================================================================================================
+# TestHook
+#===================================================================================================
+class TestHook(object):
+
+    @pytest.fixture
+    def pushed(self, monkeypatch):
+        config = types.ModuleType('config')
+        config.search_projects = ['proj']
+        config.hook_secret = 'secret'
+        monkeypatch.setitem(sys.modules, 'config', config)
+        
+        result = []
+        class Queue(object):
+            def push(self, repo_name):
+                result.append(repo_name)
+        monkeypatch.setattr(dashboard, '_update_queue', Queue())
+        return result
+
+
+    def test_hook(self, pushed):
+        client = app.test_client()
+        response = client.post('/hook/proj/repo1?token=secret')
+        assert response.status_code == 202
+
+        payload = {'repository': {'slug': 'repo2', 'project': {'key': 'proj'}}}
+        response = client.post('/hook', data=json.dumps(payload), 
+            content_type='application/json', headers={'X-Hook-Token': 'secret'})
+        assert response.status_code == 202
+        assert pushed == ['proj/repo1', 'proj/repo2']
+
+        assert client.post('/hook?token=secret', data='{}').status_code == 400
+        assert client.post('/hook?token=secret', data='xxx').status_code == 400
+        payload = {'repository': {'slug': ['repo2'], 'project': {'key': 'proj'}}}
+        assert client.post('/hook?token=secret', data=json.dumps(payload)).status_code == 400
+        
+        
+    def test_rejected(self, pushed):
+        client = app.test_client()
+        # repositories not scanned
+        assert client.post('/hook/other/repo1?token=secret').status_code == 404
+        assert client.post('/hook/proj/etk?token=secret').status_code == 404
+        
+        # wrong or missing secrets
+        assert client.post('/hook/proj/repo1').status_code == 403
+        assert client.post('/hook/proj/repo1?token=wrong').status_code == 403
+        assert client.post('/hook/proj/repo1', headers={'X-Hook-Token': u'\xe7'}).status_code == \
+            403
+        sys.modules['config'].hook_secret = ''
+        assert client.post('/hook/proj/repo1?token=').status_code == 403
+        assert pushed == []
+
+
+#===================================================================================================
+# main
+#===================================================================================================
+if __name__ == '__main__':
+    pytest.main(['', '-s'])
@@ -0,0 +1,172 @@
+from StringIO import StringIO
+from fake_stash import FakeStashData, FakeStashServer, make_diff_hunks
+from metrics import FetchMetrics
+from test_update import MemoryStorage, storage
+from update import StashServer, fetch, parse_branch_rules
+import os
+import pytest
+import subprocess
+import sys
+
+
+
+#===================================================================================================
+# fixtures
+#===================================================================================================
+@pytest.fixture
+def data():
+    return FakeStashData(projects=1, repos=2, files=30, todo_ratio=0.5, branches=1)
+
+
+@pytest.fixture
+def server(request, data):
+    result = FakeStashServer(data)
+    result.start()
+    request.addfinalizer(result.stop)
+    return result
+
+
+@pytest.fixture
+def stash(server):
+    return StashServer(server.url, auth=None, backoff=0.0, metrics=FetchMetrics())
+
+
+#===================================================================================================
+# TestFakeStashServer
+#===================================================================================================
+class TestFakeStashServer(object):
+
+    def test_listing(self, data, server, stash):
+        assert list(stash.iter_repos('PROJ0')) == ['repo0', 'repo1']
+
+        repo = data.get_repo('PROJ0', 'repo0')
+        assert stash.get_branches('PROJ0/repo0') == {
+            'refs/heads/master': repo.commits[0],
+            'refs/heads/release/0': repo.commits[0],
+        }
+        assert list(stash.iter_file_names('PROJ0/repo0')) == repo.filenames
+        assert list(stash.iter_file_names('PROJ0/repo0', until=repo.commits[0])) == repo.filenames
+
+        new_commit = repo.add_commit(changed_files=3)
+        changed = list(stash.iter_file_names('PROJ0/repo0', since=repo.commits[0],
+            until=new_commit))
+        assert len(changed) == 3
+        assert stash.get_branches('PROJ0/repo0')['refs/heads/release/0'] == repo.commits[0]
+
+
+    def test_contents(self, data, server, stash):
+        repo = data.get_repo('PROJ0', 'repo0')
+        old_commit = repo.commits[0]
+        new_commit = repo.add_commit(changed_files=len(repo.filenames))
+
+        filename = 'tests/test_0.py'
+        old_contents = stash.get_file_contents('PROJ0/repo0', filename, at=old_commit)
+        assert old_contents == data.get_contents(repo, filename, old_commit)
+        assert 'def test_0' in old_contents
+        assert stash.get_file_contents('PROJ0/repo0', filename) != old_contents
+        assert stash.get_file_contents('PROJ0/repo0', filename, at=new_commit) != old_contents
+        assert stash.get_file_contents('PROJ0/repo0', 'missing.py') is None
+        assert server.requests['browse'] == 4
+
+
+    def test_diff(self, data, stash):
+        repo = data.get_repo('PROJ0', 'repo0')
+        old_commit = repo.commits[0]
+        new_commit = repo.add_commit(changed_files=3)
+        hunks = stash.get_diff_hunks('PROJ0/repo0', old_commit, new_commit)
+        assert sorted(hunks) == sorted(repo.iter_changes(old_commit, new_commit))
+        for filename, file_hunks in hunks.iteritems():
+            old_contents = data.get_contents(repo, filename, old_commit)
+            new_contents = data.get_contents(repo, filename, new_commit)
+            assert file_hunks == make_diff_hunks(old_contents, new_contents)
+            
+            
+    def test_errors(self, server):
+        server.error_rate = 0.5
+        stash = StashServer(server.url, auth=None, retries=10, backoff=0.0, metrics=FetchMetrics())
+        assert len(list(stash.iter_file_names('PROJ0/repo0'))) == 30
+        for i in xrange(15):
+            assert stash.get_file_contents('PROJ0/repo0', 'tests/test_%d.py' % i) is not None
+
+        statuses = dict(
+            ((x['endpoint'], x['status']), x['count']) for x in stash._metrics.to_dict()['requests']
+        )
+        assert statuses[('browse', 503)] > 0
+        assert statuses[('browse', 200)] == 15
+
+
+#===================================================================================================
+# TestFetch
+#===================================================================================================
+class TestFetch(object):
+
+    def test_fetch(self, data, server, stash):
+        repo = data.get_repo('PROJ0', 'repo1')
+        storage = MemoryStorage()
+        fetch('PROJ0/repo1', storage, stash, StringIO())
+
+        expected = set()
+        for filename in repo.filenames:
+            if 'ToDo' in data.get_contents(repo, filename, None):
+                expected.add(('PROJ0/repo1', 'master', filename))
+        assert expected
+        assert set(storage.todos) == expected
+        assert storage.get_last_hash('PROJ0/repo1') == repo.commits[-1]
+        assert server.requests['browse'] == 15
+
+        # only changed files are downloaded by the next fetch; the release branch starts from
+        # the todos of master at its previous head
+        repo.add_commit(changed_files=5)
+        fetch('PROJ0/repo1', storage, stash, StringIO(),
+            branch_rules=parse_branch_rules('master,release/*'))
+        assert storage.get_last_hash('PROJ0/repo1') == repo.commits[-1]
+        assert storage.get_last_hash('PROJ0/repo1', 'release/0') == repo.commits[0]
+        assert server.requests['browse'] <= 15 + 5
+
+
+#===================================================================================================
+# TestFetchWorkers
+#===================================================================================================
+class TestFetchWorkers(object):
+    '''
+    Fetches a fetch_all run with worker processes. Requires a MongoDB running.
+    '''
+
+    WORKER_SCRIPT = 'import sys, update; update.run_worker(sys.argv[1], repo_workers=1, ' \
+        'idle_timeout=0.0)'
+
+    def test_worker_processes(self, request, storage):
+        data = FakeStashData(projects=1, repos=8, files=10, todo_ratio=0.5, branches=0)
+        server = FakeStashServer(data, latency=0.05)
+        server.start()
+        request.addfinalizer(server.stop)
+
+        repos = ['PROJ0/repo%d' % i for i in xrange(8)]
+        run_id = storage.start_fetch_run(repos)
+        env = dict(os.environ,
+            MONGOLAB_URI='mongodb://localhost:27017/testing-{}'.format(request.node.name))
+        workers = [
+            subprocess.Popen([sys.executable, '-c', self.WORKER_SCRIPT, server.url], env=env,
+                cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE)
+            for _ in xrange(2)
+        ]
+        for worker in workers:
+            worker.communicate()
+            assert worker.returncode == 0
+
+        # each repository was fetched once, by one of the workers
+        states = storage.get_repo_states(run_id)
+        assert all(states[x]['state'] == 'done' for x in repos)
+        assert all(states[x]['attempts'] == 1 for x in repos)
+        assert len(set(x['worker'].rsplit(':', 1)[0] for x in states.itervalues())) == 2
+        for repo_name in repos:
+            repo = data.get_repo(*repo_name.split('/'))
+            assert storage.get_last_hash(repo_name) == repo.commits[0]
+        assert len(storage.get_fetch_metrics(kind='fetch_worker')) == 2
+
+
+#===================================================================================================
+# main
+#===================================================================================================
+if __name__ == '__main__':
+    pytest.main(['', '-s'])
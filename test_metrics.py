@@ -0,0 +1,89 @@
+from metrics import FetchMetrics, format_prometheus
+import datetime
+import pytest
+
+
+
+#===================================================================================================
+# TestFetchMetrics
+#===================================================================================================
+class TestFetchMetrics(object):
+
+    def test_stages(self):
+        now = [100.0]
+        metrics = FetchMetrics(clock=lambda: now[0])
+        with metrics.stage('proj/repo1', 'listing'):
+            now[0] += 2
+        with metrics.stage('proj/repo1', 'listing'):
+            now[0] += 1
+        metrics.add_stage_time('proj/repo2', 'parse', 0.5)
+
+        assert metrics.get_stage_times('proj/repo1') == {'listing': 3.0}
+        assert metrics.to_dict()['stages'] == [
+            {'repo': 'proj/repo1', 'stage': 'listing', 'seconds': 3.0},
+            {'repo': 'proj/repo2', 'stage': 'parse', 'seconds': 0.5},
+        ]
+
+
+    def test_requests(self):
+        metrics = FetchMetrics()
+        metrics.record_request('browse', 200, 0.01, 100)
+        metrics.record_request('browse', 200, 0.3, 50)
+        metrics.record_request('browse', None, 60.0, 0)
+        metrics.record_cache(3, 1)
+
+        recorded = metrics.to_dict()
+        assert recorded['requests'] == [
+            {'endpoint': 'browse', 'status': None, 'count': 1},
+            {'endpoint': 'browse', 'status': 200, 'count': 2},
+        ]
+        assert recorded['bytes'] == [{'endpoint': 'browse', 'bytes': 150}]
+        latencies, = recorded['latencies']
+        assert latencies['counts'] == [1, 0, 0, 1, 0, 0, 0, 0, 0, 1]
+        assert latencies['sum'] == pytest.approx(60.31)
+        assert recorded['cache'] == {'hits': 3, 'misses': 1}
+
+        metrics.reset()
+        assert metrics.to_dict() == FetchMetrics().to_dict()
+
+
+#===================================================================================================
+# TestFormatPrometheus
+#===================================================================================================
+class TestFormatPrometheus(object):
+
+    def test_format(self):
+        metrics = FetchMetrics()
+        metrics.add_stage_time('proj/repo"1', 'download', 1.5)
+        metrics.record_request('files', 200, 0.07, 10)
+        metrics.record_request('files', 200, 3.0, 10)
+        run = {
+            'kind': 'fetch_all',
+            'started': datetime.datetime(2013, 9, 1),
+            'elapsed': 12.0,
+            'metrics': metrics.to_dict(),
+        }
+        lines = format_prometheus([run]).splitlines()
+
+        assert '# TYPE todo_fetch_stage_seconds gauge' in lines
+        assert 'todo_fetch_stage_seconds{kind="fetch_all",repo="proj/repo\\"1",stage="download"} 1.5' \
+            in lines
+        assert 'todo_fetch_requests_total{kind="fetch_all",endpoint="files",status="200"} 2.0' \
+            in lines
+        assert 'todo_fetch_response_bytes_total{kind="fetch_all",endpoint="files"} 20.0' in lines
+        # buckets are cumulative
+        histogram = 'todo_fetch_request_latency_seconds'
+        assert histogram + '_bucket{kind="fetch_all",endpoint="files",le="0.05"} 0.0' in lines
+        assert histogram + '_bucket{kind="fetch_all",endpoint="files",le="0.1"} 1.0' in lines
+        assert histogram + '_bucket{kind="fetch_all",endpoint="files",le="+Inf"} 2.0' in lines
+        assert histogram + '_count{kind="fetch_all",endpoint="files"} 2.0' in lines
+        assert 'todo_fetch_run_seconds{kind="fetch_all"} 12.0' in lines
+
+        assert format_prometheus([]) == ''
+
+
+#===================================================================================================
+# main
+#===================================================================================================
+if __name__ == '__main__':
+    pytest.main(['', '-s'])
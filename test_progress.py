@@ -0,0 +1,77 @@
+from progress import LogEvents, ProgressEvents
+import pytest
+import threading
+
+
+
+#===================================================================================================
+# TestProgressEvents
+#===================================================================================================
+class TestProgressEvents(object):
+
+    def test_events(self):
+        events = ProgressEvents()
+        def write():
+            for i in xrange(3):
+                events.put({'type': 'file', 'done': i})
+            events.close()
+        thread = threading.Thread(target=write)
+        thread.start()
+        assert [x['done'] for x in events.iter_events()] == [0, 1, 2]
+        thread.join()
+
+        # events written after closing are ignored
+        events.put({'type': 'file', 'done': 3})
+        assert list(events.iter_events()) == []
+
+
+    def test_timeout(self):
+        events = ProgressEvents()
+        iterator = events.iter_events(timeout=0.01)
+        assert next(iterator) is None
+        events.put({'type': 'done'})
+        assert next(iterator) == {'type': 'done'}
+        events.close()
+        assert list(iterator) == []
+
+
+    def test_bounded(self):
+        events = ProgressEvents(max_events=3)
+        events.put({'type': 'file', 'done': 1})
+        events.put({'type': 'repo', 'repo': 'a'})
+        events.put({'type': 'file', 'done': 2})
+        # file events are dropped first
+        events.put({'type': 'file', 'done': 3})
+        events.put({'type': 'repo', 'repo': 'b'})
+        events.put({'type': 'repo', 'repo': 'c'})
+        # then the oldest events
+        events.put({'type': 'repo', 'repo': 'd'})
+        events.close()
+        assert list(events.iter_events()) == [
+            {'type': 'dropped', 'count': 4},
+            {'type': 'repo', 'repo': 'b'},
+            {'type': 'repo', 'repo': 'c'},
+            {'type': 'repo', 'repo': 'd'},
+        ]
+
+
+#===================================================================================================
+# TestLogEvents
+#===================================================================================================
+class TestLogEvents(object):
+
+    def test_lines(self):
+        written = []
+        stream = LogEvents(written.append)
+        print >> stream, 'Fetching'
+        stream.write('T.')
+        stream.write('.\nChanged Files: 3\n\n')
+        assert [x['text'] for x in written] == ['Fetching', 'T..', 'Changed Files: 3', '']
+        assert all(x['type'] == 'log' for x in written)
+
+
+#===================================================================================================
+# main
+#===================================================================================================
+if __name__ == '__main__':
+    pytest.main(['', '-s'])
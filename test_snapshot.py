@@ -0,0 +1,260 @@
+from snapshot import SnapshotStore, TodoSnapshot
+import datetime
+import pytest
+import time
+
+
+
+#===================================================================================================
+# fixtures
+#===================================================================================================
+def make_todo(repo, filename, lineno, date=None, days=None, branch='master', function_name=None):
+    return {
+        'project': repo.split('/')[0],
+        'repo': repo,
+        'branch': branch,
+        'filename': filename,
+        'function_name': function_name or 'test_%d' % lineno,
+        'kind': 'todo',
+        'text': None,
+        'lineno': lineno,
+        'date': date,
+        'days': days,
+        'due': date + datetime.timedelta(days=days or 0) if date is not None else None,
+    }
+
+
+TODOS = [
+    make_todo(u'proj1/repo1', u'test_foo.py', 10, datetime.datetime(2013, 9, 8), 5),
+    make_todo(u'proj1/repo1', u'test_foo.py', 2, None),
+    make_todo(u'proj1/repo1', u'test_bar.py', 5, datetime.datetime(2013, 9, 1, 12, 30), 1.5),
+    make_todo(u'proj1/repo1', u'test_bar.py', 7, datetime.datetime(2013, 9, 1), branch=u'dev'),
+    make_todo(u'proj2/repo2', u'test_\xe7a.py', 1, datetime.datetime(2013, 10, 1), 1,
+        function_name=u'test_é'),
+]
+
+
+def position(todo):
+    return (todo['repo'], todo['branch'], todo['filename'], todo['lineno'])
+
+
+@pytest.fixture
+def snapshot(tmpdir):
+    filename = str(tmpdir.join('todos.snapshot'))
+    with open(filename, 'wb') as stream:
+        TodoSnapshot.write(stream, 7, iter(TODOS))
+    return TodoSnapshot.load(filename)
+
+
+#===================================================================================================
+# TestTodoSnapshot
+#===================================================================================================
+class TestTodoSnapshot(object):
+
+    def test_todos(self, snapshot):
+        assert snapshot.get_generation() == 7
+        assert list(snapshot.iter_all_todos()) == sorted(TODOS, key=position)
+        assert snapshot.count_todos() == 5
+
+
+    def test_query(self, snapshot):
+        def query(**kwargs):
+            return [(x['repo'], x['branch'], x['filename'], x['lineno'])
+                for x in snapshot.query_todos(**kwargs)]
+
+        assert query() == sorted(position(x) for x in TODOS)
+        assert query(skip=1, limit=2) == sorted(position(x) for x in TODOS)[1:3]
+        assert query(repo='proj2/repo2') == [('proj2/repo2', 'master', u'test_\xe7a.py', 1)]
+        assert query(repo='proj1') == []
+        assert query(project='proj1', branch='dev') == [
+            ('proj1/repo1', 'dev', 'test_bar.py', 7),
+        ]
+        assert query(branch='unknown') == []
+        assert query(due_from=datetime.datetime(2013, 9, 2),
+                     due_until=datetime.datetime(2013, 10, 3)) == [
+            ('proj1/repo1', 'master', 'test_bar.py', 5),
+            ('proj1/repo1', 'master', 'test_foo.py', 10),
+            ('proj2/repo2', 'master', u'test_\xe7a.py', 1),
+        ]
+        assert snapshot.count_todos(due_until=datetime.datetime(2013, 9, 3)) == 1
+
+        # todos without a due date come first
+        assert [x[3] for x in query(order_by='due')] == [2, 7, 5, 10, 1]
+        assert [x[3] for x in query(order_by='due', repo='proj1/repo1', skip=1)] == [7, 5, 10]
+        with pytest.raises(ValueError):
+            query(order_by='name')
+
+
+    def test_iter_after(self, snapshot):
+        todos = list(snapshot.iter_todos())
+        for index, todo in enumerate(todos):
+            assert list(snapshot.iter_todos(after=position(todo))) == todos[index + 1:]
+        assert list(snapshot.iter_todos(after=('proj1/repo1', 'master', 'test_c.py', 0))) == \
+            todos[2:]
+        assert list(snapshot.iter_todos(repo='proj1/repo1', after=('proj0', '', '', 0))) == \
+            todos[:4]
+
+
+    def test_values(self, snapshot):
+        todo, = snapshot.query_todos(repo='proj1/repo1', branch='master',
+            due_from=datetime.datetime(2013, 9, 1), due_until=datetime.datetime(2013, 9, 4))
+        assert todo['date'] == datetime.datetime(2013, 9, 1, 12, 30)
+        assert todo['days'] == 1.5
+        assert todo['due'] == datetime.datetime(2013, 9, 3, 0, 30)
+
+        todo, = snapshot.query_todos(repo='proj2/repo2')
+        assert todo['function_name'] == u'test_é'
+        assert todo['days'] == 1
+        assert todo['text'] is None
+
+
+    def test_count_by(self, snapshot):
+        now = datetime.datetime(2013, 9, 10)
+        assert snapshot.count_todos_by('project', now) == [
+            {'project': 'proj1', 'count': 4, 'overdue': 2},
+            {'project': 'proj2', 'count': 1, 'overdue': 0},
+        ]
+        assert snapshot.count_todos_by('repo', now, branch='master') == [
+            {'repo': 'proj1/repo1', 'count': 3, 'overdue': 1},
+            {'repo': 'proj2/repo2', 'count': 1, 'overdue': 0},
+        ]
+        with pytest.raises(ValueError):
+            snapshot.count_todos_by('branch', now)
+
+
+    def test_empty(self, tmpdir):
+        filename = str(tmpdir.join('todos.snapshot'))
+        with open(filename, 'wb') as stream:
+            TodoSnapshot.write(stream, 0, [])
+        snapshot = TodoSnapshot.load(filename)
+        assert list(snapshot.iter_todos()) == []
+        assert snapshot.query_todos(repo='proj/repo', order_by='due') == []
+        assert snapshot.count_todos_by('repo', datetime.datetime(2013, 9, 1)) == []
+
+
+    def test_invalid(self, tmpdir):
+        filename = str(tmpdir.join('todos.snapshot'))
+        with open(filename, 'wb') as stream:
+            stream.write('x' * 100)
+        with pytest.raises(ValueError):
+            TodoSnapshot.load(filename)
+
+
+#===================================================================================================
+# TestSnapshotStore
+#===================================================================================================
+class TestSnapshotStore(object):
+
+    class Storage(object):
+
+        def __init__(self):
+            self.generation = 1
+            self.todos = list(TODOS)
+            self.reads = 0
+            self.checks = 0
+
+
+        def get_generation(self):
+            self.checks += 1
+            return self.generation
+
+
+        def iter_all_todos(self):
+            self.reads += 1
+            return iter(self.todos)
+
+
+    def wait_for_generation(self, store, storage, generation):
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            snapshot = store.get(storage)
+            if snapshot is not None and snapshot.generation == generation:
+                return snapshot
+            time.sleep(0.01)
+        raise AssertionError('generation %d not loaded' % generation)
+
+
+    def test_store(self, tmpdir):
+        storage = self.Storage()
+        store = SnapshotStore(str(tmpdir))
+        snapshot = store.refresh(storage)
+        assert snapshot.generation == 1
+        assert snapshot.count_todos() == 5
+        assert store.refresh(storage) is snapshot
+        assert tmpdir.listdir() == [tmpdir.join('todos-1.snapshot')]
+
+        # another process loads the snapshot written by the first
+        other_store = SnapshotStore(str(tmpdir))
+        assert other_store.refresh(storage).count_todos() == 5
+        assert storage.reads == 1
+
+        # a new generation replaces the snapshot and the file of the process that wrote it
+        storage.generation = 2
+        del storage.todos[0]
+        assert store.refresh(storage).count_todos() == 4
+        assert tmpdir.listdir() == [tmpdir.join('todos-2.snapshot')]
+        assert other_store.refresh(storage).count_todos() == 4
+        assert snapshot.count_todos() == 5
+        assert storage.reads == 2
+
+        # files written by other processes are left to them
+        storage.generation = 3
+        assert other_store.refresh(storage).generation == 3
+        assert sorted(tmpdir.listdir()) == [
+            tmpdir.join('todos-2.snapshot'), tmpdir.join('todos-3.snapshot')]
+        store.close()
+        assert tmpdir.listdir() == [tmpdir.join('todos-3.snapshot')]
+        other_store.close()
+        assert tmpdir.listdir() == []
+        assert other_store.get(storage).count_todos() == 4
+
+
+    def test_background(self, tmpdir):
+        storage = self.Storage()
+        store = SnapshotStore(str(tmpdir.join('snapshots')), min_interval=0.0)
+        # requests don't wait for snapshots to be built
+        assert store.get(storage) is None
+        assert self.wait_for_generation(store, storage, 1).count_todos() == 5
+
+        storage.generation = 2
+        del storage.todos[0]
+        assert self.wait_for_generation(store, storage, 2).count_todos() == 4
+        assert storage.reads == 2
+
+
+    def test_background_failure(self, tmpdir, caplog):
+        storage = self.Storage()
+        def get_generation():
+            raise RuntimeError('database unavailable')
+        storage.get_generation = get_generation
+        store = SnapshotStore(str(tmpdir), min_interval=0.0)
+        assert store.get(storage) is None
+
+        # the failure is logged, and the next request tries again
+        deadline = time.time() + 5
+        while 'database unavailable' not in caplog.text and time.time() < deadline:
+            time.sleep(0.01)
+        assert 'Refreshing the snapshot failed' in caplog.text
+        del storage.get_generation
+        assert self.wait_for_generation(store, storage, 1).count_todos() == 5
+
+
+    def test_min_interval(self, tmpdir):
+        storage = self.Storage()
+        store = SnapshotStore(str(tmpdir), min_interval=60.0)
+        self.wait_for_generation(store, storage, 1)
+        assert storage.checks == 1
+
+        # the previous snapshot is served, without checking the storage, until the interval ends
+        storage.generation = 2
+        for _ in xrange(10):
+            assert store.get(storage).generation == 1
+        assert storage.checks == 1
+        assert storage.reads == 1
+
+
+#===================================================================================================
+# main
+#===================================================================================================
+if __name__ == '__main__':
+    pytest.main(['', '-s'])
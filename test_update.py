@@ -1,6 +1,23 @@
-from update import MongoStorage, StashServer
+from StringIO import StringIO
+from fake_stash import make_diff_hunks
+from metrics import FetchMetrics
+from update import (_LineStream, _SafeEval, AdaptiveLimiter, GitMirrorSource, IterToDos, 
+    MARKER_KINDS, MongoStorage, RepoSource, StashServer, ToDoExtractor, TokenBucket, UpdateQueue, 
+    FetchCancelled, check_engine, compute_blob_id, drain_fetch_queue, fetch, is_repo_due, 
+    make_worker_id, parse_branch_rules, parse_rate_limits, schedule_repos, select_branches, 
+    shift_todos)
+import ast
+import collections
 import datetime
+import futures
+import os
 import pytest
+import requests
+import subprocess
+import sys
+import textwrap
+import threading
+import time
 
 
 
@@ -42,11 +59,21 @@ class TestMongoStorage(object):
         }
         
         
-    def discard_ids(self, entries):
-        entries = list(entries)
-        for entry in entries:
-            del entry['_id']
-        return list(entries)
+    def get_entries(self, storage):
+        '''
+        Returns the todos stored grouped by file, as dicts with 'repo', 'branch', 'filename' and
+        'todos' (without the fields added for querying).
+        '''
+        result = []
+        for todo in storage.iter_all_todos():
+            entry = dict((x, todo.pop(x)) for x in ('repo', 'branch', 'filename'))
+            del todo['project'], todo['due']
+            if result and all(result[-1][x] == entry[x] for x in entry):
+                result[-1]['todos'].append(todo)
+            else:
+                entry['todos'] = [todo]
+                result.append(entry)
+        return result
         
     
     def test_todos(self, storage):
@@ -58,9 +85,10 @@ class TestMongoStorage(object):
             self.make_todo_dict('test_foo2', datetime.datetime(2013, 9, 24), 10, 500),
         ]
         storage.update_todos('proj/repo1', 'src/foo.py', foo_todos)
-        assert self.discard_ids(storage.iter_all_todos()) == [
+        assert self.get_entries(storage) == [
             {
                 'repo': 'proj/repo1',
+                'branch': 'master',
                 'filename': 'src/foo.py',
                 'todos': foo_todos,
             },
@@ -69,9 +97,10 @@ class TestMongoStorage(object):
         # change date and make sure it reflects back
         foo_todos[0]['date'] = datetime.datetime(2014, 9, 8)
         storage.update_todos('proj/repo1', 'src/foo.py', foo_todos)
-        assert self.discard_ids(storage.iter_all_todos()) == [
+        assert self.get_entries(storage) == [
             {
                 'repo': 'proj/repo1',
+                'branch': 'master',
                 'filename': 'src/foo.py',
                 'todos': foo_todos,
             },
@@ -82,14 +111,16 @@ class TestMongoStorage(object):
             self.make_todo_dict('test_bar1', datetime.datetime(2013, 5, 8), 15, 600),
         ]
         storage.update_todos('proj/repo2', 'src/bar.py', bar_todos)
-        assert self.discard_ids(storage.iter_all_todos()) == [
+        assert self.get_entries(storage) == [
             {
                 'repo': 'proj/repo1',
+                'branch': 'master',
                 'filename': 'src/foo.py',
                 'todos': foo_todos,
             },
             {
                 'repo': 'proj/repo2',
+                'branch': 'master',
                 'filename': 'src/bar.py',
                 'todos': bar_todos,
             },
@@ -97,15 +128,198 @@ class TestMongoStorage(object):
         
         # remove todos for 'foo' and make sure 'bar' todos are still ok
         storage.update_todos('proj/repo1', 'src/foo.py', [])
-        assert self.discard_ids(storage.iter_all_todos()) == [
+        assert self.get_entries(storage) == [
             {
                 'repo': 'proj/repo2',
+                'branch': 'master',
                 'filename': 'src/bar.py',
                 'todos': bar_todos,
             },
         ]
         
         
+    def test_update_repo_todos(self, storage):
+        foo_todos = [self.make_todo_dict('test_foo1', datetime.datetime(2013, 9, 8), 5, 200)]
+        bar_todos = [self.make_todo_dict('test_bar1', None, None, 10)]
+        storage.update_repo_todos('proj/repo1', [('foo.py', foo_todos), ('bar.py', bar_todos)])
+        assert storage.get_last_hash('proj/repo1') is None
+        assert len(list(storage.iter_all_todos())) == 2
+        
+        # files without todos are removed; hash is updated along with the todos
+        storage.update_repo_todos('proj/repo1', [('foo.py', []), ('baz.py', [])], 
+            hash_value='11111')
+        assert self.get_entries(storage) == [
+            {
+                'repo': 'proj/repo1',
+                'branch': 'master',
+                'filename': 'bar.py',
+                'todos': bar_todos,
+            },
+        ]
+        assert storage.get_last_hash('proj/repo1') == '11111'
+        
+        storage.update_todos('proj/repo2', 'foo.py', foo_todos)
+        assert storage.drop_todos_for_repo('proj/repo1')
+        assert not storage.drop_todos_for_repo('proj/repo1')
+        assert storage.get_last_hash('proj/repo1') is None
+        assert [x['repo'] for x in storage.iter_all_todos()] == ['proj/repo2']
+        
+        
+    def test_query_todos(self, storage):
+        storage.update_repo_todos('proj1/repo1', [
+            ('foo.py', [
+                self.make_todo_dict('test_foo1', datetime.datetime(2013, 9, 8), 5, 10),
+                self.make_todo_dict('test_foo2', None, None, 20),
+            ]),
+            ('bar.py', [self.make_todo_dict('test_bar1', datetime.datetime(2013, 9, 1), None, 5)]),
+        ])
+        storage.update_repo_todos('proj2/repo2', [
+            ('baz.py', [self.make_todo_dict('test_baz1', datetime.datetime(2013, 10, 1), 1, 1)]),
+        ])
+        
+        def query(**kwargs):
+            return [(x['repo'], x['filename'], x['function_name']) for x in 
+                storage.query_todos(**kwargs)]
+            
+        assert query() == [
+            ('proj1/repo1', 'bar.py', 'test_bar1'),
+            ('proj1/repo1', 'foo.py', 'test_foo1'),
+            ('proj1/repo1', 'foo.py', 'test_foo2'),
+            ('proj2/repo2', 'baz.py', 'test_baz1'),
+        ]
+        assert storage.count_todos() == 4
+        assert query(skip=1, limit=2) == [
+            ('proj1/repo1', 'foo.py', 'test_foo1'),
+            ('proj1/repo1', 'foo.py', 'test_foo2'),
+        ]
+        assert query(project='proj2') == [('proj2/repo2', 'baz.py', 'test_baz1')]
+        assert query(repo='proj1/repo1', limit=1) == [('proj1/repo1', 'bar.py', 'test_bar1')]
+        
+        due_from = datetime.datetime(2013, 9, 5)
+        due_until = datetime.datetime(2013, 10, 2)
+        assert query(due_from=due_from, due_until=due_until) == [
+            ('proj1/repo1', 'foo.py', 'test_foo1'),
+        ]
+        assert storage.count_todos(due_from=due_from) == 2
+        
+        # iter_todos returns the same todos as query_todos, and can resume from any of them
+        assert list(storage.iter_todos()) == storage.query_todos()
+        assert list(storage.iter_todos(due_from=due_from)) == storage.query_todos(due_from=due_from)
+        assert [x['function_name'] for x in 
+            storage.iter_todos(after=('proj1/repo1', 'master', 'foo.py', 10))] == \
+            ['test_foo2', 'test_baz1']
+        
+        todo = storage.query_todos(project='proj2')[0]
+        assert todo['due'] == datetime.datetime(2013, 10, 2)
+        assert todo['project'] == 'proj2'
+        assert todo['branch'] == 'master'
+        assert todo['lineno'] == 1
+        
+        
+    def test_branches(self, storage):
+        foo_todos = [self.make_todo_dict('test_foo1', None, None, 10)]
+        bar_todos = [self.make_todo_dict('test_bar1', None, None, 20)]
+        storage.update_repo_todos('proj/repo1', [('foo.py', foo_todos)], hash_value='11111')
+        storage.update_repo_todos('proj/repo1', [('bar.py', bar_todos)], hash_value='22222', 
+            branch='release')
+        assert storage.get_last_hash('proj/repo1') == '11111'
+        assert storage.get_last_hash('proj/repo1', 'release') == '22222'
+        assert storage.get_last_hash('proj/repo1', 'other') is None
+        
+        def query(**kwargs):
+            return [(x['branch'], x['filename']) for x in storage.query_todos(**kwargs)]
+        
+        assert query() == [('master', 'foo.py'), ('release', 'bar.py')]
+        assert query(branch='release') == [('release', 'bar.py')]
+        assert [x['function_name'] for x in 
+            storage.iter_todos(after=('proj/repo1', 'master', 'foo.py', 10))] == ['test_bar1']
+        
+        # todos of the other branch are replaced
+        storage.copy_branch_todos('proj/repo1', 'master', 'release', '11111')
+        assert query() == [('master', 'foo.py'), ('release', 'foo.py')]
+        assert storage.get_last_hash('proj/repo1', 'release') == '11111'
+        
+        assert storage.drop_todos_for_repo('proj/repo1')
+        assert query() == []
+        assert storage.get_last_hash('proj/repo1', 'release') is None
+        
+        
+    def test_upgrade_todos(self, storage):
+        db = storage.get_connection()['testing-test_upgrade_todos']
+        # entries stored before branches were supported
+        db.todos.insert({'repo': 'proj/repo1', 'filename': 'foo.py', 
+            'todos': [self.make_todo_dict('test_foo1', None, None, 10)]})
+        db.hashes.insert({'repo': 'proj/repo1', 'hash': '11111'})
+        db.todos.create_index([('repo', 1), ('filename', 1)])
+        # entries stored with all todos of a file in a single document
+        db.todos.create_index([('todos.due', 1)])
+        date = datetime.datetime(2013, 9, 1)
+        db.todos.insert({'project': 'proj', 'repo': 'proj/repo2', 'branch': 'release', 
+            'filename': 'bar.py', 'todos': [
+                dict(self.make_todo_dict('test_bar1', date, 5, 10), due=date), 
+                dict(self.make_todo_dict('test_bar2', None, None, 20), due=None),
+            ]})
+        # ... whose todos were already inserted by an interrupted upgrade
+        db.todos.insert(MongoStorage._make_entry('proj', 'proj/repo2', 'release', 'bar.py', 
+            self.make_todo_dict('test_bar1', date, 5, 10)))
+        
+        # entries are upgraded by any process opening the storage, as many times as needed
+        MongoStorage(default_db_name='testing-test_upgrade_todos')
+        storage.upgrade_todos()
+        assert [(x['project'], x['repo'], x['branch'], x['function_name'], x['due']) 
+            for x in storage.query_todos()] == [
+            ('proj', 'proj/repo1', 'master', 'test_foo1', None),
+            ('proj', 'proj/repo2', 'release', 'test_bar1', datetime.datetime(2013, 9, 6)),
+            ('proj', 'proj/repo2', 'release', 'test_bar2', None),
+        ]
+        assert db.todos.find({'todos': {'$exists': True}}).count() == 0
+        assert 'todos.due_1' not in db.todos.index_information()
+        assert 'repo_1_filename_1' not in db.todos.index_information()
+        assert storage.get_last_hash('proj/repo1') == '11111'
+        assert storage.get_last_hash('proj/repo1', scan_key=ToDoExtractor().scan_key) == '11111'
+        
+        
+    def test_compute_due(self):
+        date = datetime.datetime(2013, 9, 1)
+        assert MongoStorage.compute_due({'date': date, 'days': 5}) == datetime.datetime(2013, 9, 6)
+        assert MongoStorage.compute_due({'date': date, 'days': None}) == date
+        assert MongoStorage.compute_due({'date': None, 'days': 5}) is None
+        # days cached by older versions may be of any kind
+        for days in ['5', 10 ** 9, 10 ** 30]:
+            assert MongoStorage.compute_due({'date': date, 'days': days}) is None
+        
+        
+    def test_due_order(self, storage):
+        storage.update_repo_todos('proj1/repo1', [
+            ('foo.py', [
+                self.make_todo_dict('test_foo1', datetime.datetime(2013, 9, 8), 5, 10),
+                self.make_todo_dict('test_foo2', None, None, 20),
+            ]),
+            ('bar.py', [self.make_todo_dict('test_bar1', datetime.datetime(2013, 9, 1), None, 5)]),
+        ])
+        storage.update_repo_todos('proj2/repo2', [
+            ('baz.py', [self.make_todo_dict('test_baz1', datetime.datetime(2013, 10, 1), 1, 1)]),
+        ])
+        
+        # overdue todos, sorted by due date
+        now = datetime.datetime(2013, 10, 1)
+        assert [x['function_name'] for x in 
+            storage.query_todos(due_until=now, order_by='due', limit=50)] == \
+            ['test_bar1', 'test_foo1']
+        assert [x['function_name'] for x in storage.query_todos(order_by='due')] == \
+            ['test_foo2', 'test_bar1', 'test_foo1', 'test_baz1']
+        with pytest.raises(ValueError):
+            storage.query_todos(order_by='lineno')
+        
+        assert storage.count_todos_by('project', now) == [
+            {'project': 'proj1', 'count': 3, 'overdue': 2},
+            {'project': 'proj2', 'count': 1, 'overdue': 0},
+        ]
+        assert storage.count_todos_by('repo', now, project='proj2') == [
+            {'repo': 'proj2/repo2', 'count': 1, 'overdue': 0},
+        ]
+        
+        
     def test_last_hash(self, storage):
         assert storage.get_last_hash('proj/repo1') is None
         assert storage.get_last_hash('proj/repo2') is None
@@ -118,6 +332,256 @@ class TestMongoStorage(object):
         assert storage.get_last_hash('proj/repo1') == '11111'
         assert storage.get_last_hash('proj/repo2') == '22222'
         
+        # hashes fetched with another extractor configuration are ignored if asked
+        storage.update_repo_todos('proj/repo1', [], hash_value='33333', scan_key='todo;test_*.py')
+        assert storage.get_last_hash('proj/repo1', scan_key='todo;test_*.py') == '33333'
+        assert storage.get_last_hash('proj/repo1', scan_key='skip;test_*.py') is None
+        assert storage.get_last_hash('proj/repo2', scan_key='todo;test_*.py') is None
+        assert storage.get_last_hashes(['proj/repo1', 'proj/repo2'], 'todo;test_*.py') == {
+            ('proj/repo1', 'master'): '33333',
+        }
+        
+        
+    def test_drop_branch_todos(self, storage):
+        todos = [self.make_todo_dict('test_foo', datetime.datetime(2013, 9, 8), 5, 10)]
+        storage.update_repo_todos('proj/repo1', [('foo.py', todos)], hash_value='11111')
+        storage.update_repo_todos('proj/repo1', [('foo.py', todos)], branch='dev')
+        generation = storage.get_generation()
+        storage.drop_branch_todos('proj/repo1', 'master')
+        assert [x['branch'] for x in storage.iter_all_todos()] == ['dev']
+        assert storage.get_last_hash('proj/repo1') == '11111'
+        assert storage.get_generation() == generation + 1
+        
+        
+    def test_parse_cache(self, storage):
+        todos = [self.make_todo_dict('test_foo', datetime.datetime(2013, 9, 8), 5, 10)]
+        assert storage.get_cached_todos(['aaa', 'bbb']) == {}
+        
+        storage.cache_todos({'aaa': todos, 'bbb': []})
+        storage.cache_todos({'aaa': todos})
+        assert storage.get_cached_todos(['aaa', 'bbb', 'ccc']) == {'aaa': todos, 'bbb': []}
+        
+        # survives drop_all
+        storage.drop_all()
+        assert storage.get_cached_todos(['aaa']) == {'aaa': todos}
+        
+        # todos extracted with other markers are cached separately
+        assert storage.get_cached_todos(['aaa'], 'skip,todo') == {}
+        storage.cache_todos({'aaa': []}, 'skip,todo')
+        assert storage.get_cached_todos(['aaa'], 'skip,todo') == {'aaa': []}
+        assert storage.get_cached_todos(['aaa']) == {'aaa': todos}
+        
+        
+    def test_generation(self, storage):
+        assert storage.get_generation() == 0
+        
+        storage.update_todos('proj/repo1', 'foo.py', [self.make_todo_dict('test_foo', None, None, 1)])
+        assert storage.get_generation() == 1
+        
+        # nothing to write
+        storage.update_repo_todos('proj/repo1', [], hash_value='1111')
+        assert storage.get_generation() == 1
+        
+        storage.set_last_fetch_all_status(datetime.datetime.today(), datetime.timedelta(seconds=1))
+        assert storage.get_generation() == 2
+        
+        storage.drop_todos_for_repo('proj/repo1')
+        assert storage.get_generation() == 3
+        
+        storage.drop_all()
+        assert storage.get_generation() == 4
+        
+        
+    def test_checkpoint(self, storage):
+        assert storage.get_checkpoint('proj/repo1') is None
+        
+        todos = [self.make_todo_dict('test_foo', None, None, 1)]
+        checkpoint = {'since': None, 'until': '11111', 'count': 200}
+        storage.update_repo_todos('proj/repo1', [('foo.py', todos)], checkpoint=checkpoint)
+        assert storage.get_checkpoint('proj/repo1') == checkpoint
+        assert storage.get_last_hash('proj/repo1') is None
+        
+        storage.update_repo_todos('proj/repo1', [], hash_value='11111')
+        assert storage.get_checkpoint('proj/repo1') is None
+        assert storage.get_last_hash('proj/repo1') == '11111'
+        
+        
+    def test_fetch_runs(self, storage):
+        assert storage.get_unfinished_fetch_run() is None
+        assert storage.get_repo_states() == {}
+        
+        run_id = storage.start_fetch_run(['proj/repo1', 'proj/repo2'])
+        assert storage.get_unfinished_fetch_run() == (run_id, ['proj/repo1', 'proj/repo2'])
+        storage.set_repo_state(run_id, 'proj/repo1', 'done')
+        storage.set_repo_state(run_id, 'proj/repo2', 'failed', error='timeout')
+        
+        states = storage.get_repo_states()
+        assert states['proj/repo1']['state'] == 'done'
+        assert (states['proj/repo2']['state'], states['proj/repo2']['error']) == ('failed', 'timeout')
+        assert storage.get_repo_states(run_id) == states
+        
+        storage.finish_fetch_run(run_id)
+        assert storage.get_unfinished_fetch_run() is None
+
+
+    def test_fetch_queue(self, storage):
+        run_id = storage.start_fetch_run(['proj/repo1', 'proj/repo2'])
+        assert storage.count_unfinished_repos(run_id) == 2
+
+        # each repository is claimed by a single worker
+        claimed = [storage.claim_repo(run_id, 'w%d' % i, 60.0, 2) for i in xrange(3)]
+        assert sorted(claimed[:2]) == ['proj/repo1', 'proj/repo2']
+        assert claimed[2] is None
+        states = storage.get_repo_states(run_id)
+        assert states[claimed[0]]['worker'] == 'w0'
+        assert states[claimed[0]]['attempts'] == 1
+
+        # only the worker holding a repository can renew its lease or set its state
+        assert storage.renew_repo_lease(run_id, claimed[0], 'w0', 60.0)
+        assert not storage.renew_repo_lease(run_id, claimed[0], 'w1', 60.0)
+        assert not storage.set_repo_state(run_id, claimed[0], 'done', worker='w1')
+        assert storage.set_repo_state(run_id, claimed[0], 'done', worker='w0')
+        assert storage.count_unfinished_repos(run_id) == 1
+
+        # expired leases are claimed again, until the repository fails
+        assert storage.renew_repo_lease(run_id, claimed[1], 'w1', -1.0)
+        assert storage.claim_repo(run_id, 'w2', -1.0, 2) == claimed[1]
+        assert not storage.set_repo_state(run_id, claimed[1], 'done', worker='w1')
+        assert storage.claim_repo(run_id, 'w3', 60.0, 2) is None
+        states = storage.get_repo_states(run_id)
+        assert states[claimed[1]]['state'] == 'failed'
+        assert storage.count_unfinished_repos(run_id) == 0
+
+        # failed repositories are queued again when the run is resumed
+        storage.requeue_repos(run_id, [claimed[1]])
+        assert storage.claim_repo(run_id, 'w4', 60.0, 2) == claimed[1]
+        assert storage.get_repo_states(run_id)[claimed[1]]['attempts'] == 1
+
+
+    def test_claim_contention(self, storage, request):
+        '''
+        Workers claiming concurrently, each with its own connection, never claim the same 
+        repository twice.
+        '''
+        repos = ['proj/repo%02d' % i for i in xrange(40)]
+        run_id = storage.start_fetch_run(repos)
+        claimed = []
+        def claim_all(index):
+            worker_storage = MongoStorage(default_db_name='testing-{}'.format(request.node.name))
+            while True:
+                repo_name = worker_storage.claim_repo(run_id, 'w%d' % index, 60.0, 3)
+                if repo_name is None:
+                    return
+                claimed.append((repo_name, 'w%d' % index))
+                
+        workers = [threading.Thread(target=claim_all, args=(i,)) for i in xrange(8)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            
+        assert sorted(x for x, _ in claimed) == repos
+        states = storage.get_repo_states(run_id)
+        assert all(states[x]['worker'] == worker for x, worker in claimed)
+        assert all(states[x]['attempts'] == 1 for x in repos)
+
+
+    def test_lease_expiry(self, storage):
+        '''
+        A repository whose lease isn't renewed in time is claimed by another worker, and the 
+        worker that lost it can no longer renew it.
+        '''
+        run_id = storage.start_fetch_run(['proj/repo1'])
+        assert storage.claim_repo(run_id, 'w1', 0.5, 3) == 'proj/repo1'
+        assert storage.claim_repo(run_id, 'w2', 0.5, 3) is None
+        assert storage.renew_repo_lease(run_id, 'proj/repo1', 'w1', 0.5)
+        
+        time.sleep(1.0)
+        assert storage.claim_repo(run_id, 'w2', 60.0, 3) == 'proj/repo1'
+        assert not storage.renew_repo_lease(run_id, 'proj/repo1', 'w1', 60.0)
+        assert storage.get_repo_states(run_id)['proj/repo1']['attempts'] == 2
+        assert storage.set_repo_state(run_id, 'proj/repo1', 'done', worker='w2')
+        assert storage.count_unfinished_repos(run_id) == 0
+        
+        
+    def test_repo_lock(self, storage):
+        assert storage.lock_repo('proj/repo1', 'w1', 0.5)
+        assert storage.lock_repo('proj/repo1', 'w1', 0.5)
+        assert not storage.lock_repo('proj/repo1', 'w2', 0.5)
+        assert storage.lock_repo('proj/repo2', 'w2', 60.0)
+        assert storage.renew_repo_lock('proj/repo1', 'w1', 0.5)
+        assert not storage.renew_repo_lock('proj/repo1', 'w2', 0.5)
+        
+        # expired locks are taken by other owners
+        time.sleep(1.0)
+        assert storage.lock_repo('proj/repo1', 'w2', 60.0)
+        assert not storage.renew_repo_lock('proj/repo1', 'w1', 60.0)
+        storage.unlock_repo('proj/repo1', 'w1')
+        assert not storage.lock_repo('proj/repo1', 'w1', 60.0)
+        storage.unlock_repo('proj/repo1', 'w2')
+        assert storage.lock_repo('proj/repo1', 'w1', 60.0)
+
+
+    def test_repo_schedules(self, storage):
+        assert storage.get_repo_schedules() == {}
+        checked = datetime.datetime(2013, 9, 10, 12, 0)
+        storage.set_repo_schedule('proj/repo1', checked=checked, changed=checked)
+        storage.set_repo_schedule('proj/repo1', cost=2.5)
+        storage.set_repo_schedule('proj/repo2', cost=10.0)
+        assert storage.get_repo_schedules() == {
+            'proj/repo1': {'checked': checked, 'changed': checked, 'cost': 2.5},
+            'proj/repo2': {'checked': None, 'changed': None, 'cost': 10.0},
+        }
+        
+        # the costliest repositories are claimed first
+        run_id = storage.start_fetch_run(['proj/repo1', 'proj/repo2', 'proj/repo3'], 
+            costs={'proj/repo1': 2.5, 'proj/repo2': 10.0})
+        claimed = [storage.claim_repo(run_id, 'w', 60.0, 3) for _ in xrange(3)]
+        assert claimed == ['proj/repo2', 'proj/repo1', 'proj/repo3']
+        
+        
+    def test_file_todos(self, storage):
+        todo1 = self.make_todo_dict('test_foo', datetime.datetime(2013, 9, 1), 5, 10)
+        todo2 = self.make_todo_dict('test_bar', None, None, 2)
+        storage.update_repo_todos('proj/repo1', [('foo.py', [todo1, todo2])])
+        storage.update_repo_todos('proj/repo1', [('foo.py', [todo1])], branch='dev')
+        assert storage.get_file_todos('proj/repo1', ['foo.py', 'bar.py']) == {
+            'foo.py': [todo2, todo1],
+            'bar.py': [],
+        }
+        
+        
+    def test_last_hashes(self, storage):
+        storage.set_last_hash('proj/repo1', 'a' * 40)
+        storage.set_last_hash('proj/repo1', 'b' * 40, branch='dev')
+        storage.set_last_hash('proj/repo2', 'c' * 40)
+        storage.update_repo_todos('proj/repo2', [], checkpoint={'since': 'c' * 40, 
+            'until': 'd' * 40, 'count': 10})
+        storage.set_last_hash('proj/repo3', 'e' * 40)
+        assert storage.get_last_hashes(['proj/repo1', 'proj/repo2']) == {
+            ('proj/repo1', 'master'): 'a' * 40,
+            ('proj/repo1', 'dev'): 'b' * 40,
+        }
+        
+        
+    def test_fetch_metrics(self, storage):
+        assert storage.get_fetch_metrics() == []
+        
+        started = datetime.datetime(2013, 9, 8, 23, 30, 0)
+        for elapsed in [10.0, 20.0]:
+            storage.add_fetch_metrics('fetch_all', started, elapsed, {'cache': {'hits': 1}})
+        storage.add_fetch_metrics('fetch_single', started, 1.0, {'cache': {'hits': 2}})
+        
+        assert [x['elapsed'] for x in storage.get_fetch_metrics()] == [1.0, 20.0, 10.0]
+        last_run, = storage.get_fetch_metrics(kind='fetch_all', limit=1)
+        assert last_run == {
+            'kind': 'fetch_all', 
+            'started': started, 
+            'elapsed': 20.0, 
+            'metrics': {'cache': {'hits': 1}}, 
+            'run_id': None,
+        }
+        
         
     def test_last_fetch_all_status(self, storage):
         assert storage.get_last_fetch_all_status() == (None, None)
@@ -207,6 +671,1531 @@ class TestStashServer(object):
         ]
         
         
+#===================================================================================================
+# TestIterToDos
+#===================================================================================================
+class TestIterToDos(object):
+    
+    SOURCE = '''
+from todo import ToDo
+
+@ToDo((2013, 9, 1), days=5)
+def test_foo():
+    pass
+    
+@slow
+@ToDo((2013, 9, 1))
+def test_not_first_decorator():
+    pass
+    
+class TestBar(object):
+    
+    # comment
+    @ToDo(
+        (2013, 9, 2), 
+        days=10,
+    )
+    def test_bar(
+        self,
+    ):
+        @ToDo((2013, 9, 3))
+        def nested():
+            pass
+    
+    @ToDo()
+    def test_no_date(self): pass
+    
+if True:
+    @ToDo((2013, 9, 4), days=2)
+    def test_in_if():
+        pass
+'''
+    
+    def test_todos(self):
+        assert list(IterToDos(self.SOURCE)) == [
+            {
+                'kind': 'todo',
+                'function_name': 'test_foo',
+                'date': datetime.datetime(2013, 9, 1),
+                'days': 5,
+                'lineno': 4,
+                'text': None,
+            },
+            {
+                'kind': 'todo',
+                'function_name': 'test_bar',
+                'date': datetime.datetime(2013, 9, 2),
+                'days': 10,
+                'lineno': 16,
+                'text': None,
+            },
+            {
+                'kind': 'todo',
+                'function_name': 'test_no_date',
+                'date': None,
+                'days': None,
+                'lineno': 27,
+                'text': None,
+            },
+            {
+                'kind': 'todo',
+                'function_name': 'test_in_if',
+                'date': datetime.datetime(2013, 9, 4),
+                'days': 2,
+                'lineno': 31,
+                'text': None,
+            },
+        ]
+        
+        
+    def test_no_todos(self):
+        assert list(IterToDos('def test_foo(:\n')) == []
+        assert list(IterToDos('@ToDo((2013, 9, 1))\ndef test_foo(:\n')) == []
+        assert list(IterToDos('# TODO: fix\ndef test_foo(): pass\n')) == []
+        
+        
+    def test_class_todo(self):
+        assert list(IterToDos('@ToDo((2013, 9, 1))\nclass TestFoo: pass')) == [{
+            'kind': 'todo',
+            'function_name': 'TestFoo',
+            'date': datetime.datetime(2013, 9, 1),
+            'days': None,
+            'lineno': 1,
+            'text': None,
+        }]
+        
+        
+    MARKERS_SOURCE = '''
+import pytest, unittest
+from todo import markers
+
+@markers.ToDo((2013, 9, 1), days=2 * 3)
+def test_foo():
+    # TODO: fix this
+    pass
+
+@pytest.mark.skip(reason="broken")
+def test_skip(): pass
+
+@pytest.mark.xfail(reason="flaky")
+def test_xfail(): pass
+
+class TestBar(unittest.TestCase):
+    @unittest.skipIf(True, "no db")
+    def test_skip_if(self): pass
+
+# FIXME module level
+@ToDo(__import__('os').getcwd())
+def test_unsafe(): pass
+'''
+    
+    def test_markers(self):
+        extractor = ToDoExtractor(MARKER_KINDS)
+        todos = list(IterToDos(self.MARKERS_SOURCE, extractor=extractor))
+        assert [(x['kind'], x['function_name'], x['lineno'], x['text']) for x in todos] == [
+            ('todo', 'test_foo', 5, None),
+            ('comment', 'test_foo', 7, 'fix this'),
+            ('skip', 'test_skip', 10, 'broken'),
+            ('xfail', 'test_xfail', 13, 'flaky'),
+            ('skip', 'test_skip_if', 17, 'no db'),
+            ('comment', None, 20, 'module level'),
+            ('todo', 'test_unsafe', 21, None),
+        ]
+        assert todos[0]['date'] == datetime.datetime(2013, 9, 1)
+        assert todos[0]['days'] == 6
+        # arguments are evaluated without running any code
+        assert todos[-1]['date'] is None
+        
+        extractor = ToDoExtractor(['skip'])
+        todos = list(IterToDos(self.MARKERS_SOURCE, extractor=extractor))
+        assert [x['function_name'] for x in todos] == ['test_skip', 'test_skip_if']
+        
+        
+    def test_extractor(self):
+        with pytest.raises(ValueError):
+            ToDoExtractor(['todo', 'unknown'])
+            
+        extractor = ToDoExtractor.from_config('xfail, todo', '*_test.py, tests/*.py')
+        assert extractor.cache_key == 'todo,xfail'
+        assert extractor.matches_filename('sub/foo_test.py')
+        assert extractor.matches_filename('tests/foo.py')
+        assert not extractor.matches_filename('sub/tests/foo.py')
+        assert not extractor.matches_filename('test_foo.py')
+        
+        default = ToDoExtractor()
+        assert default.cache_key == 'todo'
+        assert default.matches_filename('sub/test_foo.py')
+        assert default.scan_key != extractor.scan_key
+        assert default.scan_key != ToDoExtractor(file_patterns=['*_test.py']).scan_key
+        
+        
+    def test_invalid_days(self):
+        def days(text):
+            todo, = IterToDos('@ToDo((2013, 9, 1), days=%s)\ndef test_foo(): pass\n' % text)
+            return todo['days']
+        assert days('5') == 5
+        assert days('5.0') == 5
+        assert days('-2') == -2
+        for text in ['1.5', '"5"', 'True', '10 ** 9', '1e300', '[]']:
+            assert days(text) is None
+        
+        
+    def test_safe_eval(self):
+        assert _SafeEval(ast.parse('((2013, 9, 1), -2 * 3)', mode='eval').body) == \
+            ((2013, 9, 1), -6)
+        for source in ['open("x")', 'x', '"a" * 1000', '[1][0]']:
+            with pytest.raises(ValueError):
+                _SafeEval(ast.parse(source, mode='eval').body)
+        
+        
+#===================================================================================================
+# TestStashServerRequests
+#===================================================================================================
+class TestStashServerRequests(object):
+    '''
+    Tests StashServer's handling of sessions and retries, without a live server.
+    '''
+    
+    class FakeResponse(object):
+        
+        def __init__(self, status_code, text='', headers=None, data=None):
+            self.status_code = status_code
+            self.text = text
+            self.content = text
+            self.headers = headers or {}
+            self.data = data
+            
+        def json(self):
+            return self.data
+    
+    
+    class FakeSession(object):
+        
+        def __init__(self, responses):
+            self.responses = responses
+            
+        def get(self, url, params, timeout):
+            result = self.responses.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        
+        
+    class PagedSession(object):
+        '''
+        Serves `count` values paged by offset, with at most `max_limit` values per page.
+        '''
+        
+        def __init__(self, count, max_limit):
+            self.count = count
+            self.max_limit = max_limit
+            self.starts = []
+            
+        def get(self, url, params, timeout):
+            start = params.get('start', 0)
+            self.starts.append(start)
+            end = start + min(params['limit'], self.max_limit)
+            data = {
+                'start': start,
+                'values': range(self.count)[start:end],
+                'isLastPage': end >= self.count,
+                'nextPageStart': end,
+            }
+            return TestStashServerRequests.FakeResponse(200, data=data)
+        
+        
+    def make_server(self, monkeypatch, responses, session=None, **kwargs):
+        if session is None:
+            session = self.FakeSession(responses)
+        monkeypatch.setattr(StashServer, '_create_session', lambda self: session)
+        return StashServer('http://stash', auth=None, backoff=0, **kwargs)
+    
+    
+    def test_retries(self, monkeypatch):
+        import requests
+        responses = [
+            requests.Timeout(),
+            self.FakeResponse(503),
+            self.FakeResponse(200, 'contents'),
+        ]
+        metrics = FetchMetrics()
+        server = self.make_server(monkeypatch, responses, retries=2, metrics=metrics)
+        assert server.get_file_contents('proj/repo', 'foo.py') == 'contents'
+        assert responses == []
+        
+        recorded = metrics.to_dict()
+        assert recorded['requests'] == [
+            {'endpoint': 'browse', 'status': None, 'count': 1},
+            {'endpoint': 'browse', 'status': 200, 'count': 1},
+            {'endpoint': 'browse', 'status': 503, 'count': 1},
+        ]
+        assert recorded['bytes'] == [{'endpoint': 'browse', 'bytes': len('contents')}]
+        
+        
+    def test_retries_exhausted(self, monkeypatch):
+        import requests
+        server = self.make_server(monkeypatch, [self.FakeResponse(500)] * 2, retries=1)
+        with pytest.raises(RuntimeError):
+            server.get_file_contents('proj/repo', 'foo.py')
+        
+        server = self.make_server(monkeypatch, [requests.ConnectionError()] * 2, retries=1)
+        with pytest.raises(requests.ConnectionError):
+            server.get_file_contents('proj/repo', 'foo.py')
+            
+        server = self.make_server(monkeypatch, [self.FakeResponse(404)], retries=1)
+        assert server.get_file_contents('proj/repo', 'foo.py') is None
+        
+        
+    def test_prefetch_pages(self, monkeypatch):
+        session = self.PagedSession(25, max_limit=10)
+        server = self.make_server(monkeypatch, None, session=session, prefetch_pages=2)
+        values = server._iter_paged_requests('http://stash/files', {'limit': 10})
+        
+        assert next(values) == 0
+        # following pages are requested before the first is consumed
+        deadline = time.time() + 5
+        while len(session.starts) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        assert sorted(session.starts) == [0, 10, 20]
+        assert list(values) == range(1, 25)
+        
+        
+    def test_prefetch_pages_wrong_guess(self, monkeypatch):
+        # the server returns pages smaller than the limit requested
+        session = self.PagedSession(25, max_limit=5)
+        server = self.make_server(monkeypatch, None, session=session, prefetch_pages=3)
+        assert list(server._iter_paged_requests('http://stash/files', {'limit': 10})) == range(25)
+        assert set([0, 5, 10, 15, 20]).issubset(session.starts)
+        
+        
+    def test_retry_after(self, monkeypatch):
+        clock = FakeClock()
+        monkeypatch.setattr(time, 'time', clock.time)
+        monkeypatch.setattr(time, 'sleep', clock.sleep)
+        responses = [
+            self.FakeResponse(429, headers={'Retry-After': '7'}),
+            self.FakeResponse(503),
+            self.FakeResponse(200, 'contents'),
+        ]
+        server = self.make_server(monkeypatch, responses, retries=2, pool_size=4)
+        assert server.get_file_contents('proj/repo', 'foo.py') == 'contents'
+        assert clock.sleeps == [7.0, 0.0]
+        # halved only once: the second overload came too soon after the first
+        assert server._limiter.get_limit() == 2
+        
+        
+    def test_rate_limits(self, monkeypatch):
+        clock = FakeClock()
+        monkeypatch.setattr(time, 'time', clock.time)
+        monkeypatch.setattr(time, 'sleep', clock.sleep)
+        responses = [self.FakeResponse(200, 'contents')] * 3
+        server = self.make_server(monkeypatch, responses, rate_limits={'browse': 2})
+        for _ in xrange(3):
+            server.get_file_contents('proj/repo', 'foo.py')
+        assert clock.sleeps == [0.5]
+        
+        
+#===================================================================================================
+# FakeClock
+#===================================================================================================
+class FakeClock(object):
+    '''
+    Replaces time.time and time.sleep: sleeping advances the time immediately.
+    '''
+    
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+        
+        
+    def time(self):
+        return self.now
+    
+    
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+        
+        
+#===================================================================================================
+# TestTokenBucket
+#===================================================================================================
+class TestTokenBucket(object):
+    
+    def test_acquire(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2, burst=2, clock=clock.time, sleep=clock.sleep)
+        assert [bucket.acquire() for _ in xrange(4)] == [0, 0, 0.5, 0.5]
+        
+        # tokens accumulate up to the burst while idle
+        clock.now += 10
+        assert [bucket.acquire() for _ in xrange(3)] == [0, 0, 0.5]
+        
+        
+    def test_parse_rate_limits(self):
+        assert parse_rate_limits('') == {}
+        assert parse_rate_limits('browse=50, files=2.5') == {'browse': 50.0, 'files': 2.5}
+        
+        
+#===================================================================================================
+# TestAdaptiveLimiter
+#===================================================================================================
+class TestAdaptiveLimiter(object):
+    
+    def test_aimd(self):
+        clock = FakeClock()
+        limiter = AdaptiveLimiter(8, latency_target=1.0, clock=clock.time)
+        assert limiter.get_limit() == 8
+        
+        limiter.acquire()
+        limiter.release(0.1, overloaded=True)
+        assert limiter.get_limit() == 4
+        
+        # slow responses count as overload, but not right after a decrease
+        limiter.acquire()
+        limiter.release(3.0)
+        assert limiter.get_limit() == 4
+        clock.now += 1
+        limiter.acquire()
+        limiter.release(3.0)
+        assert limiter.get_limit() == 2
+        
+        # grows by about one for each `limit` fast responses
+        for _ in xrange(3):
+            limiter.acquire()
+            limiter.release(0.1)
+        assert limiter.get_limit() == 3
+        
+        for _ in xrange(10):
+            clock.now += 1
+            limiter.acquire()
+            limiter.release(0.1, overloaded=True)
+        assert limiter.get_limit() == 1
+        
+        
+    def test_concurrency(self):
+        limiter = AdaptiveLimiter(2)
+        limiter.acquire()
+        limiter.acquire()
+        
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(limiter.acquire()))
+        thread.start()
+        thread.join(0.1)
+        assert acquired == []
+        
+        limiter.release(0.1)
+        thread.join(5)
+        assert len(acquired) == 1
+        
+        
+#===================================================================================================
+# TestGitMirrorSource
+#===================================================================================================
+class TestGitMirrorSource(object):
+    '''
+    Tests GitMirrorSource using a throwaway local repository as the remote.
+    '''
+    
+    @pytest.fixture
+    def remote(self, tmpdir):
+        remote = tmpdir.join('remote', 'proj', 'repo')
+        remote.ensure(dir=True)
+        self.git(remote, 'init', '--quiet')
+        return remote
+    
+    
+    def git(self, work_dir, *args):
+        env = dict(os.environ, GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@example.com',
+            GIT_COMMITTER_NAME='test', GIT_COMMITTER_EMAIL='test@example.com')
+        return subprocess.check_output(['git'] + list(args), cwd=str(work_dir), env=env).strip()
+    
+    
+    def commit(self, remote, files):
+        for filename, contents in files.iteritems():
+            if contents is None:
+                self.git(remote, 'rm', '--quiet', filename)
+            else:
+                remote.join(filename).write(contents, ensure=True)
+                self.git(remote, 'add', filename)
+        self.git(remote, 'commit', '--quiet', '-m', 'commit')
+        return self.git(remote, 'rev-parse', 'HEAD')
+    
+    
+    def test_source(self, tmpdir, remote):
+        first = self.commit(remote, {'README.md': 'readme', 'foo/test_foo.py': 'foo = 1\n'})
+        
+        clone_url_format = str(tmpdir.join('remote')) + '/{project}/{slug}'
+        source = GitMirrorSource(str(tmpdir.join('mirrors')), clone_url_format, 
+            auth=('user', 'secret'))
+        source.sync_repo('proj/repo')
+        assert list(source.iter_repos('proj')) == ['repo']
+        
+        branches = source.get_branches('proj/repo')
+        assert branches.values() == [first]
+        assert set(source.iter_file_names('proj/repo', at=first)) == set(
+            ['README.md', 'foo/test_foo.py'])
+        assert source.get_file_contents('proj/repo', 'foo/test_foo.py', at=first) == 'foo = 1\n'
+        
+        # new commits are fetched by sync_repo
+        second = self.commit(remote, {'foo/test_foo.py': None, 'test_bar.py': 'bar = 1\n'})
+        assert source.get_branches('proj/repo') == branches
+        
+        # the heads of the remote are checked without updating the mirror
+        assert source.get_project_branches('proj', ['repo', 'other']) == {
+            'repo': {branches.keys()[0]: second},
+            'other': None,
+        }
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            assert source.get_project_branches('proj', ['repo', 'other'], executor) == {
+                'repo': {branches.keys()[0]: second},
+                'other': None,
+            }
+        assert source.get_branches('proj/repo') == branches
+        source.sync_repo('proj/repo')
+        assert source.get_branches('proj/repo').values() == [second]
+        
+        assert set(source.iter_file_names('proj/repo', since=first, until=second)) == set(
+            ['foo/test_foo.py', 'test_bar.py'])
+        assert set(source.iter_file_names('proj/repo', until=first)) == set(
+            ['README.md', 'foo/test_foo.py'])
+        
+        contents = source.iter_files_contents('proj/repo',
+            ['foo/test_foo.py', 'test_bar.py', 'README.md', 'foo'], second, executor=None)
+        assert list(contents) == [None, 'bar = 1\n', 'readme', None]
+        
+        # names with spaces, and reads stopped before the end
+        fourth = self.commit(remote, dict(
+            ('test %d.py' % i, 'x = %d\n' % i * 10000) for i in xrange(20)))
+        source.sync_repo('proj/repo')
+        contents = source.iter_files_contents('proj/repo',
+            ['test 1.py', 'missing file.py', 'test 2.py'], fourth, executor=None)
+        assert list(contents) == ['x = 1\n' * 10000, None, 'x = 2\n' * 10000]
+        contents = source.iter_files_contents('proj/repo',
+            ['test %d.py' % i for i in xrange(20)] * 10, fourth, executor=None)
+        assert next(contents) == 'x = 0\n' * 10000
+        contents.close()
+        
+        # only files changed in place have hunks
+        third = self.commit(remote, {'test_bar.py': 'bar = 1\nbaz = 2\n', 'README.md': None})
+        source.sync_repo('proj/repo')
+        assert source.get_diff_hunks('proj/repo', first, second) == {}
+        assert source.get_diff_hunks('proj/repo', second, third) == {
+            'test_bar.py': [(1, 1, [(' ', 'bar = 1'), ('+', 'baz = 2')])],
+        }
+        
+        
+    def test_remote_env(self, tmpdir, monkeypatch):
+        monkeypatch.setenv('GIT_CONFIG_COUNT', '1')
+        env = GitMirrorSource(str(tmpdir), auth=('user', 'secret'))._get_remote_env()
+        assert env['GIT_TERMINAL_PROMPT'] == '0'
+        # settings already given through the environment are kept
+        assert env['GIT_CONFIG_COUNT'] == '2'
+        assert env['GIT_CONFIG_KEY_1'] == 'http.extraHeader'
+        assert env['GIT_CONFIG_VALUE_1'] == 'Authorization: Basic dXNlcjpzZWNyZXQ='
+        
+        env = GitMirrorSource(str(tmpdir))._get_remote_env()
+        assert env['GIT_TERMINAL_PROMPT'] == '0'
+        assert 'GIT_CONFIG_KEY_1' not in env
+        
+        
+    def test_cat_file_failure(self, tmpdir):
+        '''
+        A cat-file process exiting early is reported, instead of failing to parse its output.
+        '''
+        source = GitMirrorSource(str(tmpdir))
+        contents = source.iter_files_contents('proj/missing', ['test_foo.py'], None, 
+            executor=None)
+        with pytest.raises(RuntimeError) as error:
+            list(contents)
+        assert 'HEAD:test_foo.py from proj/missing' in str(error.value)
+        
+        
+#===================================================================================================
+# TestUpdateQueue
+#===================================================================================================
+class TestUpdateQueue(object):
+    
+    def wait_for(self, condition, timeout=5.0):
+        deadline = time.time() + timeout
+        while not condition():
+            assert time.time() < deadline, 'timeout'
+            time.sleep(0.01)
+            
+    
+    def test_coalesce(self):
+        fetched = []
+        queue = UpdateQueue(fetched.append, coalesce_delay=0.2)
+        for _ in xrange(5):
+            queue.push('proj/repo1')
+        queue.push('proj/repo2')
+        assert queue.get_pending() == ['proj/repo1', 'proj/repo2']
+        
+        self.wait_for(lambda: len(fetched) == 2)
+        time.sleep(0.3)
+        assert fetched == ['proj/repo1', 'proj/repo2']
+        assert queue.get_pending() == []
+        
+        
+    def test_push_while_fetching(self):
+        fetched = []
+        started = threading.Event()
+        release = threading.Event()
+        def fetch_function(repo_name):
+            started.set()
+            release.wait()
+            fetched.append(repo_name)
+            
+        queue = UpdateQueue(fetch_function, coalesce_delay=0)
+        queue.push('proj/repo1')
+        started.wait()
+        queue.push('proj/repo1')
+        assert queue.get_pending() == ['proj/repo1']
+        release.set()
+        
+        self.wait_for(lambda: len(fetched) == 2)
+        assert fetched == ['proj/repo1', 'proj/repo1']
+        
+        
+    def test_failure(self, caplog):
+        '''
+        A failed fetch is logged, and the queue goes on with the next repository.
+        '''
+        fetched = []
+        def fetch_function(repo_name):
+            if repo_name == 'proj/repo1':
+                raise RuntimeError('boom')
+            fetched.append(repo_name)
+            
+        queue = UpdateQueue(fetch_function, coalesce_delay=0)
+        queue.push('proj/repo1')
+        queue.push('proj/repo2')
+        self.wait_for(lambda: fetched == ['proj/repo2'] and 'proj/repo1' in caplog.text)
+        assert 'Fetch of proj/repo1 failed' in caplog.text
+        assert 'RuntimeError: boom' in caplog.text
+
+
+#===================================================================================================
+# TestDrainFetchQueue
+#===================================================================================================
+class QueueStorage(object):
+    '''
+    Implements the queue of a fetch_all run as MongoStorage does, in memory.
+    '''
+
+    def __init__(self, repos):
+        self.states = dict((x, {'state': 'queued', 'worker': None}) for x in repos)
+        self.renewals = 0
+        self.lock = threading.Lock()
+
+
+    def claim_repo(self, run_id, worker, lease_seconds, max_attempts):
+        with self.lock:
+            for repo_name, state in sorted(self.states.iteritems()):
+                if state['state'] == 'queued':
+                    state.update(state='running', worker=worker)
+                    return repo_name
+        return None
+
+
+    def renew_repo_lease(self, run_id, repo_name, worker, lease_seconds):
+        with self.lock:
+            self.renewals += 1
+            return self.states[repo_name]['worker'] == worker
+
+
+    def set_repo_state(self, run_id, repo_name, state, error=None, worker=None):
+        with self.lock:
+            if self.states[repo_name]['worker'] != worker:
+                return False
+            self.states[repo_name].update(state=state, error=error)
+            return True
+
+
+    def count_unfinished_repos(self, run_id):
+        with self.lock:
+            return sum(1 for x in self.states.itervalues() if x['state'] in ('queued', 'running'))
+
+
+class TestDrainFetchQueue(object):
+
+    @pytest.fixture(autouse=True)
+    def short_lease(self, monkeypatch):
+        import update
+        monkeypatch.setattr(update, 'FETCH_LEASE_SECONDS', 0.03)
+        monkeypatch.setattr(update, 'FETCH_POLL_SECONDS', 0.01)
+
+
+    def test_drain(self):
+        storage = QueueStorage(['proj/repo%d' % i for i in xrange(10)])
+        fetched = []
+        def fetch_repo(repo_name, cancel):
+            if repo_name == 'proj/repo3':
+                raise RuntimeError('boom')
+            time.sleep(0.01)
+            fetched.append(repo_name)
+        finished = []
+
+        workers = [
+            threading.Thread(target=drain_fetch_queue,
+                args=(storage, 'run', make_worker_id(i), fetch_repo,
+                    lambda *args: finished.append(args)))
+            for i in xrange(3)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(5)
+
+        assert sorted(fetched) == ['proj/repo%d' % i for i in xrange(10) if i != 3]
+        assert sorted(finished)[3] == ('proj/repo3', 'failed')
+        assert len(finished) == 10
+        assert storage.states['proj/repo3']['error'] == 'boom'
+        assert len(set(x['worker'] for x in storage.states.itervalues())) == 3
+
+
+    def test_lease(self):
+        '''
+        Leases are renewed while fetching; a worker that lost its lease cancels its fetch and 
+        doesn't set the state of the repository, left to the worker that claimed it next.
+        '''
+        storage = QueueStorage(['proj/repo1'])
+        cancelled = []
+        def fetch_repo(repo_name, cancel):
+            time.sleep(0.1)
+            assert not cancel.is_set()
+            storage.states[repo_name].update(worker='other', state='failed')
+            cancelled.append(cancel.wait(1.0))
+        finished = []
+        drain_fetch_queue(storage, 'run', 'worker', fetch_repo,
+            lambda *args: finished.append(args))
+        assert storage.renewals >= 2
+        assert cancelled == [True]
+        assert finished == []
+        assert storage.states['proj/repo1']['state'] == 'failed'
+
+
+    def test_wait_for_other_workers(self):
+        '''
+        Workers with nothing to claim wait until repositories running elsewhere finish.
+        '''
+        storage = QueueStorage(['proj/repo1'])
+        storage.states['proj/repo1'].update(state='running', worker='other')
+        def finish():
+            time.sleep(0.05)
+            storage.set_repo_state('run', 'proj/repo1', 'done', worker='other')
+        thread = threading.Thread(target=finish)
+        thread.start()
+        drain_fetch_queue(storage, 'run', 'worker', lambda repo_name, cancel: None)
+        assert storage.states['proj/repo1']['state'] == 'done'
+        thread.join()
+
+
+#===================================================================================================
+# MemoryStash
+#===================================================================================================
+class MemoryStash(RepoSource):
+    '''
+    Stash server replacement serving files from a dict, used to test fetch() without a live server.
+    '''
+    
+    def __init__(self, files, master='1' * 40, delay=0.0):
+        self.files = files
+        self.master = master
+        self.branches = {}  # name => head, besides master
+        self.commits = {}  # head => files, for heads other than master
+        self.delay = delay
+        self.active = 0
+        self.max_active = 0
+        self.downloaded = []
+        self.diffs = 0
+        self.fail_on = None
+        self._lock = threading.Lock()
+        
+        
+    def get_branches(self, repo_name):
+        result = dict(('refs/heads/' + x, y) for x, y in self.branches.iteritems())
+        result['refs/heads/master'] = self.master
+        return result
+    
+    
+    def get_files(self, at):
+        return self.commits.get(at, self.files)
+    
+    
+    def iter_file_names(self, repo_name, since=None, until=None, at=None):
+        if since is not None:
+            old_files = self.get_files(since)
+            new_files = self.get_files(until)
+            names = set(old_files) | set(new_files)
+            return iter(sorted(x for x in names if old_files.get(x) != new_files.get(x)))
+        return iter(sorted(self.get_files(at)))
+    
+    
+    def get_diff_hunks(self, repo_name, since, until):
+        self.diffs += 1
+        old_files, new_files = self.get_files(since), self.get_files(until)
+        return dict(
+            (x, make_diff_hunks(old_files[x], new_files[x])) 
+            for x in set(old_files) & set(new_files) if old_files[x] != new_files[x]
+        )
+    
+    
+    def get_file_contents(self, repo_name, filename, at=None):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.delay)
+            if filename == self.fail_on:
+                raise RuntimeError('failed to download %s' % filename)
+            self.downloaded.append(filename)
+            return self.get_files(at).get(filename)
+        finally:
+            with self._lock:
+                self.active -= 1
+        
+        
+#===================================================================================================
+# MemoryStorage
+#===================================================================================================
+class MemoryStorage(object):
+    '''
+    Records the calls fetch() and schedule_repos() make into MongoStorage.
+    '''
+    
+    def __init__(self):
+        self.updates = []
+        self.todos = {}
+        self.hashes = {}
+        self.checkpoints = {}
+        self.parse_cache = {}
+        self.schedules = {}
+        self.file_todos = {}
+        # hashes set directly by tests were fetched with the default extractor
+        self.scan_keys = collections.defaultdict(lambda: ToDoExtractor().scan_key)
+        self.locks = {}  # repo name => owner; leases never expire
+        self._locks_lock = threading.Lock()
+        
+        
+    def get_cached_todos(self, blob_ids, extractor_key=''):
+        return dict(
+            (x, self.parse_cache[x, extractor_key]) for x in blob_ids 
+            if (x, extractor_key) in self.parse_cache
+        )
+    
+    
+    def cache_todos(self, todos_by_blob_id, extractor_key=''):
+        for blob_id, todos in todos_by_blob_id.iteritems():
+            self.parse_cache[blob_id, extractor_key] = todos
+        
+        
+    def get_last_hash(self, repo_name, branch='master', scan_key=None):
+        if scan_key is None or self.scan_keys[(repo_name, branch)] == scan_key:
+            return self.hashes.get((repo_name, branch))
+        return None
+    
+    
+    def update_repo_todos(self, repo_name, todos_by_filename, hash_value=None, checkpoint=None,
+                          branch='master', scan_key=None):
+        for filename, todos in todos_by_filename:
+            function_names = [x['function_name'] for x in todos]
+            self.updates.append((repo_name, filename, function_names))
+            self.file_todos[(repo_name, branch, filename)] = list(todos)
+            if todos:
+                self.todos[(repo_name, branch, filename)] = function_names
+            else:
+                self.todos.pop((repo_name, branch, filename), None)
+        if hash_value is not None:
+            self.hashes[(repo_name, branch)] = hash_value
+            if scan_key is not None:
+                self.scan_keys[(repo_name, branch)] = scan_key
+            self.checkpoints.pop((repo_name, branch), None)
+        elif checkpoint is not None:
+            self.checkpoints[(repo_name, branch)] = checkpoint
+            
+            
+    def get_checkpoint(self, repo_name, branch='master'):
+        return self.checkpoints.get((repo_name, branch))
+    
+    
+    def get_file_todos(self, repo_name, filenames, branch='master'):
+        return dict((x, self.file_todos.get((repo_name, branch, x), [])) for x in filenames)
+    
+    
+    def copy_branch_todos(self, repo_name, from_branch, to_branch, hash_value, scan_key=None):
+        for (repo, branch, filename), function_names in self.todos.items():
+            if (repo, branch) == (repo_name, from_branch):
+                self.todos[(repo, to_branch, filename)] = function_names
+        for (repo, branch, filename), todos in self.file_todos.items():
+            if (repo, branch) == (repo_name, from_branch):
+                self.file_todos[(repo, to_branch, filename)] = todos
+        self.hashes[(repo_name, to_branch)] = hash_value
+        if scan_key is not None:
+            self.scan_keys[(repo_name, to_branch)] = scan_key
+        
+        
+    def drop_branch_todos(self, repo_name, branch):
+        for key in self.todos.keys():
+            if key[:2] == (repo_name, branch):
+                del self.todos[key]
+        for key in self.file_todos.keys():
+            if key[:2] == (repo_name, branch):
+                del self.file_todos[key]
+        
+        
+    def get_last_hashes(self, repo_names, scan_key=None):
+        return dict(
+            (x, y) for x, y in self.hashes.iteritems() 
+            if x[0] in repo_names and x not in self.checkpoints and 
+                (scan_key is None or self.scan_keys[x] == scan_key)
+        )
+    
+    
+    def get_repo_schedules(self):
+        return dict((x, dict(y)) for x, y in self.schedules.iteritems())
+    
+    
+    def set_repo_schedule(self, repo_name, checked=None, changed=None, cost=None):
+        schedule = self.schedules.setdefault(repo_name, 
+            {'checked': None, 'changed': None, 'cost': 0.0})
+        for name, value in [('checked', checked), ('changed', changed), ('cost', cost)]:
+            if value is not None:
+                schedule[name] = value
+                
+                
+    def lock_repo(self, repo_name, owner, lease_seconds):
+        with self._locks_lock:
+            if self.locks.setdefault(repo_name, owner) != owner:
+                return False
+            return True
+        
+        
+    def renew_repo_lock(self, repo_name, owner, lease_seconds):
+        return self.locks.get(repo_name) == owner
+    
+    
+    def unlock_repo(self, repo_name, owner):
+        with self._locks_lock:
+            if self.locks.get(repo_name) == owner:
+                del self.locks[repo_name]
+        
+        
+#===================================================================================================
+# TestFetch
+#===================================================================================================
+class TestFetch(object):
+    
+    TODO_CONTENTS = '@ToDo((2013, 9, 1), days=5)\ndef test_%d():\n    pass\n'
+        
+    def test_concurrent_downloads_in_order(self):
+        files = dict(('test_%02d.py' % i, self.TODO_CONTENTS % i) for i in xrange(20))
+        files['README.md'] = 'readme'
+        stash = MemoryStash(files, delay=0.01)
+        storage = MemoryStorage()
+        
+        with futures.ThreadPoolExecutor(max_workers=4) as executor:
+            fetch('proj/repo', storage, stash, StringIO(), download_executor=executor)
+        
+        assert storage.updates == [
+            ('proj/repo', 'test_%02d.py' % i, ['test_%d' % i]) for i in xrange(20)
+        ]
+        assert storage.hashes == {('proj/repo', 'master'): stash.master}
+        assert 1 < stash.max_active <= 4
+        
+        
+    def test_streamed_listing(self):
+        files = dict(('test_%d.py' % i, self.TODO_CONTENTS % i) for i in xrange(2))
+        stash = MemoryStash(files)
+        downloading = threading.Event()
+        original_get_file_contents = stash.get_file_contents
+        def get_file_contents(repo_name, filename, at=None):
+            downloading.set()
+            return original_get_file_contents(repo_name, filename, at)
+        def iter_file_names(repo_name, since=None, until=None, at=None):
+            yield 'test_0.py'
+            # the first file is downloaded while the rest is listed
+            assert downloading.wait(5)
+            yield 'test_1.py'
+        stash.get_file_contents = get_file_contents
+        stash.iter_file_names = iter_file_names
+        
+        storage = MemoryStorage()
+        fetch('proj/repo', storage, stash, StringIO())
+        assert storage.updates == [
+            ('proj/repo', 'test_0.py', ['test_0']), 
+            ('proj/repo', 'test_1.py', ['test_1']),
+        ]
+        
+        
+    def test_progress(self):
+        files = {
+            'test_1.py': self.TODO_CONTENTS % 1,
+            'test_2.py': 'def test_2():\n    pass\n',
+            'README.md': 'readme',
+        }
+        events = []
+        fetch('proj/repo', MemoryStorage(), MemoryStash(files), StringIO(), 
+            progress=events.append)
+        
+        assert events[:2] == [
+            {'type': 'file', 'repo': 'proj/repo', 'branch': 'master', 'filename': 'test_1.py', 
+                'todos': 1, 'done': 1},
+            {'type': 'file', 'repo': 'proj/repo', 'branch': 'master', 'filename': 'test_2.py', 
+                'todos': 0, 'done': 2},
+        ]
+        summary = dict(events[2])
+        assert summary.pop('seconds') >= 0
+        assert summary == {'type': 'branch', 'repo': 'proj/repo', 'branch': 'master', 
+            'changed': 3, 'test': 2, 'todos': 1}
+        assert len(events) == 3
+        
+        
+    def test_line_stream(self):
+        stream = StringIO()
+        lock = threading.Lock()
+        stream_1 = _LineStream(stream, lock, prefix='[1] ')
+        stream_2 = _LineStream(stream, lock, prefix='[2] ')
+        stream_1.write('T.')
+        print >> stream_2, 'Fetching'
+        stream_1.write('.\nChanged')
+        stream_1.flush()
+        assert stream.getvalue() == '[2] Fetching\n[1] T..\n[1] Changed\n'
+        
+        
+    def test_parse_executor(self):
+        files = dict(('test_%02d.py' % i, self.TODO_CONTENTS % i) for i in xrange(50))
+        storage = MemoryStorage()
+        with futures.ProcessPoolExecutor(max_workers=2) as executor:
+            fetch('proj/repo', storage, MemoryStash(files), StringIO(), parse_executor=executor)
+        
+        assert storage.updates == [
+            ('proj/repo', 'test_%02d.py' % i, ['test_%d' % i]) for i in xrange(50)
+        ]
+        
+        
+    def test_resume(self, monkeypatch):
+        import update
+        monkeypatch.setattr(update, 'FETCH_CHUNK_SIZE', 5)
+        
+        files = dict(('test_%02d.py' % i, self.TODO_CONTENTS % i) for i in xrange(20))
+        stash = MemoryStash(files)
+        stash.fail_on = 'test_12.py'
+        storage = MemoryStorage()
+        with pytest.raises(RuntimeError):
+            fetch('proj/repo', storage, stash, StringIO())
+        
+        # the first two chunks were stored
+        assert len(storage.updates) == 10
+        assert storage.get_last_hash('proj/repo') is None
+        assert storage.get_checkpoint('proj/repo') == {
+            'since': None, 
+            'until': stash.master, 
+            'count': 10,
+            'scan_key': ToDoExtractor().scan_key,
+        }
+        
+        # resumes from the checkpoint, even if master moved meanwhile
+        stash.fail_on = None
+        stash.downloaded = []
+        old_master = stash.master
+        stash.master = '2' * 40
+        fetch('proj/repo', storage, stash, StringIO())
+        assert sorted(stash.downloaded) == ['test_%02d.py' % i for i in xrange(10, 20)]
+        assert storage.updates == [
+            ('proj/repo', 'test_%02d.py' % i, ['test_%d' % i]) for i in xrange(20)
+        ]
+        assert storage.get_last_hash('proj/repo') == old_master
+        assert storage.get_checkpoint('proj/repo') is None
+        
+        
+    def test_cancel(self, monkeypatch):
+        '''
+        A cancelled fetch stops between chunks, leaving the hash unset so the repository is fetched
+        again by whoever claims it next.
+        '''
+        import update
+        monkeypatch.setattr(update, 'FETCH_CHUNK_SIZE', 5)
+        
+        files = dict(('test_%02d.py' % i, self.TODO_CONTENTS % i) for i in xrange(20))
+        stash = MemoryStash(files)
+        storage = MemoryStorage()
+        cancel = threading.Event()
+        original_update_repo_todos = storage.update_repo_todos
+        def update_repo_todos(*args, **kwargs):
+            original_update_repo_todos(*args, **kwargs)
+            cancel.set()
+        storage.update_repo_todos = update_repo_todos
+        
+        with pytest.raises(FetchCancelled):
+            fetch('proj/repo', storage, stash, StringIO(), cancel=cancel)
+        assert len(storage.updates) == 5
+        assert storage.get_last_hash('proj/repo') is None
+        assert storage.locks == {}
+        
+        
+    def test_lock(self, monkeypatch):
+        '''
+        Fetches of a repository locked by another fetch wait for its lock to be released.
+        '''
+        import update
+        monkeypatch.setattr(update, 'REPO_LOCK_POLL_SECONDS', 0.01)
+        stash = MemoryStash({'test_1.py': self.TODO_CONTENTS % 1})
+        storage = MemoryStorage()
+        storage.locks['proj/repo'] = 'other'
+        
+        fetcher = threading.Thread(target=fetch, args=('proj/repo', storage, stash, StringIO()))
+        fetcher.start()
+        time.sleep(0.1)
+        assert stash.downloaded == []
+        storage.unlock_repo('proj/repo', 'other')
+        fetcher.join(5)
+        assert stash.downloaded == ['test_1.py']
+        assert storage.get_last_hash('proj/repo') == stash.master
+        assert storage.locks == {}
+        
+        # a cancelled fetch stops waiting
+        storage.locks['proj/repo'] = 'other'
+        cancel = threading.Event()
+        cancel.set()
+        with pytest.raises(FetchCancelled):
+            fetch('proj/repo', storage, stash, StringIO(), cancel=cancel)
+        assert storage.locks == {'proj/repo': 'other'}
+            
+            
+    def test_lock_lost(self, monkeypatch):
+        '''
+        A fetch whose lock is lost, since it couldn't be renewed in time, is cancelled.
+        '''
+        import update
+        monkeypatch.setattr(update, 'FETCH_CHUNK_SIZE', 5)
+        monkeypatch.setattr(update, 'REPO_LOCK_SECONDS', 0.03)
+        
+        files = dict(('test_%02d.py' % i, self.TODO_CONTENTS % i) for i in xrange(20))
+        storage = MemoryStorage()
+        original_update_repo_todos = storage.update_repo_todos
+        def update_repo_todos(*args, **kwargs):
+            original_update_repo_todos(*args, **kwargs)
+            storage.locks['proj/repo'] = 'other'
+            time.sleep(0.1)
+        storage.update_repo_todos = update_repo_todos
+        
+        with pytest.raises(FetchCancelled):
+            fetch('proj/repo', storage, MemoryStash(files), StringIO())
+        assert len(storage.updates) == 5
+        assert storage.locks == {'proj/repo': 'other'}
+        
+        
+    def test_shift(self):
+        '''
+        Files whose changes can't affect their markers aren't downloaded again.
+        '''
+        contents = '\n'.join([
+            'def setup_module():',
+            '    value = 1',
+            '',
+            '@ToDo((2013, 9, 1), days=5)',
+            'def test_%d():',
+            '    pass',
+            '',
+        ])
+        files = dict(('test_%d.py' % i, contents % i) for i in xrange(3))
+        stash = MemoryStash(files)
+        storage = MemoryStorage()
+        fetch('proj/repo', storage, stash, StringIO())
+        assert stash.diffs == 0
+        
+        stash.downloaded = []
+        stash.commits[stash.master] = dict(files)
+        stash.master = '2' * 40
+        files['test_0.py'] = files['test_0.py'].replace('value = 1', 'value = 2')
+        files['test_1.py'] = files['test_1.py'].replace('value = 1', 'value = 1\n    other = 2')
+        files['test_2.py'] = files['test_2.py'].replace('days=5', 'days=10')
+        stream = StringIO()
+        fetch('proj/repo', storage, stash, stream)
+        
+        assert stash.diffs == 1
+        assert stash.downloaded == ['test_2.py']
+        assert [x[1] for x in storage.updates[3:]] == ['test_1.py', 'test_2.py']
+        todos = storage.get_file_todos('proj/repo', sorted(files))
+        assert [(x['lineno'], x['days']) for y in sorted(files) for x in todos[y]] == [
+            (4, 5), (5, 5), (4, 10)
+        ]
+        assert 'Test Files Not Downloaded: 2' in stream.getvalue()
+        assert storage.get_last_hash('proj/repo') == stash.master
+        
+        
+    @pytest.mark.parametrize('error', [
+        RuntimeError('diff failed'), 
+        requests.ConnectionError('connection reset'), 
+        ValueError('No JSON object could be decoded'),
+    ])
+    def test_shift_no_diff(self, error):
+        '''
+        Changed files are downloaded again when the diff can't be obtained.
+        '''
+        files = {'test_1.py': self.TODO_CONTENTS % 1, 'test_2.py': self.TODO_CONTENTS % 2}
+        stash = MemoryStash(files)
+        storage = MemoryStorage()
+        fetch('proj/repo', storage, stash, StringIO())
+        
+        def get_diff_hunks(repo_name, since, until):
+            raise error
+        stash.get_diff_hunks = get_diff_hunks
+        stash.downloaded = []
+        stash.commits[stash.master] = dict(files)
+        stash.master = '2' * 40
+        files['test_1.py'] = files['test_1.py'].replace('test_1', 'test_3')
+        stream = StringIO()
+        fetch('proj/repo', storage, stash, stream)
+        
+        assert stash.downloaded == ['test_1.py']
+        assert 'Diff not available: %s' % error in stream.getvalue()
+        assert storage.get_last_hash('proj/repo') == stash.master
+        
+        
+    def test_parse_cache(self, monkeypatch):
+        import update
+        parsed = []
+        original_iter_todos = update.IterToDos
+        def IterToDos(contents, **kwargs):
+            parsed.append(contents)
+            return original_iter_todos(contents, **kwargs)
+        monkeypatch.setattr(update, 'IterToDos', IterToDos)
+        
+        files = {
+            'test_1.py': self.TODO_CONTENTS % 1,
+            'test_2.py': self.TODO_CONTENTS % 2,
+            'sub/test_1.py': self.TODO_CONTENTS % 1,
+        }
+        storage = MemoryStorage()
+        fetch('proj/repo1', storage, MemoryStash(files), StringIO())
+        assert sorted(parsed) == [self.TODO_CONTENTS % 1, self.TODO_CONTENTS % 2]
+        
+        # same contents in another repo are not parsed again
+        metrics = FetchMetrics()
+        fetch('proj/repo2', storage, MemoryStash(files), StringIO(), metrics=metrics)
+        assert len(parsed) == 2
+        assert metrics.to_dict()['cache'] == {'hits': 3, 'misses': 0}
+        assert set(metrics.get_stage_times('proj/repo2')) == \
+            set(['sync', 'branches', 'listing', 'download', 'parse', 'storage'])
+        assert sorted(storage.updates)[-3:] == [
+            ('proj/repo2', 'sub/test_1.py', ['test_1']),
+            ('proj/repo2', 'test_1.py', ['test_1']),
+            ('proj/repo2', 'test_2.py', ['test_2']),
+        ]
+
+
+    def test_extractor(self):
+        files = {
+            'test_1.py': self.TODO_CONTENTS % 1,
+            'foo_test.py': '@pytest.mark.skip(reason="broken")\ndef test_foo(): pass\n',
+            'bar_test.py': 'def test_bar():\n    # TODO: fix\n    pass\n',
+        }
+        storage = MemoryStorage()
+        fetch('proj/repo', storage, MemoryStash(files), StringIO())
+        assert storage.todos == {('proj/repo', 'master', 'test_1.py'): ['test_1']}
+
+        # another configuration scans all files again, dropping the todos of files not scanned
+        # anymore; todos parsed with the default markers are not reused from the cache
+        extractor = ToDoExtractor(['skip', 'comment'], ['*_test.py'])
+        stream = StringIO()
+        fetch('proj/repo', storage, MemoryStash(files), stream, extractor=extractor)
+        assert 'Fetching proj/repo ALL' in stream.getvalue()
+        assert storage.todos == {
+            ('proj/repo', 'master', 'foo_test.py'): ['test_foo'],
+            ('proj/repo', 'master', 'bar_test.py'): ['test_bar'],
+        }
+        stream = StringIO()
+        fetch('proj/repo', storage, MemoryStash(files), stream, extractor=extractor)
+        assert 'ToDos up-to-date' in stream.getvalue()
+
+
+    def test_known_branches(self):
+        '''
+        Branches already obtained (see schedule_repos) aren't obtained again.
+        '''
+        stash = MemoryStash({'test_1.py': self.TODO_CONTENTS % 1})
+        def get_branches(repo_name):
+            raise AssertionError('branches obtained again')
+        stash.get_branches = get_branches
+        storage = MemoryStorage()
+        fetch('proj/repo', storage, stash, StringIO(), branches={'refs/heads/master': '2' * 40})
+        assert storage.get_last_hash('proj/repo') == '2' * 40
+        
+        
+    def test_branches(self):
+        files = {
+            'test_1.py': self.TODO_CONTENTS % 1,
+            'test_2.py': self.TODO_CONTENTS % 2,
+        }
+        stash = MemoryStash(files)
+        release = '2' * 40
+        stash.branches = {'release/1.0': release, 'feature': '3' * 40}
+        stash.commits[release] = {
+            'test_1.py': self.TODO_CONTENTS % 1,
+            'test_3.py': self.TODO_CONTENTS % 3,
+        }
+        storage = MemoryStorage()
+        fetch('proj/repo', storage, stash, StringIO(), 
+            branch_rules=parse_branch_rules('*=master,release/*'))
+        
+        # master is fetched first; the release branch starts from its todos, so only the files
+        # that differ between both are downloaded. Files of each branch are downloaded
+        # concurrently, in any order
+        assert sorted(stash.downloaded[:2]) == ['test_1.py', 'test_2.py']
+        assert sorted(stash.downloaded[2:]) == ['test_2.py', 'test_3.py']
+        assert storage.todos == {
+            ('proj/repo', 'master', 'test_1.py'): ['test_1'],
+            ('proj/repo', 'master', 'test_2.py'): ['test_2'],
+            ('proj/repo', 'release/1.0', 'test_1.py'): ['test_1'],
+            ('proj/repo', 'release/1.0', 'test_3.py'): ['test_3'],
+        }
+        assert storage.get_last_hash('proj/repo', 'release/1.0') == release
+        assert storage.get_last_hash('proj/repo', 'feature') is None
+        
+        
+    def test_select_branches(self):
+        refs = ['refs/heads/master', 'refs/heads/release/1.0', 'refs/heads/dev', 'refs/tags/v1']
+        rules = parse_branch_rules('proj/repo1=dev,release/*; proj/*=master,release/*')
+        assert rules == [(['proj/repo1'], ['dev', 'release/*']), (['proj/*'], ['master', 'release/*'])]
+        
+        assert select_branches('proj/repo1', refs, rules) == ['dev', 'release/1.0']
+        assert select_branches('proj/repo2', refs, rules) == ['master', 'release/1.0']
+        assert select_branches('other/repo', refs, rules) == ['master']
+        assert select_branches('other/repo', refs) == ['master']
+        assert select_branches('other/repo', ['refs/heads/dev']) == []
+        assert parse_branch_rules('master,dev') == [(['*'], ['master', 'dev'])]
+        
+        
+    def test_gevent_engine(self):
+        pytest.importorskip('gevent')
+        with pytest.raises(RuntimeError):
+            check_engine('gevent')  # not monkey patched
+        with pytest.raises(RuntimeError):
+            check_engine('asyncio')
+        check_engine('threads')
+        
+        # hundreds of downloads in flight on greenlets
+        script = textwrap.dedent('''
+            from gevent import monkey
+            monkey.patch_all()
+            
+            from StringIO import StringIO
+            from test_update import MemoryStash, MemoryStorage
+            from update import check_engine, fetch
+            import futures
+            
+            check_engine('gevent')
+            files = dict(('test_%03d.py' % i, '') for i in xrange(400))
+            stash = MemoryStash(files, delay=0.2)
+            with futures.ThreadPoolExecutor(max_workers=200) as executor:
+                fetch('proj/repo', MemoryStorage(), stash, StringIO(), download_executor=executor)
+            print stash.max_active
+        ''')
+        output = subprocess.check_output([sys.executable, '-c', script], 
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        assert int(output) == 200
+        
+        
+    def test_compute_blob_id(self):
+        # same id as given by "git hash-object"
+        assert compute_blob_id('hello\n') == 'ce013625030ba8dba906f756967f9e9ca394464a'
+        assert compute_blob_id(u'hello\n') == 'ce013625030ba8dba906f756967f9e9ca394464a'
+        
+        
+#===================================================================================================
+# TestShiftToDos
+#===================================================================================================
+class TestShiftToDos(object):
+    
+    SOURCE = textwrap.dedent('''\
+        import os
+        
+        
+        class TestFoo(object):
+        
+            def setup_method(self, method):
+                self.value = 1
+                self.other = [1, 2]
+                
+            @ToDo((2013, 9, 1), 
+                  days=5)
+            def test_foo(self):
+                pass
+                
+            def test_bar(self):
+                pass
+        ''')
+    
+    def shift(self, old, new, extractor=None):
+        '''
+        Returns the todos of `old` shifted to `new`, checking they are the todos of `new` if the 
+        changes couldn't affect them.
+        '''
+        extractor = extractor or ToDoExtractor()
+        todos = shift_todos(extractor.extract(old), make_diff_hunks(old, new), extractor)
+        if todos is not None:
+            assert todos == extractor.extract(new)
+        return todos
+    
+    
+    def test_shift(self):
+        def replace(old, new):
+            assert old in self.SOURCE
+            return self.shift(self.SOURCE, self.SOURCE.replace(old, new))
+        
+        todos = ToDoExtractor().extract(self.SOURCE)
+        assert [x['lineno'] for x in todos] == [10]
+        assert replace('value = 1', 'value = 2') == todos
+        assert [x['lineno'] for x in replace('value = 1', 'value = 1\n        v = 0')] == [11]
+        assert [x['lineno'] for x in replace('\n        self.other = [1, 2]', '')] == [9]
+        assert [x['lineno'] for x in replace('import os', 'import os\n\nimport sys\n')] == [13]
+        # lines after the markers don't move them
+        source = self.SOURCE + 'x = 1\n' * 25
+        assert self.shift(source, source + 'y = 2\n') == todos
+        
+        # changes that could affect markers
+        assert replace('value = 1', 'value = (1,') is None
+        assert replace('value = 1', 'value = 1  # see ToDo') is None
+        assert replace('self.value = 1', 'ToDo = 1') is None
+        assert replace('self.value = 1', 'if self:') is None
+        assert replace('        self.value = 1', 'self.value = 1') is None
+        assert replace('        self.value = 1', '            self.value = 1') is None
+        assert replace('days=5)', 'days=6)') is None
+        assert replace('def test_bar(self):\n        pass', 'def test_bar(self):\n        a = 1') \
+            is None
+        
+        
+    def test_comments(self):
+        source = 'def test_foo():\n    # TODO: fix\n    a = 1\n' + 'b = 2\n' * 30
+        extractor = ToDoExtractor(['comment'])
+        assert self.shift(source, source.replace('a = 1', 'a = 2'), extractor) is None
+        assert self.shift(source, source + 'c = 3\n', extractor) == extractor.extract(source)
+        assert self.shift(source, source.replace('    a = 1', '    a = 1\n    # FIXME'), 
+            extractor) is None
+        # without comments, the same changes don't affect markers
+        assert self.shift(source, source.replace('a = 1', 'a = 2')) == []
+        
+        
+#===================================================================================================
+# TestScheduleRepos
+#===================================================================================================
+class TestScheduleRepos(object):
+    
+    class Stash(RepoSource):
+        
+        def __init__(self, heads, delay=0.0):
+            self.heads = heads
+            self.checked = []
+            self.delay = delay
+            self.active = 0
+            self.max_active = 0
+            self._lock = threading.Lock()
+            
+            
+        def get_branches(self, repo_name):
+            with self._lock:
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+            time.sleep(self.delay)
+            with self._lock:
+                self.active -= 1
+            self.checked.append(repo_name)
+            if self.heads[repo_name] is None:
+                raise RuntimeError('no such repository')
+            return {'refs/heads/master': self.heads[repo_name], 'refs/heads/dev': 'd' * 40}
+        
+        
+    def test_concurrent_checks(self):
+        '''
+        Repositories of a project are checked concurrently.
+        '''
+        stash = self.Stash(dict(('proj/repo%d' % i, '1' * 40) for i in xrange(8)), delay=0.05)
+        with futures.ThreadPoolExecutor(max_workers=4) as executor:
+            repos, _, _ = schedule_repos(MemoryStorage(), stash, sorted(stash.heads), executor, 
+                StringIO())
+        assert len(repos) == 8
+        assert stash.max_active == 4
+        
+        
+    def test_is_repo_due(self):
+        now = datetime.datetime(2013, 9, 10, 12, 0)
+        def schedule(checked_hours_ago, idle_hours):
+            checked = now - datetime.timedelta(hours=checked_hours_ago)
+            return {'checked': checked, 'changed': checked - datetime.timedelta(hours=idle_hours)}
+        
+        assert is_repo_due(None, now)
+        assert is_repo_due(schedule(0, 0), now)
+        assert is_repo_due(schedule(2, 10), now)
+        assert not is_repo_due(schedule(2, 30), now)
+        # repositories idle for long are still checked daily
+        assert not is_repo_due(schedule(23, 24 * 100), now)
+        assert is_repo_due(schedule(25, 24 * 100), now)
+        
+        
+    def test_schedule(self):
+        now = datetime.datetime(2013, 9, 10, 12, 0)
+        long_ago = now - datetime.timedelta(days=100)
+        old, new = '1' * 40, '2' * 40
+        stash = self.Stash({
+            'proj/unchanged': old, 
+            'proj/changed': new, 
+            'proj/new': old, 
+            'proj/cold': new, 
+            'other/broken': None,
+        })
+        storage = MemoryStorage()
+        for repo_name in ['proj/unchanged', 'proj/changed', 'proj/cold']:
+            storage.hashes[(repo_name, 'master')] = old
+        storage.set_repo_schedule('proj/unchanged', checked=long_ago, changed=long_ago)
+        storage.set_repo_schedule('proj/changed', checked=long_ago, changed=long_ago, cost=5.0)
+        storage.set_repo_schedule('other/broken', cost=1.0)
+        cold_checked = now - datetime.timedelta(hours=1)
+        storage.set_repo_schedule('proj/cold', checked=cold_checked, changed=long_ago)
+        
+        stream = StringIO()
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            repos, costs, branches = schedule_repos(storage, stash, sorted(stash.heads), executor,
+                stream, now=now)
+            
+        # changed repositories come costliest first; cold ones aren't even checked
+        assert repos == ['proj/changed', 'other/broken', 'proj/new']
+        assert costs == {'proj/changed': 5.0, 'other/broken': 1.0, 'proj/new': 0.0}
+        # the branches checked are kept for fetch
+        assert sorted(branches) == ['proj/changed', 'proj/new']
+        assert branches['proj/changed']['refs/heads/master'] == new
+        assert sorted(stash.checked) == ['other/broken', 'proj/changed', 'proj/new', 
+            'proj/unchanged']
+        assert stream.getvalue() == '=== Checked 4 of 5 repos: 3 changed ===\n'
+        
+        schedules = storage.get_repo_schedules()
+        assert schedules['proj/unchanged'] == {'checked': now, 'changed': long_ago, 'cost': 0.0}
+        assert schedules['proj/new'] == {'checked': now, 'changed': now, 'cost': 0.0}
+        assert schedules['proj/cold']['checked'] == cold_checked
+        
+        # branches selected besides master are checked too
+        storage.hashes[('proj/changed', 'master')] = new
+        storage.hashes[('proj/changed', 'dev')] = 'd' * 40
+        later = now + datetime.timedelta(days=2)
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            repos, _, _ = schedule_repos(storage, stash, ['proj/changed', 'proj/unchanged'], 
+                executor, stream, branch_rules=parse_branch_rules('proj/*=master,dev'), 
+                now=later)
+        assert repos == ['proj/unchanged']
+        
+        # branches fetched with another extractor configuration count as moved
+        checks = [
+            (later + datetime.timedelta(days=2), None, []),
+            (later + datetime.timedelta(days=4), ToDoExtractor(['todo', 'skip']), ['proj/changed']),
+        ]
+        for check_time, extractor, expected in checks:
+            with futures.ThreadPoolExecutor(max_workers=2) as executor:
+                repos, _, _ = schedule_repos(storage, stash, ['proj/changed'], executor, stream, 
+                    now=check_time, extractor=extractor)
+            assert repos == expected
+        
+        
 #===================================================================================================
 # main
 #===================================================================================================
@@ -1,29 +1,90 @@
 from StringIO import StringIO
-from ast import Expression
+from contextlib import contextmanager
+from metrics import FetchMetrics
 from pip.vcs.git import urlsplit
+import Queue
 import ast
+import base64
+import collections
 import datetime
+import email.utils
 import fnmatch
 import futures
+import hashlib
+import itertools
+import logging
 import optparse
 import os
 import pymongo
+import re
 import requests
+import socket
+import subprocess
 import sys
+import threading
 import time
+import tokenize
 
 
 #===================================================================================================
-# StashServer
+# branches
 #===================================================================================================
-class StashServer(object):
+DEFAULT_BRANCH = 'master'
+
+BRANCH_REF_PREFIX = 'refs/heads/'
+
+def parse_branch_rules(text):
+    '''
+    Parses the configuration of the branches scanned in each repository, given as rules separated
+    by ";". Each rule is "repos=branches", both comma separated lists of fnmatch patterns, for 
+    example "*=master;proj/repo=master,release/*". A rule without "=" applies to all repos. 
     
+    Returns a list of (repo_patterns, branch_patterns) tuples, for select_branches.
+    '''
+    result = []
+    for rule in text.split(';'):
+        rule = rule.strip()
+        if not rule:
+            continue
+        if '=' in rule:
+            repos, branches = rule.split('=', 1)
+        else:
+            repos, branches = '*', rule
+        repo_patterns = [x.strip() for x in repos.split(',') if x.strip()]
+        branch_patterns = [x.strip() for x in branches.split(',') if x.strip()]
+        result.append((repo_patterns, branch_patterns))
+    return result
+
+
+def select_branches(repo_name, branch_refs, branch_rules=None):
+    '''
+    Returns the names of the branches of a repository that should be scanned, given the branch 
+    refs of the repository (see RepoSource.get_branches) and the rules of parse_branch_rules. 
     
-    def __init__(self, base_url, auth):
-        self._base_url = base_url
-        self._auth = auth
-        
+    The first rule matching the repository is used; without rules, or if no rule matches, only 
+    DEFAULT_BRANCH is scanned. DEFAULT_BRANCH always comes first, so other branches can start 
+    from its todos (see fetch); the others are sorted by name.
+    '''
+    branch_patterns = [DEFAULT_BRANCH]
+    for repo_patterns, patterns in branch_rules or []:
+        if any(fnmatch.fnmatchcase(repo_name, x) for x in repo_patterns):
+            branch_patterns = patterns
+            break
         
+    names = [x[len(BRANCH_REF_PREFIX):] for x in branch_refs if x.startswith(BRANCH_REF_PREFIX)]
+    names = [x for x in names if any(fnmatch.fnmatchcase(x, y) for y in branch_patterns)]
+    return sorted(names, key=lambda x: (x != DEFAULT_BRANCH, x))
+
+
+#===================================================================================================
+# RepoSource
+#===================================================================================================
+class RepoSource(object):
+    '''
+    Interface of the sources of repositories scanned by fetch. Repositories are named 
+    "project/slug".
+    '''
+    
     @classmethod
     def split_repo_name(cls, repo_name):
         fields = repo_name.split('/')
@@ -35,6 +96,392 @@ class StashServer(object):
             slug = None
         
         return project, slug
+    
+    
+    def iter_repos(self, project_name):
+        '''
+        Iterates over the slugs of the repositories of the given project.
+        '''
+        raise NotImplementedError
+    
+    
+    def sync_repo(self, repo_name):
+        '''
+        Called before a repository is scanned, so sources keeping local copies of repositories can
+        update them. Does nothing by default.
+        '''
+        
+        
+    def get_branches(self, repo_name):
+        '''
+        Returns a dict mapping each branch ref of the repository ("refs/heads/master") to the hash
+        of its head. 
+        '''
+        raise NotImplementedError
+    
+    
+    def get_project_branches(self, project_name, slugs, executor=None):
+        '''
+        Returns the branches of the given repositories of a project (see get_branches), as a dict
+        mapping slug => branches, or None if they couldn't be obtained. Used to check which 
+        repositories changed without scanning them (see schedule_repos).
+        
+        By default calls get_branches for each repository, concurrently using `executor` if given;
+        sources able to obtain the heads of many repositories at once, or more cheaply than 
+        get_branches, should override this.
+        '''
+        def get_branches(slug):
+            try:
+                return self.get_branches('%s/%s' % (project_name, slug))
+            except Exception:
+                return None  # left for fetch to report
+        return self._map_slugs(get_branches, slugs, executor)
+    
+    
+    @classmethod
+    def _map_slugs(cls, function, slugs, executor):
+        '''
+        Returns a dict mapping each slug => function(slug), called concurrently using `executor`
+        if given.
+        '''
+        if executor is not None:
+            results = executor.map(function, slugs)
+        else:
+            results = itertools.imap(function, slugs)
+        return dict(itertools.izip(slugs, results))
+    
+    
+    def iter_file_names(self, repo_name, since=None, until=None, at=None):
+        '''
+        Iterates over the names of the files changed between the commits `since` and `until`, or
+        changed by `until` if `since` is not given. Otherwise, iterates over the names of all
+        files at commit `at`, or at the head of the default branch if not given.
+        '''
+        raise NotImplementedError
+    
+    
+    def get_file_contents(self, repo_name, filename, at=None):
+        '''
+        Returns the contents of a file at the given commit (or at the head of the default branch),
+        or None if it doesn't exist there.
+        '''
+        raise NotImplementedError
+    
+    
+    # lines of context around each hunk requested by get_diff_hunks
+    DIFF_CONTEXT_LINES = 3
+    
+    def get_diff_hunks(self, repo_name, since, until):
+        '''
+        Returns the changes made to files between the commits `since` and `until`, as a dict 
+        mapping filename => hunks, each hunk a tuple (old_start, new_start, lines): the numbers of
+        its first line before and after the changes, and its lines as (tag, text) pairs, tag being
+        " " (unchanged), "-" (removed) or "+" (added). Hunks include DIFF_CONTEXT_LINES unchanged 
+        lines around the changes.
+        
+        Files whose hunks aren't available (added, removed, renamed or binary files, or diffs too 
+        large) may be left out. By default, no hunks are available: changed files are always 
+        downloaded again (see shift_todos).
+        '''
+        return {}
+    
+    
+    # maximum number of files read ahead of the contents consumed by iter_files_contents
+    DOWNLOAD_WINDOW = 1000
+    
+    def iter_files_contents(self, repo_name, filenames, at, executor):
+        '''
+        Iterates over the contents of the given files at the given commit (see get_file_contents),
+        in the same order as `filenames`. 
+        
+        By default calls get_file_contents for each file using the given executor, so many files
+        are read concurrently; sources able to read several files at once should override this.
+        
+        `filenames` may be an iterator: reads start as soon as the first names are available, and
+        are kept at most DOWNLOAD_WINDOW files ahead of the contents consumed.
+        '''
+        def get_contents(filename):
+            return self.get_file_contents(repo_name, filename, at=at)
+        
+        filenames = iter(filenames)
+        pending = collections.deque()
+        try:
+            while True:
+                for filename in itertools.islice(filenames, self.DOWNLOAD_WINDOW - len(pending)):
+                    pending.append(executor.submit(get_contents, filename))
+                if not pending:
+                    break
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+        
+        
+#===================================================================================================
+# TokenBucket
+#===================================================================================================
+class TokenBucket(object):
+    '''
+    Limits the rate of requests to `rate` per second, allowing bursts of up to `burst` requests.
+    
+    Thread-safe: each call to acquire reserves a token, sleeping until the time it becomes 
+    available, so threads waiting on the same bucket are spread over time instead of waking up 
+    together.
+    '''
+    
+    def __init__(self, rate, burst=None, clock=None, sleep=None):
+        self._rate = float(rate)
+        self._burst = float(burst if burst is not None else max(1.0, rate))
+        self._clock = clock or time.time
+        self._sleep = sleep or time.sleep
+        self._tokens = self._burst
+        self._last = self._clock()
+        self._lock = threading.Lock()
+        
+        
+    def acquire(self):
+        '''
+        Takes a token, sleeping until one is available. Returns the time slept.
+        '''
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            # tokens may become negative: that's the debt waited for by this call
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0.0
+            
+        if wait > 0:
+            self._sleep(wait)
+        return wait
+    
+    
+#===================================================================================================
+# parse_rate_limits
+#===================================================================================================
+def parse_rate_limits(text):
+    '''
+    Parses the rate limits of each Stash endpoint, given as "endpoint=rate" pairs separated by 
+    commas, for example "browse=50,files=5". Rates are in requests per second. Returns a dict 
+    mapping endpoint => rate (see StashServer).
+    '''
+    result = {}
+    for item in text.split(','):
+        item = item.strip()
+        if item:
+            endpoint, rate = item.split('=', 1)
+            result[endpoint.strip()] = float(rate)
+    return result
+    
+    
+#===================================================================================================
+# AdaptiveLimiter
+#===================================================================================================
+class AdaptiveLimiter(object):
+    '''
+    Limits the number of concurrent requests, adapting the limit to the responses of the server
+    (AIMD): the limit grows by one for each `limit` requests answered within `latency_target`
+    seconds, and is multiplied by `decrease_factor` when a request is answered slower than that or
+    the server signals overload (429, 5xx or timeouts).
+    
+    The server can also ask for a pause (Retry-After), during which no request is started.
+    '''
+    
+    def __init__(self, max_limit, min_limit=1, latency_target=2.0, decrease_factor=0.5, 
+                 clock=None):
+        self._max_limit = max_limit
+        self._min_limit = min_limit
+        self._latency_target = latency_target
+        self._decrease_factor = decrease_factor
+        self._clock = clock or time.time
+        
+        self._limit = float(max_limit)
+        self._active = 0
+        self._paused_until = 0.0
+        self._last_decrease = None
+        self._condition = threading.Condition()
+        
+        
+    def get_limit(self):
+        return int(self._limit)
+    
+    
+    def acquire(self):
+        '''
+        Waits until a request can be started, returning the time it was started.
+        '''
+        with self._condition:
+            while True:
+                now = self._clock()
+                pause = self._paused_until - now
+                if pause > 0:
+                    self._condition.wait(pause)
+                elif self._active >= int(self._limit):
+                    self._condition.wait()
+                else:
+                    break
+            self._active += 1
+            return now
+        
+        
+    def release(self, latency, overloaded=False):
+        '''
+        Signals the end of a request started by acquire, which took `latency` seconds. 
+        '''
+        with self._condition:
+            self._active -= 1
+            now = self._clock()
+            if overloaded or latency > self._latency_target:
+                # requests in flight when the server got overloaded usually report the same 
+                # overload, so the limit is decreased at most once per latency target
+                if self._last_decrease is None or \
+                        now - self._last_decrease >= self._latency_target:
+                    self._limit = max(self._min_limit, self._limit * self._decrease_factor)
+                    self._last_decrease = now
+            else:
+                self._limit = min(self._max_limit, self._limit + 1.0 / self._limit)
+            self._condition.notify_all()
+            
+            
+    def pause(self, seconds):
+        '''
+        Delays the start of all requests for the given number of seconds.
+        '''
+        with self._condition:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+            
+            
+#===================================================================================================
+# StashServer
+#===================================================================================================
+class StashServer(RepoSource):
+    '''
+    Access to a Stash server through its REST api.
+    
+    Requests are made using a pool of persistent sessions, so connections (and TLS handshakes) are
+    reused between requests. The same instance can be shared between threads: at most `pool_size`
+    requests are made concurrently, other threads wait for a session to become available.
+    
+    The number of concurrent requests adapts to the server's health (see AdaptiveLimiter), between 
+    1 and `pool_size`. Requests to each endpoint ("files", "changes", "diff", "browse", "branches"
+    and "repos") can also be limited to a number of requests per second, given by `rate_limits`
+    (see parse_rate_limits); a rate limit is shared by all threads using this instance.
+    
+    Requests that time out, fail to connect or receive a 429 or 5xx response are retried up to 
+    `retries` times, waiting the time asked by the server in the Retry-After header or 
+    `backoff * 2 ** attempt` seconds between each attempt.
+    
+    If `metrics` is given, every request (including retries) is recorded in it (see FetchMetrics).
+    
+    Paged listings request up to `prefetch_pages` pages ahead of the one being consumed (see 
+    _iter_paged_requests).
+    '''
+    
+    DEFAULT_POOL_SIZE = 8
+    
+    # page size used by Stash when no limit is given
+    DEFAULT_PAGE_SIZE = 25
+    
+    def __init__(self, base_url, auth, pool_size=DEFAULT_POOL_SIZE, retries=3, backoff=0.5, 
+                 timeout=30.0, rate_limits=None, latency_target=5.0, metrics=None, 
+                 prefetch_pages=2):
+        self._base_url = base_url
+        self._auth = auth
+        self._retries = retries
+        self._backoff = backoff
+        self._timeout = timeout
+        self._metrics = metrics
+        
+        self._sessions = Queue.Queue()
+        for _ in xrange(pool_size):
+            self._sessions.put(self._create_session())
+            
+        self._limiter = AdaptiveLimiter(pool_size, latency_target=latency_target)
+        self._prefetch_pages = prefetch_pages
+        self._page_executor = futures.ThreadPoolExecutor(max_workers=pool_size)
+        self._buckets = dict(
+            (endpoint, TokenBucket(rate)) for endpoint, rate in (rate_limits or {}).iteritems())
+        
+        
+    def _create_session(self):
+        session = requests.Session()
+        session.auth = self._auth
+        return session
+    
+    
+    @contextmanager
+    def _session(self):
+        '''
+        Context manager that borrows a session from the pool, blocking until one is available.
+        '''
+        session = self._sessions.get()
+        try:
+            yield session
+        finally:
+            self._sessions.put(session)
+            
+            
+    def _get(self, url, params, endpoint=None):
+        '''
+        Makes a GET request using a pooled session, retrying on timeouts, connection errors, 
+        too many requests (429) and server errors (5xx). Returns the last response received.
+        
+        :param endpoint: name of the endpoint requested, for its rate limit.
+        '''
+        bucket = self._buckets.get(endpoint)
+        attempt = 0
+        while True:
+            if bucket is not None:
+                bucket.acquire()
+            start_time = self._limiter.acquire()
+            try:
+                with self._session() as session:
+                    response = session.get(url, params=params, timeout=self._timeout)
+            except (requests.Timeout, requests.ConnectionError):
+                latency = time.time() - start_time
+                self._limiter.release(latency, overloaded=True)
+                if self._metrics is not None:
+                    self._metrics.record_request(endpoint, None, latency, 0)
+                if attempt >= self._retries:
+                    raise
+                delay = self._backoff * 2 ** attempt
+            else:
+                latency = time.time() - start_time
+                overloaded = response.status_code == 429 or response.status_code >= 500
+                self._limiter.release(latency, overloaded=overloaded)
+                if self._metrics is not None:
+                    self._metrics.record_request(
+                        endpoint, response.status_code, latency, len(response.content))
+                if not overloaded or attempt >= self._retries:
+                    return response
+                
+                delay = self._get_retry_after(response)
+                if delay is not None:
+                    # the server is asking all clients to slow down, not only this request
+                    self._limiter.pause(delay)
+                else:
+                    delay = self._backoff * 2 ** attempt
+            
+            time.sleep(delay)
+            attempt += 1
+            
+            
+    @classmethod
+    def _get_retry_after(cls, response):
+        '''
+        Returns the number of seconds given in the Retry-After header of a response (either as 
+        seconds or as a date), or None if not given.
+        '''
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            date = email.utils.parsedate_tz(value)
+            if date is None:
+                return None
+            return max(0.0, email.utils.mktime_tz(date) - time.time())
         
         
     def _make_repo_url_api(self, repo_name, api):
@@ -54,27 +501,56 @@ class StashServer(object):
             raise RuntimeError('Response status %d. Text:\n%s' % (response.status_code, response.text))
     
     
-    def _iter_paged_requests(self, url, params={}):
-        params = params.copy()
-        while True:
-            r = requests.get(url, params=params, auth=self._auth)
-            self._check_reponse(r)
-            
-            json = r.json()
-            yield json
-            
-            if json['isLastPage']:
-                break
-            params['start'] = json['nextPageStart']
+    def _get_page(self, url, params, endpoint):
+        r = self._get(url, params, endpoint)
+        self._check_reponse(r)
+        return r.json()
+    
+    
+    def _iter_paged_requests(self, url, params={}, endpoint=None):
+        '''
+        Iterates over the values of all pages of a paged api, as they are received.
+        
+        While the values of a page are consumed, the following pages are requested in the 
+        background. Stash pages by offset, so the pages after the next one are requested assuming
+        each page has `limit` values; the guess is checked against the "nextPageStart" of each 
+        page, and requests made for wrong offsets are discarded.
+        '''
+        limit = params.get('limit', self.DEFAULT_PAGE_SIZE)
+        pending = collections.deque()  # (start, future) of the pages requested ahead
+        try:
+            page = self._get_page(url, params, endpoint)
+            while True:
+                if not page['isLastPage']:
+                    next_start = page['nextPageStart']
+                    if pending and pending[0][0] != next_start:
+                        for _, future in pending:
+                            future.cancel()
+                        pending.clear()
+                    while len(pending) < max(1, self._prefetch_pages):
+                        start = next_start + limit * len(pending)
+                        future = self._page_executor.submit(
+                            self._get_page, url, dict(params, start=start), endpoint)
+                        pending.append((start, future))
+                    
+                for value in page['values']:
+                    yield value
+                    
+                if page['isLastPage']:
+                    break
+                _, future = pending.popleft()
+                page = future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
             
                 
     def get_branches(self, repo_name):
         url = self._make_repo_url_api(repo_name, '/branches')
         
         result = {}
-        for json in self._iter_paged_requests(url, params=dict(limit=1000)):
-            for value in json['values']:
-                result[value['id']] = value['latestChangeset']   
+        for value in self._iter_paged_requests(url, params=dict(limit=1000), endpoint='branches'):
+            result[value['id']] = value['latestChangeset']   
         return result
         
 
@@ -82,22 +558,55 @@ class StashServer(object):
         params = {'limit': 1000}
         
         if until is not None:
-            assert at is not None, "either pass 'since' and 'until' params or 'at'"
+            assert at is None, "either pass 'since' and 'until' params or 'at'"
             params['until'] = until
             if since is not None:
                 params['since'] = since
                 
             url = self._make_repo_url_api(repo_name, '/changes')
-            for json in self._iter_paged_requests(url, params):
-                for value in json['values']:
-                    yield value['path']['toString']
+            for value in self._iter_paged_requests(url, params, endpoint='changes'):
+                yield value['path']['toString']
         else:
             if at is not None:
                 params['at'] = at
             url = self._make_repo_url_api(repo_name, '/files')
-            for json in self._iter_paged_requests(url, params):
-                for filename in json['values']:
-                    yield filename
+            for filename in self._iter_paged_requests(url, params, endpoint='files'):
+                yield filename
+        
+        
+    def get_diff_hunks(self, repo_name, since, until):
+        '''
+        Obtains the hunks of all files with a single request to the diff api. Diffs truncated by 
+        the server are left out.
+        '''
+        url = self._make_repo_url_api(repo_name, '/commits/%s/diff' % until)
+        params = {
+            'since': since, 
+            'contextLines': self.DIFF_CONTEXT_LINES, 
+            'withComments': 'false',
+        }
+        response = self._get(url, params, endpoint='diff')
+        self._check_reponse(response)
+        
+        tags = {'CONTEXT': ' ', 'REMOVED': '-', 'ADDED': '+'}
+        result = {}
+        for diff in response.json().get('diffs', []):
+            source, destination = diff.get('source'), diff.get('destination')
+            if source is None or destination is None or diff.get('truncated') or \
+                    source['toString'] != destination['toString']:
+                continue
+            hunks = []
+            for hunk in diff.get('hunks', []):
+                lines = [
+                    (tags[segment['type']], line['line']) 
+                    for segment in hunk['segments'] for line in segment['lines']
+                ]
+                hunks.append((hunk['sourceLine'], hunk['destinationLine'], lines))
+                if hunk.get('truncated') or any(x.get('truncated') for x in hunk['segments']):
+                    break
+            else:
+                result[destination['toString']] = hunks
+        return result
         
         
     def get_file_contents(self, repo_name, filename, at=None):
@@ -108,32 +617,324 @@ class StashServer(object):
         project, slug = self.split_repo_name(repo_name)
         url = '%s/projects/%s/repos/%s/browse/%s' % (self._base_url, project, slug, filename)
         
-        r = requests.get(url, params=params, auth=self._auth)
+        r = self._get(url, params, endpoint='browse')
         if r.status_code == 200:
             return r.text
+        elif r.status_code >= 500:
+            # don't mistake a server failure for a removed file, which would drop its todos
+            self._check_reponse(r)
         else:
             return None
         
         
     def iter_repos(self, project_name):
-        for json in self._iter_paged_requests(self._make_repo_url_api(project_name, api=None)):
-            for value in json['values']:
-                yield value['slug']
+        url = self._make_repo_url_api(project_name, api=None)
+        for value in self._iter_paged_requests(url, endpoint='repos'):
+            yield value['slug']
+        
+
+#===================================================================================================
+# GitMirrorSource
+#===================================================================================================
+class GitMirrorSource(RepoSource):
+    '''
+    Reads repositories from local bare mirrors, kept in `mirrors_dir` as "project/slug.git". 
+    
+    Mirrors are cloned (if missing) and updated with an incremental "git fetch" by sync_repo, 
+    using `clone_url_format` to obtain the url of each repository: a string formatted with the 
+    project and slug of the repository, like "ssh://git@example.com/{project}/{slug}.git".
+    
+    Listing and reading files is done by local git commands; in particular, the contents of many
+    files are read through a single "git cat-file --batch" process.
+    
+    :param repo_lister: source used to list the repositories of a project (iter_repos), usually 
+        the server hosting them. If not given, only the mirrors already in `mirrors_dir` are 
+        listed.
+    :param auth: (user, password) sent to http(s) remotes. Git never prompts for credentials, so
+        commands fail instead of hanging when they are missing or rejected.
+    '''
+    
+    def __init__(self, mirrors_dir, clone_url_format=None, repo_lister=None, git='git', 
+                 auth=None):
+        self._mirrors_dir = mirrors_dir
+        self._clone_url_format = clone_url_format
+        self._repo_lister = repo_lister
+        self._git = git
+        self._auth = auth
+        
+        
+    def get_mirror_dir(self, repo_name):
+        project, slug = self.split_repo_name(repo_name)
+        return os.path.join(self._mirrors_dir, project, slug + '.git')
+    
+    
+    def _get_remote_env(self):
+        '''
+        Returns the environment of git commands contacting the remote: prompts are disabled, and
+        the credentials are given as an http header through the environment (git 2.31+), so they
+        don't show in the command line of the process.
+        '''
+        env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+        if self._auth is not None:
+            credentials = base64.b64encode('%s:%s' % tuple(self._auth))
+            index = int(env.get('GIT_CONFIG_COUNT', 0))
+            env['GIT_CONFIG_COUNT'] = str(index + 1)
+            env['GIT_CONFIG_KEY_%d' % index] = 'http.extraHeader'
+            env['GIT_CONFIG_VALUE_%d' % index] = 'Authorization: Basic %s' % credentials
+        return env
+    
+    
+    def _run_git(self, repo_name, *args, **kwargs):
+        '''
+        Runs a git command on the mirror of the given repository, returning its output. Pass 
+        remote=True for commands contacting the remote (see _get_remote_env).
+        '''
+        env = self._get_remote_env() if kwargs.pop('remote', False) else None
+        command = [self._git, '--git-dir', self.get_mirror_dir(repo_name)] + list(args)
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, 
+            env=env)
+        stdout, stderr = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError('Command %s failed (%d):\n%s' % (
+                ' '.join(command), process.returncode, stderr))
+        return stdout
+    
+    
+    def iter_repos(self, project_name):
+        if self._repo_lister is not None:
+            for slug in self._repo_lister.iter_repos(project_name):
+                yield slug
+        else:
+            project_dir = os.path.join(self._mirrors_dir, project_name)
+            if os.path.isdir(project_dir):
+                for name in sorted(os.listdir(project_dir)):
+                    if name.endswith('.git'):
+                        yield name[:-len('.git')]
+    
+    
+    def sync_repo(self, repo_name):
+        mirror_dir = self.get_mirror_dir(repo_name)
+        if os.path.isdir(mirror_dir):
+            self._run_git(repo_name, 'fetch', '--prune', '--quiet', remote=True)
+        elif self._clone_url_format is not None:
+            project, slug = self.split_repo_name(repo_name)
+            url = self._clone_url_format.format(project=project, slug=slug)
+            command = [self._git, 'clone', '--mirror', '--quiet', url, mirror_dir]
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, 
+                env=self._get_remote_env())
+            _, stderr = process.communicate()
+            if process.returncode != 0:
+                raise RuntimeError('Failed to clone %s (%d):\n%s' % (url, process.returncode, stderr))
+            
+            
+    def get_branches(self, repo_name):
+        output = self._run_git(repo_name, 'for-each-ref', '--format=%(refname) %(objectname)', 
+            'refs/heads')
+        result = {}
+        for line in output.splitlines():
+            ref, hash_value = line.rsplit(' ', 1)
+            result[ref] = hash_value
+        return result
+    
+    
+    def get_project_branches(self, project_name, slugs, executor=None):
+        '''
+        Lists the branches of the remote of each mirror with "git ls-remote", much cheaper than
+        updating the mirror, concurrently using `executor` if given. Repositories not mirrored 
+        yet are left as None.
+        '''
+        def get_branches(slug):
+            repo_name = '%s/%s' % (project_name, slug)
+            if not os.path.isdir(self.get_mirror_dir(repo_name)):
+                return None
+            try:
+                output = self._run_git(repo_name, 'ls-remote', '--heads', 'origin', remote=True)
+            except RuntimeError:
+                return None  # left for fetch to report
+            branches = {}
+            for line in output.splitlines():
+                hash_value, ref = line.split('\t', 1)
+                branches[ref] = hash_value
+            return branches
+        return self._map_slugs(get_branches, slugs, executor)
+    
+    
+    def iter_file_names(self, repo_name, since=None, until=None, at=None):
+        if until is not None:
+            assert at is None, "either pass 'since' and 'until' params or 'at'"
+            if since is not None:
+                output = self._run_git(repo_name, 'diff', '--name-only', '--no-renames', '-z',
+                    since, until)
+            else:
+                output = self._run_git(repo_name, 'diff-tree', '--root', '--no-commit-id', 
+                    '--name-only', '-r', '-z', until)
+        else:
+            output = self._run_git(repo_name, 'ls-tree', '-r', '--name-only', '-z', at or 'HEAD')
+            
+        for filename in output.split('\0'):
+            if filename:
+                yield filename.decode('utf-8')
+                
+                
+    def get_diff_hunks(self, repo_name, since, until):
+        output = self._run_git(repo_name, '-c', 'core.quotepath=false', 'diff', '--no-color', 
+            '--no-renames', '--no-ext-diff', '-U%d' % self.DIFF_CONTEXT_LINES, since, until)
+        return _ParseUnifiedDiff(output.decode('utf-8', 'replace'))
+    
+    
+    def get_file_contents(self, repo_name, filename, at=None):
+        return next(self.iter_files_contents(repo_name, [filename], at, executor=None))
+    
+    
+    def iter_files_contents(self, repo_name, filenames, at, executor):
+        '''
+        Reads all files through a single "git cat-file --batch" process. The executor is not
+        used.
+        '''
+        filenames = list(filenames)
+        command = [self._git, '--git-dir', self.get_mirror_dir(repo_name), 'cat-file', '--batch']
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        
+        # requests are written by another thread, otherwise both processes could block writing
+        # to full pipes
+        def write_requests():
+            try:
+                try:
+                    for filename in filenames:
+                        process.stdin.write('%s:%s\n' % (at or 'HEAD', filename.encode('utf-8')))
+                finally:
+                    process.stdin.close()
+            except IOError:
+                pass  # the process was stopped before all contents were read
+                
+        writer = threading.Thread(target=write_requests)
+        writer.daemon = True
+        writer.start()
         
+        try:
+            for filename in filenames:
+                # "<object> <type> <size>", or "<object> missing"; the object is given as requested,
+                # so it may contain spaces
+                header = process.stdout.readline()
+                if not header:
+                    raise RuntimeError('git cat-file stopped before reading %s:%s from %s' % (
+                        at or 'HEAD', filename, repo_name))
+                header = header.rstrip('\n')
+                if not header.endswith(' missing'):
+                    _, object_type, size = header.rsplit(' ', 2)
+                    contents = process.stdout.read(int(size))
+                    process.stdout.read(1)  # new line after contents
+                    if object_type == 'blob':
+                        yield contents.decode('utf-8', 'replace')
+                        continue
+                yield None  # missing, or not a file
+        finally:
+            # if the contents weren't all read, the writer may be blocked on a full pipe: the
+            # process is stopped first, so the writer fails instead of waiting forever
+            process.stdout.close()
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            writer.join()
+                
+        
+_HUNK_HEADER_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
 
+def _ParseUnifiedDiff(text):
+    '''
+    Returns the hunks of each file in a unified diff, as returned by RepoSource.get_diff_hunks. 
+    Files added, removed or renamed are left out, as are files with quoted names.
+    '''
+    result = {}
+    lines = text.split('\n')
+    index = 0
+    old_path = hunks = None
+    while index < len(lines):
+        line = lines[index]
+        index += 1
+        if line.startswith('diff '):
+            old_path = hunks = None
+        elif line.startswith('--- '):
+            old_path = line[len('--- '):]
+        elif line.startswith('+++ '):
+            new_path = line[len('+++ '):]
+            if old_path is not None and old_path.startswith('a/') and \
+                    new_path == 'b/' + old_path[len('a/'):]:
+                hunks = result[new_path[len('b/'):]] = []
+        else:
+            match = _HUNK_HEADER_RE.match(line)
+            if match is None:
+                continue
+            old_start, old_count, new_start, new_count = match.groups()
+            old_count = int(old_count) if old_count is not None else 1
+            new_count = int(new_count) if new_count is not None else 1
+            # hunks without lines on one side give the line before them
+            hunk = (int(old_start) + (old_count == 0), int(new_start) + (new_count == 0), [])
+            
+            # the lines of the hunk are counted, as they may look like headers themselves
+            while (old_count > 0 or new_count > 0) and index < len(lines):
+                line = lines[index]
+                index += 1
+                tag, text = line[:1] or ' ', line[1:]
+                if tag == '\\':
+                    continue  # "no newline at end of file"
+                if tag in (' ', '-'):
+                    old_count -= 1
+                if tag in (' ', '+'):
+                    new_count -= 1
+                hunk[2].append((tag, text))
+            if hunks is not None:
+                hunks.append(hunk)
+    return result
+    
+    
 #===================================================================================================
 # MongoStorage
 #===================================================================================================
 class MongoStorage(object):
     
-    def __init__(self, default_db_name='todos'):
+    PARSE_CACHE_SIZE = 32 * 1024 * 1024
+    
+    _POSITION_ORDER = [
+        ('repo', pymongo.ASCENDING), 
+        ('branch', pymongo.ASCENDING), 
+        ('filename', pymongo.ASCENDING),
+        ('lineno', pymongo.ASCENDING),
+    ]
+    
+    _DUE_ORDER = [('due', pymongo.ASCENDING)] + _POSITION_ORDER
+    
+    FETCH_METRICS_SIZE = 16 * 1024 * 1024
+    
+    def __init__(self, default_db_name='todos', parse_cache_size=PARSE_CACHE_SIZE, 
+                 fetch_metrics_size=FETCH_METRICS_SIZE):
         mongodb_uri = os.environ.get('MONGOLAB_URI', 'mongodb://localhost:27017/{}'.format(default_db_name))
         db_name = urlsplit(mongodb_uri).path[1:]
         self._connection = pymongo.Connection(mongodb_uri)
         self._db = self._connection[db_name]
         
-        self._db.todos.create_index([('repo', pymongo.ASCENDING), ('filename', pymongo.ASCENDING)])
-        self._db.hashes.create_index('repo')
+        # each todo is stored as its own document; indexes match the orders given by query_todos
+        self._db.todos.create_index(self._POSITION_ORDER)
+        self._db.todos.create_index([('project', pymongo.ASCENDING)] + self._POSITION_ORDER)
+        self._db.todos.create_index(self._DUE_ORDER)
+        self._db.hashes.create_index([('repo', pymongo.ASCENDING), ('branch', pymongo.ASCENDING)])
+        self._db.repo_states.create_index([('run_id', pymongo.ASCENDING), ('repo', pymongo.ASCENDING)])
+        self._db.repo_states.create_index([('run_id', pymongo.ASCENDING), ('state', pymongo.ASCENDING)])
+        self._db.repo_schedules.create_index([('repo', pymongo.ASCENDING)], unique=True)
+        
+        # capped collections discard their oldest documents once full, bounding the size of the
+        # cache and of the history of metrics
+        collection_names = self._db.collection_names()
+        capped_sizes = [('parse_cache', parse_cache_size), ('fetch_metrics', fetch_metrics_size)]
+        for name, size in capped_sizes:
+            if name not in collection_names:
+                try:
+                    self._db.create_collection(name, capped=True, size=size)
+                except pymongo.errors.CollectionInvalid:
+                    pass  # created concurrently by another process
+                    
+        # every process reading or writing todos may be the first one run after a deploy
+        self.upgrade_todos()
         
         self.__TESTING__ = False
         
@@ -147,241 +948,2245 @@ class MongoStorage(object):
         self._db.drop_collection('todos')
         self._db.drop_collection('hashes')
         self._db.drop_collection('fetch_all_status')
+        self._db.drop_collection('fetch_runs')
+        self._db.drop_collection('repo_states')
+        self._db.drop_collection('repo_schedules')
+        self._db.drop_collection('repo_locks')
+        # the parse cache is kept: it only depends on the contents of files, and makes the scan
+        # that follows the drop much cheaper
+        # the generation is bumped instead of dropped: starting it over could make it match a 
+        # generation cached before the drop
+        self.bump_generation()
         
         
-    def drop_todos_for_repo(self, repo_name):
-        result = False
-        for entry in self._db.todos.find({'repo': repo_name}):
-            self._db.todos.remove(entry['_id'])
-            result = True
-            
-        entry = self._db.hashes.find_one({'repo': repo_name})
-        if entry:
-            self._db.hashes.remove(entry['_id'])
-            result = True
+    def get_generation(self):
+        '''
+        Returns the current generation of the stored data: a counter incremented every time todos
+        or the fetch status are written, which can be used to invalidate caches of that data.
+        '''
+        entry = self._db.counters.find_one({'_id': 'generation'})
+        if entry is not None:
+            return entry['value']
+        else:
+            return 0
         
-        return result
+        
+    def bump_generation(self):
+        self._db.counters.update({'_id': 'generation'}, {'$inc': {'value': 1}}, upsert=True, w=1)
+        
+        
+    def drop_todos_for_repo(self, repo_name):
+        todos_result = self._db.todos.remove({'repo': repo_name}, w=1)
+        hashes_result = self._db.hashes.remove({'repo': repo_name}, w=1)
+        if todos_result['n']:
+            self.bump_generation()
+        return bool(todos_result['n'] or hashes_result['n'])
          
 
-    def update_todos(self, repo_name, filename, todos):
-        entry = self._db.todos.find_one({'repo': repo_name, 'filename': filename})
-        if todos:
-            if entry is None:
-                entry = {}
-            entry['repo'] = repo_name
-            entry['filename'] = filename
-            entry['todos'] = todos
-            self._db.todos.save(entry)
-        else:
-            if entry is not None:
-                self._db.todos.remove(entry['_id'])
+    def update_todos(self, repo_name, filename, todos, branch=DEFAULT_BRANCH):
+        self.update_repo_todos(repo_name, [(filename, todos)], branch=branch)
+        
+        
+    def update_repo_todos(self, repo_name, todos_by_filename, hash_value=None, checkpoint=None,
+                          branch=DEFAULT_BRANCH, scan_key=None):
+        '''
+        Updates the todos of several files of a branch of a repository using a single bulk write.
+        
+        :param todos_by_filename: sequence of (filename, todos) pairs. The todos of each file 
+            replace its previous todos.
+        :param hash_value: if given, the last hash of the repository is updated to this value,
+            but only after all todos have been acknowledged by the server: MongoDB can't write
+            to two collections atomically, so a failure in the middle leaves the previous hash in
+            place and the next fetch just rewrites the same todos again.
+        :param checkpoint: if given, the fetch checkpoint of the repository is updated to this
+            value after the todos are written (see get_checkpoint). Setting the hash clears it.
+        :param branch: name of the branch, without the "refs/heads/" prefix. Todos and hashes of
+            each branch are stored separately.
+        :param scan_key: stored along with `hash_value` (see get_last_hash).
+        '''
+        project, _slug = StashServer.split_repo_name(repo_name)
+        # ordered, so the todos of each file are inserted after its previous todos are removed
+        bulk = self._db.todos.initialize_ordered_bulk_op()
+        has_operations = False
+        for filename, todos in todos_by_filename:
+            bulk.find({'repo': repo_name, 'branch': branch, 'filename': filename}).remove()
+            for todo in todos:
+                bulk.insert(self._make_entry(project, repo_name, branch, filename, todo))
+            has_operations = True
+            
+        if has_operations:
+            bulk.execute(write_concern={'w': 1})
+            self.bump_generation()
+            
+        if hash_value is not None:
+            self.set_last_hash(repo_name, hash_value, branch=branch, scan_key=scan_key)
+        elif checkpoint is not None:
+            self._db.hashes.update(
+                {'repo': repo_name, 'branch': branch}, 
+                {'$set': {'checkpoint': checkpoint}}, 
+                upsert=True, 
+                w=1,
+            )
                 
                 
-    def iter_all_todos(self):
-        return iter(self._db.todos.find())
-    
-    
-    def get_last_hash(self, repo_name):
-        entry = self._db.hashes.find_one({'repo': repo_name})
+    def get_checkpoint(self, repo_name, branch=DEFAULT_BRANCH):
+        '''
+        Returns the checkpoint of an unfinished fetch of the given branch, as last given to
+        update_repo_todos, or None if its last fetch finished.
+        '''
+        entry = self._db.hashes.find_one({'repo': repo_name, 'branch': branch})
         if entry:
-            return entry['hash']
+            return entry.get('checkpoint')
         else:
             return None
         
         
-    def set_last_hash(self, repo_name, hash_value):
-        entry = self._db.hashes.find_one({'repo': repo_name})
-        if entry is None:
-            entry = {'repo': repo_name}
-        entry['hash'] = hash_value
-        self._db.hashes.save(entry)
-
-
-    def set_last_fetch_all_status(self, date, elapsed):
-        entry = self._db.fetch_all_status.find_one()
-        if entry is None:
-            entry = {}
-        entry['date'] = date.strftime('%Y-%m-%d %H:%M:%S')
-        entry['elapsed'] = str(elapsed)
-        self._db.fetch_all_status.save(entry)
-
-
-    def get_last_fetch_all_status(self):
-        entry = self._db.fetch_all_status.find_one()
-        if entry is not None:
-            return entry['date'], entry['elapsed']
-        else:
-            return None, None
-    
-    
-#===================================================================================================
-# IterToDos
-#===================================================================================================
-def IterToDos(contents):
-    
-    class MyVisitor(ast.NodeVisitor):
-
-        def __init__(self):
-            self.todos = []
+    def copy_branch_todos(self, repo_name, from_branch, to_branch, hash_value, scan_key=None):
+        '''
+        Replaces the todos of `to_branch` by a copy of the todos of `from_branch`, setting its last
+        hash to `hash_value`: the hash `from_branch` was fetched at. 
         
+        Used to start the fetch of a new branch from the todos of a branch already fetched, so only
+        the files that differ between both are fetched (see fetch).
+        '''
+        self._db.todos.remove({'repo': repo_name, 'branch': to_branch}, w=1)
+        bulk = self._db.todos.initialize_unordered_bulk_op()
+        has_operations = False
+        for entry in self._db.todos.find({'repo': repo_name, 'branch': from_branch}):
+            del entry['_id']
+            entry['branch'] = to_branch
+            bulk.insert(entry)
+            has_operations = True
+            
+        if has_operations:
+            bulk.execute(write_concern={'w': 1})
+            self.bump_generation()
+        self.set_last_hash(repo_name, hash_value, branch=to_branch, scan_key=scan_key)
         
-        def IsToDo(self, expr):
-            return type(expr) is ast.Call and expr.func.id == 'ToDo'
         
-        def visit_FunctionDef(self, function_def):
-            if function_def.decorator_list and self.IsToDo(function_def.decorator_list[0]):
-                call = function_def.decorator_list[0]
-                
-                function_name = function_def.name
+    def drop_branch_todos(self, repo_name, branch):
+        '''
+        Removes all todos of a branch, keeping its hash. Used before scanning all files of a 
+        branch, so files that were scanned before but aren't anymore don't keep their todos.
+        '''
+        result = self._db.todos.remove({'repo': repo_name, 'branch': branch}, w=1)
+        if result['n']:
+            self.bump_generation()
                 
-                if call.args:
-                    date = ast.literal_eval(call.args[0])
-                    date = datetime.datetime(*date)
-                else:
-                    date = None
                 
-                if date is not None and call.keywords:
-                    expr = Expression(call.keywords[0].value)
-                    b = compile(expr, '', 'eval')
-                    
-                    days = eval(b)
-                else:
-                    days = None
-                    
-                self.todos.append({
-                    'function_name' : function_name, 
-                    'date' : date, 
-                    'days' : days, 
-                    'lineno' : function_def.lineno,
-                })
-    
-    visitor = MyVisitor()
-    try:
-        visitor.visit(ast.parse(contents))
-    except SyntaxError:
-        return
+    @classmethod
+    def _make_entry(cls, project, repo_name, branch, filename, todo):
+        '''
+        Creates the document stored for a todo: the todo itself plus its position, the project of
+        its repository and its due date, so todos can be filtered and sorted by any of them.
+        '''
+        entry = todo.copy()
+        entry['project'] = project
+        entry['repo'] = repo_name
+        entry['branch'] = branch
+        entry['filename'] = filename
+        entry['due'] = cls.compute_due(todo)
+        return entry
     
-    for x in visitor.todos:
-        yield x    
-        
-        
-#===================================================================================================
-# fetch
-#===================================================================================================
-def fetch(repo_name, storage, stash, stream):
-    branches = stash.get_branches(repo_name)
     
-    def short(hash_name):
-        return hash_name[:7]
+    @classmethod
+    def compute_due(cls, todo):
+        '''
+        Returns the date a todo is due: its date plus its number of days, or None if it has no date
+        or its due date can't be computed (cached by older versions that didn't check days).
+        '''
+        if todo['date'] is None:
+            return None
+        if todo['days']:
+            try:
+                return todo['date'] + datetime.timedelta(days=todo['days'])
+            except (TypeError, OverflowError):
+                return None
+        return todo['date']
     
-    start_time = time.time()
     
-    try:
-        master = branches['refs/heads/master']
-    except KeyError:
-        print >> stream, 'Skipping: no master branch'
-        print >> stream, 'Branches (%d):' % len(branches)
-        for branch in branches:
-            print >> stream, branch
-        return
-    
-    last_hash = storage.get_last_hash(repo_name)
-    
-    if last_hash == master:
-        print >> stream, 'ToDos up-to-date (against %s)' % short(master)
-    else:
-        if last_hash:
-            since = last_hash
-            until = master
-            print >> stream, 'Fetching %s %s..%s' % (repo_name, short(since), short(until))
-        else:
-            print >> stream, 'Fetching %s ALL (master at %s)' % (repo_name, short(master))
-            since = None
-            until = None
-        
-        filenames = list(stash.iter_file_names(repo_name, since=since, until=until))
-        print >> stream, 'Changed Files: %d' % len(filenames)
-        
-        filenames = [x for x in filenames if fnmatch.fnmatch(os.path.basename(x), 'test_*.py')]
-        print >> stream, 'Test Files: %d' % len(filenames)
+    def get_file_todos(self, repo_name, filenames, branch=DEFAULT_BRANCH):
+        '''
+        Returns the todos of the given files of a branch, as given to update_repo_todos, as a dict
+        mapping filename => todos sorted by line (an empty list for files without todos).
+        '''
+        result = dict((x, []) for x in filenames)
+        cursor = self._db.todos.find(
+            {'repo': repo_name, 'branch': branch, 'filename': {'$in': list(filenames)}},
+            fields={'_id': False, 'project': False, 'repo': False, 'branch': False, 'due': False},
+        )
+        for entry in cursor.sort(self._POSITION_ORDER):
+            result[entry.pop('filename')].append(entry)
+        return result
+    
+    
+    def iter_all_todos(self):
+        '''
+        Iterates over all todos as stored, sorted by repo, branch, filename and line.
+        '''
+        cursor = self._db.todos.find(fields={'_id': False})
+        return iter(cursor.sort(self._POSITION_ORDER))
+    
+    
+    # indexes of the layouts stored by previous versions
+    _OUTDATED_INDEXES = [
+        'repo_1_filename_1',
+        'repo_1_branch_1_filename_1', 
+        'project_1_repo_1_branch_1_filename_1', 
+        'todos.due_1',
+    ]
+    
+    # an entry claimed by an upgrade is claimed again after this long, in case its process died
+    UPGRADE_CLAIM_SECONDS = 600.0
+    
+    def upgrade_todos(self):
+        '''
+        Rewrites entries stored by previous versions, which kept all todos of a file in a single
+        document, possibly without the project or the branch (which was always master).
         
-        summary = {}
-        for filename in filenames:
-            contents = stash.get_file_contents(repo_name, filename, at=until)
-            if contents is not None:
-                todos = list(IterToDos(contents))
-            else:
-                todos = []
+        Run whenever a storage is created: it does nothing once all entries are upgraded, and 
+        processes running it at the same time claim each entry before upgrading it.
+        '''
+        upgraded = False
+        while True:
+            now = datetime.datetime.utcnow()
+            expired = now - datetime.timedelta(seconds=self.UPGRADE_CLAIM_SECONDS)
+            entry = self._db.todos.find_and_modify(
+                {'todos': {'$exists': True}, 
+                    '$or': [{'upgrading': {'$exists': False}}, {'upgrading': {'$lt': expired}}]},
+                {'$set': {'upgrading': now}},
+            )
+            if entry is None:
+                break
+            project, _slug = StashServer.split_repo_name(entry['repo'])
+            branch = entry.get('branch', DEFAULT_BRANCH)
+            new_entries = [
+                self._make_entry(project, entry['repo'], branch, entry['filename'], todo)
+                for todo in entry['todos']
+            ]
+            # todos of the file may have been inserted by an upgrade interrupted before removing
+            # its previous document
+            self._db.todos.remove({'repo': entry['repo'], 'branch': branch, 
+                'filename': entry['filename'], 'todos': {'$exists': False}}, w=1)
+            if new_entries:
+                self._db.todos.insert(new_entries, w=1)
+            self._db.todos.remove({'_id': entry['_id']}, w=1)
+            upgraded = True
+            
+        index_names = self._db.todos.index_information()
+        for name in self._OUTDATED_INDEXES:
+            if name in index_names:
+                self._db.todos.drop_index(name)
+        
+        self._db.hashes.update(
+            {'branch': {'$exists': False}}, {'$set': {'branch': DEFAULT_BRANCH}}, multi=True, w=1)
+        # hashes fetched before extractors were configurable were scanned with the defaults
+        self._db.hashes.update(
+            {'scan_key': {'$exists': False}}, {'$set': {'scan_key': _DEFAULT_EXTRACTOR.scan_key}},
+            multi=True, w=1)
+            
+        if upgraded:
+            self.bump_generation()
+    
+    
+    def iter_todos(self, repo=None, project=None, due_from=None, due_until=None, branch=None,
+                   after=None):
+        '''
+        Iterates over todos matching the given filters (see query_todos), in the same order and
+        format. Todos are read from a cursor as they are consumed, so memory usage doesn't depend 
+        on the number of todos.
+        
+        :param after: a (repo, branch, filename, lineno) tuple: only todos after this position are
+            returned. Used to resume iteration from the last todo received.
+        '''
+        match = self._make_todos_match(repo, project, due_from, due_until, branch)
+        if after is not None:
+            after_repo, after_branch, after_filename, after_lineno = after
+            match = {'$and': [match, {'$or': [
+                {'repo': {'$gt': after_repo}},
+                {'repo': after_repo, 'branch': {'$gt': after_branch}},
+                {'repo': after_repo, 'branch': after_branch, 'filename': {'$gt': after_filename}},
+                {'repo': after_repo, 'branch': after_branch, 'filename': after_filename, 
+                    'lineno': {'$gt': after_lineno}},
+            ]}]}
+            
+        cursor = self._db.todos.find(match, fields={'_id': False})
+        return iter(cursor.sort(self._POSITION_ORDER))
+    
+    
+    def _make_todos_match(self, repo, project, due_from, due_until, branch):
+        '''
+        Returns a query matching the todos that match the given filters.
+        '''
+        match = {}
+        if repo is not None:
+            match['repo'] = repo
+        if project is not None:
+            match['project'] = project
+        if branch is not None:
+            match['branch'] = branch
+            
+        due_match = {}
+        if due_from is not None:
+            due_match['$gte'] = due_from
+        if due_until is not None:
+            due_match['$lt'] = due_until
+        if due_match:
+            match['due'] = due_match
+        return match
+    
+    
+    def query_todos(self, repo=None, project=None, due_from=None, due_until=None, branch=None,
+                    skip=0, limit=None, order_by='position'):
+        '''
+        Returns a list of todos matching the given filters.
+        
+        Each todo is returned as a flat dict, containing the keys of the todo itself 
+        ('function_name', 'date', 'days', 'lineno' and 'due') plus 'project', 'repo', 'branch' 
+        and 'filename'.
+        
+        :param due_from: only todos due on or after this date.
+        :param due_until: only todos due before this date. Overdue todos are those due before now.
+        :param branch: only todos of this branch; by default todos of all branches are returned.
+        :param skip: number of todos to skip.
+        :param limit: maximum number of todos to return, or None for no limit.
+        :param order_by: "position" sorts todos by repo, branch, filename and line; "due" sorts 
+            them by due date first, todos without a date coming first. Both orders are backed by 
+            indexes.
+        '''
+        if order_by == 'position':
+            order = self._POSITION_ORDER
+        elif order_by == 'due':
+            order = self._DUE_ORDER
+        else:
+            raise ValueError('Unknown order: %r' % (order_by,))
+            
+        match = self._make_todos_match(repo, project, due_from, due_until, branch)
+        cursor = self._db.todos.find(match, fields={'_id': False}).sort(order)
+        if skip:
+            cursor = cursor.skip(skip)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return list(cursor)
+    
+    
+    def count_todos(self, repo=None, project=None, due_from=None, due_until=None, branch=None):
+        '''
+        Returns the number of todos matching the given filters (see query_todos). 
+        '''
+        match = self._make_todos_match(repo, project, due_from, due_until, branch)
+        return self._db.todos.find(match).count()
+    
+    
+    def count_todos_by(self, group_by, now, repo=None, project=None, due_from=None, 
+                       due_until=None, branch=None):
+        '''
+        Returns the number of todos matching the given filters (see query_todos) in each project or
+        repository, for summary views. 
+        
+        :param group_by: "project" or "repo".
+        :param now: date used to tell overdue todos: those due before it.
+        :return: list of dicts with the name of each group (under the `group_by` key), its number
+            of todos in "count" and of overdue todos in "overdue", sorted by name.
+        '''
+        if group_by not in ('project', 'repo'):
+            raise ValueError('Unknown group: %r' % (group_by,))
+        
+        # null is lower than any date, so todos without a due date are excluded explicitly
+        is_overdue = {'$and': [{'$gt': ['$due', None]}, {'$lt': ['$due', now]}]}
+        pipeline = [
+            {'$match': self._make_todos_match(repo, project, due_from, due_until, branch)},
+            {'$group': {
+                '_id': '$' + group_by, 
+                'count': {'$sum': 1}, 
+                'overdue': {'$sum': {'$cond': [is_overdue, 1, 0]}},
+            }},
+            {'$sort': {'_id': pymongo.ASCENDING}},
+        ]
+        return [
+            {group_by: x['_id'], 'count': x['count'], 'overdue': x['overdue']}
+            for x in self._db.todos.aggregate(pipeline)['result']
+        ]
+    
+    
+    # stored along with the blob id in the parse cache; must be incremented whenever the todos
+    # extracted from a file change, so entries from previous versions are not used
+    PARSE_CACHE_VERSION = 2
+    
+    def get_cached_todos(self, blob_ids, extractor_key=''):
+        '''
+        Returns the todos previously cached for the given blob ids (see cache_todos), as a dict
+        mapping blob id => todos. Blob ids not found in the cache are not included.
+        
+        :param extractor_key: identifies the configuration todos were extracted with (see 
+            ToDoExtractor.cache_key); todos cached with other configurations are not returned.
+        '''
+        keys = [self._make_cache_key(x, extractor_key) for x in blob_ids]
+        result = {}
+        for entry in self._db.parse_cache.find({'_id': {'$in': keys}}):
+            blob_id = entry['_id'].split(':')[0]
+            result[blob_id] = entry['todos']
+        return result
+    
+    
+    def cache_todos(self, todos_by_blob_id, extractor_key=''):
+        '''
+        Caches the todos parsed from files, given as a dict mapping blob id => todos.
+        '''
+        entries = [
+            {'_id': self._make_cache_key(blob_id, extractor_key), 'todos': todos}
+            for blob_id, todos in todos_by_blob_id.iteritems()
+        ]
+        if entries:
+            try:
+                self._db.parse_cache.insert(entries, continue_on_error=True, w=1)
+            except pymongo.errors.DuplicateKeyError:
+                pass  # cached concurrently by another fetch
+                
+                
+    @classmethod
+    def _make_cache_key(cls, blob_id, extractor_key):
+        return '%s:%d:%s' % (blob_id, cls.PARSE_CACHE_VERSION, extractor_key)
+    
+    
+    def get_last_hash(self, repo_name, branch=DEFAULT_BRANCH, scan_key=None):
+        '''
+        Returns the last hash fetched of a branch, or None if it was never fetched.
+        
+        :param scan_key: if given, None is also returned if the hash was fetched with another
+            extractor configuration (see ToDoExtractor.scan_key), so all files are scanned again.
+        '''
+        entry = self._db.hashes.find_one({'repo': repo_name, 'branch': branch})
+        if entry and (scan_key is None or entry.get('scan_key') == scan_key):
+            return entry.get('hash')
+        else:
+            return None
+        
+        
+    def set_last_hash(self, repo_name, hash_value, branch=DEFAULT_BRANCH, scan_key=None):
+        values = {'hash': hash_value}
+        if scan_key is not None:
+            values['scan_key'] = scan_key
+        self._db.hashes.update(
+            {'repo': repo_name, 'branch': branch}, 
+            {'$set': values, '$unset': {'checkpoint': True}}, 
+            upsert=True, 
+            w=1,
+        )
+        
+        
+    def get_last_hashes(self, repo_names, scan_key=None):
+        '''
+        Returns the last hashes fetched of all branches of the given repositories, as a dict 
+        mapping (repo name, branch) => hash. Branches whose last fetch didn't finish are left out,
+        as their todos aren't up-to-date with any hash yet (see get_checkpoint), and so are those
+        fetched with another `scan_key` (see get_last_hash).
+        '''
+        result = {}
+        for entry in self._db.hashes.find({'repo': {'$in': list(repo_names)}}):
+            if entry.get('hash') is not None and entry.get('checkpoint') is None and \
+                    (scan_key is None or entry.get('scan_key') == scan_key):
+                result[(entry['repo'], entry['branch'])] = entry['hash']
+        return result
+        
+        
+    def start_fetch_run(self, repos, costs=None):
+        '''
+        Registers the start of a fetch_all run over the given repositories, all of them in the 
+        'queued' state. Returns the id of the run.
+        
+        The repositories of the run are a queue of fetch jobs, drained by the fetch_all process 
+        and any number of workers (see claim_repo).
+        
+        :param costs: dict mapping repo name => estimated seconds to fetch it; the costliest 
+            repositories are claimed first.
+        '''
+        if costs is None:
+            costs = {}
+        run_id = self._db.fetch_runs.insert({
+            'started': datetime.datetime.today(),
+            'finished': None,
+            'repos': repos,
+        }, w=1)
+        if repos:
+            self._db.repo_states.insert(
+                [self._make_repo_state(run_id, x, costs.get(x, 0.0)) for x in repos], 
+                w=1,
+            )
+        return run_id
+    
+    
+    @classmethod
+    def _make_repo_state(cls, run_id, repo_name, cost=0.0):
+        return {
+            'run_id': run_id, 
+            'repo': repo_name, 
+            'state': 'queued', 
+            'error': None, 
+            'worker': None, 
+            'lease_expires': None, 
+            'attempts': 0,
+            'cost': cost,
+        }
+    
+    
+    def finish_fetch_run(self, run_id):
+        self._db.fetch_runs.update(
+            {'_id': run_id}, {'$set': {'finished': datetime.datetime.today()}}, w=1)
+    
+    
+    def get_unfinished_fetch_run(self):
+        '''
+        Returns (run_id, repos) of the last fetch_all run if it didn't finish, or None.
+        '''
+        for entry in self._db.fetch_runs.find().sort('started', pymongo.DESCENDING).limit(1):
+            if entry['finished'] is None:
+                return entry['_id'], entry['repos']
+        return None
+    
+    
+    def set_repo_state(self, run_id, repo_name, state, error=None, worker=None):
+        '''
+        Sets the state of a repository in a fetch_all run: 'queued', 'running', 'done' or 
+        'failed', the latter along with an error message.
+        
+        :param worker: if given, the state is only set if the repository is still claimed by this
+            worker (see claim_repo), and not by another worker since its lease expired.
+        :return: if the state was set.
+        '''
+        query = {'run_id': run_id, 'repo': repo_name}
+        if worker is not None:
+            query['worker'] = worker
+        result = self._db.repo_states.update(
+            query,
+            {'$set': {'state': state, 'error': error, 'date': datetime.datetime.today()}}, 
+            upsert=worker is None,
+            w=1,
+        )
+        return result['n'] > 0
+    
+    
+    def claim_repo(self, run_id, worker, lease_seconds, max_attempts):
+        '''
+        Atomically claims the next repository to fetch in a fetch_all run, so each repository is
+        fetched by a single worker at a time. Returns its name, or None if no repository is left
+        to claim.
+        
+        Queued repositories are claimed first, costliest first (see start_fetch_run), so the 
+        longest fetches don't end up as the tail of the run; then those whose lease expired, as 
+        their worker stopped renewing it (see renew_repo_lease), presumably because it died. 
+        Repositories claimed `max_attempts` times whose lease expired again are marked as failed
+        instead.
+        
+        :param worker: identifies the claiming worker, unique among all processes and threads.
+        :param lease_seconds: seconds the repository is claimed for, unless its lease is renewed.
+        '''
+        now = datetime.datetime.utcnow()
+        expired = {'run_id': run_id, 'state': 'running', 'lease_expires': {'$lt': now}}
+        
+        failed = dict(expired, attempts={'$gte': max_attempts})
+        self._db.repo_states.update(failed, {'$set': {
+            'state': 'failed', 
+            'error': 'Lease expired %d times' % max_attempts, 
+            'date': datetime.datetime.today(),
+        }}, multi=True, w=1)
+        
+        claimed = {'$set': {
+            'state': 'running', 
+            'worker': worker, 
+            'lease_expires': now + datetime.timedelta(seconds=lease_seconds),
+            'date': datetime.datetime.today(),
+        }, '$inc': {'attempts': 1}}
+        for query in [{'run_id': run_id, 'state': 'queued'}, expired]:
+            entry = self._db.repo_states.find_and_modify(query, claimed, 
+                sort=[('cost', pymongo.DESCENDING)], new=True)
+            if entry is not None:
+                return entry['repo']
+        return None
+    
+    
+    def renew_repo_lease(self, run_id, repo_name, worker, lease_seconds):
+        '''
+        Extends the lease of a repository claimed by the given worker (see claim_repo). Returns 
+        False if the repository is no longer claimed by the worker.
+        '''
+        lease_expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=lease_seconds)
+        result = self._db.repo_states.update(
+            {'run_id': run_id, 'repo': repo_name, 'state': 'running', 'worker': worker},
+            {'$set': {'lease_expires': lease_expires}},
+            w=1,
+        )
+        return result['n'] > 0
+    
+    
+    def lock_repo(self, repo_name, owner, lease_seconds):
+        '''
+        Atomically locks a repository for the given owner, unless another owner holds its lock 
+        and its lease didn't expire yet (see hold_repo_lock). Returns if the lock was taken.
+        '''
+        now = datetime.datetime.utcnow()
+        try:
+            # a lock held by another owner doesn't match, so the upsert fails on the duplicate id
+            self._db.repo_locks.update(
+                {'_id': repo_name, '$or': [{'owner': owner}, {'lease_expires': {'$lt': now}}]},
+                {'$set': {
+                    'owner': owner, 
+                    'lease_expires': now + datetime.timedelta(seconds=lease_seconds),
+                }},
+                upsert=True,
+                w=1,
+            )
+        except pymongo.errors.DuplicateKeyError:
+            return False
+        return True
+    
+    
+    def renew_repo_lock(self, repo_name, owner, lease_seconds):
+        '''
+        Extends the lease of a repository locked by the given owner (see lock_repo). Returns False
+        if the lock is no longer held by the owner.
+        '''
+        lease_expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=lease_seconds)
+        result = self._db.repo_locks.update(
+            {'_id': repo_name, 'owner': owner},
+            {'$set': {'lease_expires': lease_expires}},
+            w=1,
+        )
+        return result['n'] > 0
+    
+    
+    def unlock_repo(self, repo_name, owner):
+        self._db.repo_locks.remove({'_id': repo_name, 'owner': owner}, w=1)
+        
+        
+    def count_unfinished_repos(self, run_id):
+        '''
+        Returns the number of repositories of a fetch_all run still queued or running.
+        '''
+        return self._db.repo_states.find(
+            {'run_id': run_id, 'state': {'$in': ['queued', 'running']}}).count()
+    
+    
+    def requeue_repos(self, run_id, repos):
+        '''
+        Queues again the given repositories of a fetch_all run, unless they are claimed by a 
+        worker, so they are fetched again with a fresh number of attempts.
+        '''
+        # repositories left running by versions without leases are queued too
+        self._db.repo_states.update(
+            {'run_id': run_id, 'repo': {'$in': repos}, 
+                '$or': [{'state': {'$ne': 'running'}}, {'lease_expires': None}]},
+            {'$set': {'state': 'queued', 'error': None, 'worker': None, 'attempts': 0}},
+            multi=True,
+            w=1,
+        )
+        
+        
+    def get_repo_states(self, run_id=None):
+        '''
+        Returns the states of the repositories in a fetch_all run (the last one if not given), as
+        a dict mapping repo name => {'state', 'error', 'date', 'worker', 'attempts'}.
+        '''
+        if run_id is None:
+            for entry in self._db.fetch_runs.find().sort('started', pymongo.DESCENDING).limit(1):
+                run_id = entry['_id']
+        
+        result = {}
+        if run_id is not None:
+            for entry in self._db.repo_states.find({'run_id': run_id}):
+                result[entry['repo']] = {
+                    'state': entry['state'], 
+                    'error': entry['error'], 
+                    'date': entry.get('date'),
+                    'worker': entry.get('worker'),
+                    'attempts': entry.get('attempts', 0),
+                }
+        return result
+    
+    
+    def get_repo_schedules(self):
+        '''
+        Returns the schedules of all repositories checked by fetch_all (see schedule_repos), as a
+        dict mapping repo name => {'checked', 'changed', 'cost'}: the dates of the last check for
+        changes and of the last change found, and the seconds taken by the last fetch.
+        '''
+        result = {}
+        for entry in self._db.repo_schedules.find():
+            result[entry['repo']] = {
+                'checked': entry.get('checked'),
+                'changed': entry.get('changed'),
+                'cost': entry.get('cost', 0.0),
+            }
+        return result
+    
+    
+    def set_repo_schedule(self, repo_name, checked=None, changed=None, cost=None):
+        '''
+        Updates the given fields of the schedule of a repository (see get_repo_schedules).
+        '''
+        values = dict((k, v) for k, v in [('checked', checked), ('changed', changed), 
+            ('cost', cost)] if v is not None)
+        if values:
+            self._db.repo_schedules.update({'repo': repo_name}, {'$set': values}, upsert=True, 
+                w=1)
+
+
+    def set_last_fetch_all_status(self, date, elapsed):
+        entry = self._db.fetch_all_status.find_one()
+        if entry is None:
+            entry = {}
+        entry['date'] = date.strftime('%Y-%m-%d %H:%M:%S')
+        entry['elapsed'] = str(elapsed)
+        self._db.fetch_all_status.save(entry)
+        self.bump_generation()
+
+
+    def get_last_fetch_all_status(self):
+        entry = self._db.fetch_all_status.find_one()
+        if entry is not None:
+            return entry['date'], entry['elapsed']
+        else:
+            return None, None
+        
+        
+    def add_fetch_metrics(self, kind, started, elapsed, metrics, run_id=None):
+        '''
+        Adds the metrics of a fetch run to the history of runs. 
+        
+        :param kind: "fetch_all" or "fetch_single".
+        :param started: datetime the run started.
+        :param elapsed: seconds the run took.
+        :param metrics: the metrics collected, as given by FetchMetrics.to_dict.
+        :param run_id: id of the fetch_all run (see start_fetch_run).
+        '''
+        self._db.fetch_metrics.insert({
+            'kind': kind, 
+            'started': started, 
+            'elapsed': elapsed, 
+            'metrics': metrics,
+            'run_id': run_id,
+        }, w=1)
+        
+        
+    def get_fetch_metrics(self, kind=None, limit=10):
+        '''
+        Returns the metrics of the last `limit` runs of the given kind (all kinds if not given), 
+        from the most recent to the oldest, as given to add_fetch_metrics. Older runs are 
+        discarded automatically as the history grows.
+        '''
+        query = {}
+        if kind is not None:
+            query['kind'] = kind
+        # capped collections keep the insertion order
+        cursor = self._db.fetch_metrics.find(query, fields={'_id': False})
+        return list(cursor.sort('$natural', pymongo.DESCENDING).limit(limit))
+    
+    
+#===================================================================================================
+# IterToDos
+#===================================================================================================
+MARKER_KINDS = ['todo', 'comment', 'skip', 'xfail']
+
+DEFAULT_MARKER_KINDS = ['todo']
+
+DEFAULT_FILE_PATTERNS = ['test_*.py']
+
+class ToDoExtractor(object):
+    '''
+    Extracts markers of the given kinds from Python sources:
+    
+    * "todo": functions, methods and classes whose first decorator is a call to ToDo (possibly
+      qualified, as in "@markers.ToDo"), with its date and number of days;
+    * "comment": "# TODO" and "# FIXME" comments, named after the function or class they are in;
+    * "skip": functions, methods and classes decorated with pytest.mark.skip/skipif or unittest's
+      skip/skipIf/skipUnless, with their reason as text;
+    * "xfail": the same for pytest.mark.xfail.
+    
+    Each file is scanned in a single pass for all kinds: decorators are read from one parse of
+    the file (ast) and comments from one tokenization (tokenize), each done only if the file 
+    contains a word identifying markers of those kinds.
+    
+    Only files whose names match one of `file_patterns` are scanned (see matches_filename).
+    '''
+    
+    # words that files must contain to declare markers of each kind
+    _DECORATOR_WORDS = {'todo': 'ToDo', 'skip': 'skip', 'xfail': 'xfail'}
+    _COMMENT_WORDS = ['TODO', 'FIXME']
+    
+    def __init__(self, kinds=None, file_patterns=None):
+        if kinds is None:
+            kinds = DEFAULT_MARKER_KINDS
+        if file_patterns is None:
+            file_patterns = DEFAULT_FILE_PATTERNS
+        unknown = [x for x in kinds if x not in MARKER_KINDS]
+        if unknown:
+            raise ValueError('Unknown marker kinds: %s (expected %s)' % (
+                ', '.join(unknown), ', '.join(MARKER_KINDS)))
+        self.kinds = list(kinds)
+        self.file_patterns = list(file_patterns)
+        
+        
+    @classmethod
+    def from_config(cls, kinds_text, file_patterns_text):
+        '''
+        Creates an extractor from comma separated lists of kinds and file patterns.
+        '''
+        def split(text):
+            return [x.strip() for x in text.split(',') if x.strip()]
+        return cls(split(kinds_text), split(file_patterns_text))
+    
+    
+    @property
+    def marker_words(self):
+        '''
+        Words that lines must contain to declare markers of the kinds extracted.
+        '''
+        result = [self._DECORATOR_WORDS[x] for x in self.kinds if x in self._DECORATOR_WORDS]
+        if 'comment' in self.kinds:
+            result += self._COMMENT_WORDS
+        return result
+    
+    
+    @property
+    def cache_key(self):
+        '''
+        Identifies the kinds extracted, so todos cached by a configuration are not used by another
+        (see MongoStorage.get_cached_todos).
+        '''
+        return ','.join(sorted(self.kinds))
+    
+    
+    @property
+    def scan_key(self):
+        '''
+        Identifies the kinds extracted and the files scanned, stored with the last hash fetched of
+        each branch: branches fetched with another configuration are scanned again from scratch
+        (see MongoStorage.get_last_hash).
+        '''
+        return '%s;%s' % (self.cache_key, ','.join(sorted(self.file_patterns)))
+        
+        
+    def matches_filename(self, filename):
+        '''
+        Checks if a file should be scanned: fnmatch patterns are matched against its base name, or
+        against its full path if they contain "/".
+        '''
+        basename = os.path.basename(filename)
+        for pattern in self.file_patterns:
+            if fnmatch.fnmatch(filename if '/' in pattern else basename, pattern):
+                return True
+        return False
+    
+    
+    def extract(self, contents):
+        '''
+        Returns the list of todos in the given source, sorted by line (see IterToDos).
+        '''
+        decorator_kinds = [
+            x for x in self.kinds 
+            if x in self._DECORATOR_WORDS and self._DECORATOR_WORDS[x] in contents
+        ]
+        scan_comments = 'comment' in self.kinds and \
+            any(x in contents for x in self._COMMENT_WORDS)
+        
+        todos = []
+        if decorator_kinds:
+            todos += _ParseToDos(contents, decorator_kinds)
+        if scan_comments:
+            todos += _ScanComments(contents)
+            todos.sort(key=lambda x: x['lineno'])
+        return todos
+    
+    
+class _ToDoVisitor(ast.NodeVisitor):
+    '''
+    Collects the markers of the given kinds declared by decorators of functions and classes. 
+    Functions nested in functions are not visited.
+    '''
+
+    def __init__(self, kinds=DEFAULT_MARKER_KINDS):
+        self.kinds = kinds
+        self.todos = []
+    
+    
+    def visit_FunctionDef(self, function_def):
+        self.VisitDecorators(function_def)
+        
+        
+    def visit_ClassDef(self, class_def):
+        self.VisitDecorators(class_def)
+        self.generic_visit(class_def)
+        
+        
+    def VisitDecorators(self, node):
+        for index, decorator in enumerate(node.decorator_list):
+            name = _GetDottedName(decorator)
+            if name is None:
+                continue
+            name = name.split('.')[-1]
+            
+            if name == 'ToDo' and index == 0 and 'todo' in self.kinds:
+                if type(decorator) is ast.Call:
+                    date, days = self.GetDateAndDays(decorator)
+                    self.AddToDo('todo', node, date=date, days=days)
+            elif name in _SKIP_REASON_INDEXES and 'skip' in self.kinds:
+                self.AddToDo('skip', node, text=self.GetReason(decorator, name))
+            elif name == 'xfail' and 'xfail' in self.kinds:
+                self.AddToDo('xfail', node, text=self.GetReason(decorator, name))
+        
+        
+    def AddToDo(self, kind, node, date=None, days=None, text=None):
+        self.todos.append({
+            'kind': kind,
+            'function_name': node.name, 
+            'date': date, 
+            'days': days, 
+            'lineno': node.lineno,
+            'text': text,
+        })
+        
+        
+    def GetDateAndDays(self, call):
+        '''
+        Returns the date and days given to a ToDo call: ToDo((year, month, day), days=N). Values
+        that can't be evaluated, aren't a valid date or a whole number of days, or give a due date
+        out of range, are taken as missing.
+        '''
+        date = None
+        if call.args:
+            try:
+                date = datetime.datetime(*_SafeEval(call.args[0]))
+            except (TypeError, ValueError):
+                pass
+        
+        days = None
+        if date is not None:
+            days_nodes = [x.value for x in call.keywords if x.arg == 'days'] + call.args[1:2]
+            if days_nodes:
+                try:
+                    days = _SafeEval(days_nodes[0])
+                    if type(days) not in (int, long, float) or days != int(days):
+                        raise ValueError('days must be a whole number')
+                    days = int(days)
+                    date + datetime.timedelta(days=days)  # the due date must be valid
+                except (ValueError, OverflowError):
+                    days = None
+        return date, days
+    
+    
+    def GetReason(self, decorator, name):
+        '''
+        Returns the reason given to a skip or xfail decorator, if it's a string.
+        '''
+        if type(decorator) is not ast.Call:
+            return None
+        reason_nodes = [x.value for x in decorator.keywords if x.arg == 'reason']
+        index = _SKIP_REASON_INDEXES.get(name)
+        if index is not None:
+            reason_nodes += decorator.args[index:index + 1]
+        for node in reason_nodes:
+            try:
+                reason = _SafeEval(node)
+            except ValueError:
+                continue
+            if isinstance(reason, basestring):
+                return reason
+        return None
+    
+    
+# index of the positional argument with the reason of each skip decorator
+_SKIP_REASON_INDEXES = {'skip': 0, 'skipif': 1, 'skipIf': 1, 'skipUnless': 1}
+                
+                
+def _GetDottedName(node):
+    '''
+    Returns the dotted name of a decorator ("ToDo", "pytest.mark.skip"), or None if it's not a 
+    name or a call to one.
+    '''
+    if type(node) is ast.Call:
+        node = node.func
+    parts = []
+    while type(node) is ast.Attribute:
+        parts.append(node.attr)
+        node = node.value
+    if type(node) is not ast.Name:
+        return None
+    parts.append(node.id)
+    return '.'.join(reversed(parts))
+
+
+_SAFE_OPERATORS = {
+    ast.Add: lambda x, y: x + y,
+    ast.Sub: lambda x, y: x - y,
+    ast.Mult: lambda x, y: x * y,
+    ast.Div: lambda x, y: x / y,
+    ast.FloorDiv: lambda x, y: x // y,
+}
+
+def _SafeEval(node):
+    '''
+    Evaluates an expression made only of literals and arithmetic on numbers, as found in the 
+    arguments of markers ("days=7 * 4"), raising ValueError for anything else. Unlike eval, it
+    can't run code from the scanned files.
+    '''
+    if type(node) is ast.BinOp and type(node.op) in _SAFE_OPERATORS:
+        left = _SafeEval(node.left)
+        right = _SafeEval(node.right)
+        if not all(isinstance(x, (int, long, float)) for x in (left, right)):
+            raise ValueError('arithmetic is only supported on numbers')
+        try:
+            return _SAFE_OPERATORS[type(node.op)](left, right)
+        except ArithmeticError as e:
+            raise ValueError(str(e))
+    if type(node) is ast.UnaryOp and type(node.op) in (ast.UAdd, ast.USub):
+        value = _SafeEval(node.operand)
+        if not isinstance(value, (int, long, float)):
+            raise ValueError('arithmetic is only supported on numbers')
+        return -value if type(node.op) is ast.USub else value
+    if type(node) in (ast.Tuple, ast.List):
+        return tuple(_SafeEval(x) for x in node.elts)
+    return ast.literal_eval(node)
+                
+                
+_DEFAULT_EXTRACTOR = ToDoExtractor()
+
+def IterToDos(contents, extractor=None):
+    '''
+    Iterates over the todos declared in the given Python source: by default, functions and classes
+    whose first decorator is a call to ToDo(). Other kinds of markers are extracted if given an 
+    `extractor` (see ToDoExtractor). 
+    
+    Each todo is a dict with the "kind" of marker, the "function_name" and "lineno" of the 
+    function or class marked (or of the comment), the "date" and "days" of ToDo() and the "text" of 
+    comments and reasons of skips.
+    
+    Files that don't contain the words identifying the markers (such as "ToDo") can't declare any
+    todos, and are skipped without being parsed; this is the case of most files.
+    '''
+    if extractor is None:
+        extractor = _DEFAULT_EXTRACTOR
+    for x in extractor.extract(contents):
+        yield x
+        
+        
+def _ParseToDos(contents, kinds=DEFAULT_MARKER_KINDS):
+    '''
+    Returns the list of todos declared by decorators in the given source, parsing all of it.
+    '''
+    visitor = _ToDoVisitor(kinds)
+    try:
+        visitor.visit(ast.parse(contents))
+    except SyntaxError:
+        return []
+    return visitor.todos
+
+
+_COMMENT_RE = re.compile(r'#\s*(?:TODO|FIXME)\b[:\s]*(.*)')
+
+def _ScanComments(contents):
+    '''
+    Returns the "# TODO" and "# FIXME" comments in the given source, as todos of kind "comment"
+    named after the innermost function or class they are in (None at module level).
+    
+    Blocks are followed through the INDENT and DEDENT tokens, so there's no need to parse the 
+    source; tokenizing stops at the first error, keeping the comments found until then. Comments 
+    are tokenized before the DEDENT tokens that precede them, so the block of a comment is given
+    by its indentation instead.
+    '''
+    todos = []
+    scopes = []  # (depth, name, column of the body) of the enclosing blocks
+    depth = 0
+    header = None  # (name, column) of the block whose header is being read
+    pending = None  # block whose header was read, if its body didn't start yet
+    after_keyword = None  # column of a "def" or "class" keyword just read
+    try:
+        for token_type, text, (row, column), (_, end_column), _ in \
+                tokenize.generate_tokens(StringIO(contents).readline):
+            if token_type == tokenize.COMMENT:
+                match = _COMMENT_RE.match(text)
+                if match is not None:
+                    if header is not None:
+                        # comments in the header, or after a body on the header line
+                        function_name = header[0]
+                    elif pending is not None and column > pending[1]:
+                        # comments before the first statement of a block
+                        function_name = pending[0]
+                    else:
+                        enclosing = [x[1] for x in scopes if x[2] <= column]
+                        function_name = enclosing[-1] if enclosing else None
+                    todos.append({
+                        'kind': 'comment',
+                        'function_name': function_name,
+                        'date': None,
+                        'days': None,
+                        'lineno': row,
+                        'text': match.group(1).strip(),
+                    })
+                continue
+            if token_type == tokenize.NL:
+                continue
+            if token_type == tokenize.INDENT:
+                depth += 1
+                if pending is not None:
+                    scopes.append((depth, pending[0], end_column))
+                pending = None
+                continue
+            if token_type == tokenize.DEDENT:
+                depth -= 1
+                while scopes and scopes[-1][0] > depth:
+                    scopes.pop()
+            if token_type == tokenize.NEWLINE:
+                if header is not None:
+                    pending = header
+                header = None
+                continue
+            
+            # any other token ends a pending block (its body was on the header line)
+            pending = None
+            if token_type == tokenize.NAME:
+                if after_keyword is not None and header is None:
+                    header = (text, after_keyword)
+                after_keyword = column if text in ('def', 'class') else None
+    except (tokenize.TokenError, IndentationError):
+        pass
+    return todos
+
+
+# lines a marker's decorator may span (see shift_todos)
+_MAX_SPAN_LINES = 20
+
+
+#===================================================================================================
+# compute_blob_id
+#===================================================================================================
+def compute_blob_id(contents):
+    '''
+    Returns the id git gives to a blob with the given contents (the SHA-1 of a header plus the
+    contents), so the same contents have the same id in any repository.
+    '''
+    if isinstance(contents, unicode):
+        contents = contents.encode('utf-8')
+    return hashlib.sha1('blob %d\0%s' % (len(contents), contents)).hexdigest()
+
+
+#===================================================================================================
+# shift_todos
+#===================================================================================================
+def shift_todos(todos, hunks, extractor=None):
+    '''
+    Returns the todos of a file, as found before the changes given by `hunks` (see 
+    RepoSource.get_diff_hunks), moved to their lines after the changes; or None if the changes 
+    could affect the markers of the file, which then has to be scanned again.
+    
+    Changes can't affect markers if each line added or removed is blank, or:
+    
+    * contains no word identifying markers (see ToDoExtractor.marker_words), no decorator, no 
+      "def" or "class" and doesn't start a block;
+    * is complete by itself (see _GetLineTokens);
+    * keeps the blocks of the source (see _KeepsBlocks);
+    * doesn't follow a marker by _MAX_SPAN_LINES lines or less, as it could be in its decorator.
+    '''
+    if extractor is None:
+        extractor = _DEFAULT_EXTRACTOR
+    marker_linenos = [x['lineno'] for x in todos]
+    moves = []  # (line number before the changes, lines added or removed there)
+    for old_start, _new_start, lines in hunks:
+        old_lineno = old_start
+        previous = None  # last unchanged statement
+        run = []  # changed lines after it, with statements
+        for index, (tag, text) in enumerate(lines):
+            if tag == ' ':
+                if _IsStatement(text):
+                    previous = text
+                old_lineno += 1
+                continue
             
-            if todos:
-                stream.write('T')
-                summary[filename] = len(todos)
+            if text.strip():
+                tokens = _GetLineTokens(text)
+                if tokens is None or tokens[:1] == ['@'] or tokens[-1:] == [':'] or \
+                        'def' in tokens or 'class' in tokens or \
+                        any(x in text for x in extractor.marker_words):
+                    return None
+                if any(0 <= old_lineno - x <= _MAX_SPAN_LINES for x in marker_linenos):
+                    return None
+                run.append((tag, text))
+            if index + 1 == len(lines) or lines[index + 1][0] == ' ':
+                following = next((x for t, x in lines[index + 1:] if _IsStatement(x)), None)
+                if run and not _KeepsBlocks(run, previous, following):
+                    return None
+                run = []
+                
+            if tag == '-':
+                moves.append((old_lineno, -1))
+                old_lineno += 1
             else:
-                stream.write('.')
+                moves.append((old_lineno, 1))
+    
+    result = []
+    for todo in todos:
+        # lines added right before a todo move it, lines removed right before it were above it
+        shift = sum(
+            count for lineno, count in moves 
+            if lineno < todo['lineno'] or (lineno == todo['lineno'] and count > 0)
+        )
+        result.append(dict(todo, lineno=todo['lineno'] + shift))
+    return result
+
+
+def _IsStatement(line):
+    return bool(line.strip()) and not line.strip().startswith('#')
+
+
+def _GetIndent(line):
+    return line[:len(line) - len(line.lstrip())]
+
+
+def _KeepsBlocks(run, previous, following):
+    '''
+    Checks if the given lines, all of them added or removed between the unchanged statements 
+    `previous` and `following` (None if unknown), keep the blocks of the source, assuming the 
+    source was valid before the changes.
+    
+    The lines must be indented as `previous`, which must be complete, so they're statements of its
+    block; or, if `previous` starts a block, as its first statement, keeping at least one of them:
+    either `following` has that same indentation, or lines removed are replaced by lines added.
+    '''
+    previous_tokens = _GetLineTokens(previous) if previous is not None else None
+    if previous_tokens is None or previous_tokens[:1] == ['@']:
+        return False
+    indents = set(_GetIndent(x) for _, x in run)
+    if len(indents) != 1:
+        return False
+    indent = indents.pop()
+    
+    if previous_tokens[-1:] != [':']:
+        return indent == _GetIndent(previous)
+    if not indent.startswith(_GetIndent(previous)) or indent == _GetIndent(previous):
+        return False
+    if following is not None and _GetIndent(following) == indent:
+        return True
+    return set(x for x, _ in run) == set(['-', '+'])
+
+
+def _GetLineTokens(line):
+    '''
+    Returns the names and operators in a line of source, or None if the line isn't complete by 
+    itself: its brackets and strings must be closed in the same line, and it can't continue in the
+    next one.
+    '''
+    tokens = []
+    depth = 0
+    try:
+        for token_type, text, _, _, _ in \
+                tokenize.generate_tokens(StringIO(line.strip() + '\n').readline):
+            if token_type == tokenize.ERRORTOKEN:
+                return None  # unclosed string
+            if token_type not in (tokenize.OP, tokenize.NAME):
+                continue
+            tokens.append(text)
+            if text in ('(', '[', '{'):
+                depth += 1
+            elif text in (')', ']', '}'):
+                depth -= 1
+                if depth < 0:
+                    return None
+    except (tokenize.TokenError, IndentationError):
+        return None  # unclosed brackets or strings, or continued
+    return tokens
+    
+    
+#===================================================================================================
+# parse_files
+#===================================================================================================
+PARSE_BATCH_SIZE = 20
+
+def parse_files(files, storage, parse_executor=None, metrics=None, extractor=None):
+    '''
+    Returns the todos of each (filename, contents) pair given, as a list of (filename, todos) 
+    pairs, extracted by `extractor` (see ToDoExtractor; by default, only ToDo decorators). Files 
+    whose contents are None (missing) have no todos.
+    
+    Contents parsed before, by any repository, are not parsed again: their todos are taken from 
+    the parse cache in storage, looked up by blob id in a single query.
+    
+    If `parse_executor` is given (usually a process pool, since parsing is CPU bound and would be
+    serialized by the GIL in threads) the remaining contents are parsed by it, in batches of
+    PARSE_BATCH_SIZE files to amortize the cost of sending them to the workers.
+    
+    If `metrics` is given, the number of files found in the cache and parsed is recorded in it.
+    '''
+    if extractor is None:
+        extractor = _DEFAULT_EXTRACTOR
+    blob_ids = [compute_blob_id(contents) if contents is not None else None for _, contents in files]
+    cached = storage.get_cached_todos([x for x in blob_ids if x is not None], extractor.cache_key)
+    
+    to_parse = {}
+    for (_, contents), blob_id in itertools.izip(files, blob_ids):
+        if contents is not None and blob_id not in cached:
+            to_parse[blob_id] = contents
+    
+    parsed = {}
+    if to_parse:
+        blob_ids_to_parse = to_parse.keys()
+        batches = [
+            [to_parse[x] for x in blob_ids_to_parse[i:i + PARSE_BATCH_SIZE]]
+            for i in xrange(0, len(blob_ids_to_parse), PARSE_BATCH_SIZE)
+        ]
+        extractors = [extractor] * len(batches)
+        if parse_executor is not None:
+            parsed_batches = parse_executor.map(parse_contents_batch, batches, extractors)
+        else:
+            parsed_batches = itertools.imap(parse_contents_batch, batches, extractors)
+        todos_list = itertools.chain.from_iterable(parsed_batches)
+        parsed = dict(itertools.izip(blob_ids_to_parse, todos_list))
+    
+    result = []
+    for (filename, contents), blob_id in itertools.izip(files, blob_ids):
+        if contents is None:
+            todos = []
+        elif blob_id in cached:
+            todos = cached[blob_id]
+        else:
+            todos = parsed[blob_id]
+        result.append((filename, todos))
+        
+    storage.cache_todos(parsed, extractor.cache_key)
+    if metrics is not None:
+        hits = sum(1 for x in blob_ids if x in cached)
+        metrics.record_cache(hits, sum(1 for x in blob_ids if x in to_parse))
+    return result
+
 
-            storage.update_todos(repo_name, filename, todos)
+def parse_contents_batch(contents_list, extractor=None):
+    '''
+    Returns a list with the todos found in each of the given contents. Module level function, so
+    it can be called by process pool executors.
+    '''
+    return [list(IterToDos(x, extractor=extractor)) for x in contents_list]
+
+
+#===================================================================================================
+# hold_repo_lock
+#===================================================================================================
+# a repository stays locked this long unless its lock is renewed, so locks of fetches whose process
+# died are released
+REPO_LOCK_SECONDS = 120.0
+
+# seconds between attempts to lock a repository locked by another fetch
+REPO_LOCK_POLL_SECONDS = 1.0
+
+_repo_lock_ids = itertools.count()
+
+@contextmanager
+def hold_repo_lock(storage, repo_name, cancel):
+    '''
+    Context manager locking a repository in `storage` (see MongoStorage.lock_repo), so it's never
+    fetched by two threads or processes at the same time, which could make an older fetch set its
+    hash after a newer one. Waits while another fetch holds the lock.
+    
+    The lock is renewed by a separate thread while held. If it's lost, `cancel` is set, so the
+    fetch stops before storing anything else (see fetch); the wait also stops if it's set.
+    '''
+    owner = make_worker_id(next(_repo_lock_ids))
+    while not storage.lock_repo(repo_name, owner, REPO_LOCK_SECONDS):
+        if cancel.wait(REPO_LOCK_POLL_SECONDS):
+            raise FetchCancelled('Fetch of %s cancelled while waiting for its lock' % repo_name)
+    
+    stop_heartbeat = threading.Event()
+    def renew_lock():
+        while not stop_heartbeat.wait(REPO_LOCK_SECONDS / 3.0):
+            if not storage.renew_repo_lock(repo_name, owner, REPO_LOCK_SECONDS):
+                cancel.set()
+                break
+    heartbeat = threading.Thread(target=renew_lock, name='lock-%s' % repo_name)
+    heartbeat.daemon = True
+    heartbeat.start()
+    try:
+        yield
+    finally:
+        stop_heartbeat.set()
+        heartbeat.join()
+        storage.unlock_repo(repo_name, owner)
+
+
+#===================================================================================================
+# UpdateQueue
+#===================================================================================================
+class UpdateQueue(object):
+    '''
+    Queue of repositories to fetch, drained by a background thread calling 
+    `fetch_function(repo_name)` for each one.
+    
+    A repository is fetched only `coalesce_delay` seconds after it was pushed, and pushing a 
+    repository already waiting in the queue does nothing, so a burst of pushes to a repository 
+    results in a single fetch. Pushing a repository while it is being fetched queues it again, 
+    since the running fetch may have missed the new commits.
+    '''
+    
+    def __init__(self, fetch_function, coalesce_delay=2.0):
+        self._fetch_function = fetch_function
+        self._coalesce_delay = coalesce_delay
+        self._pending = collections.OrderedDict()  # repo_name => time it was pushed
+        self._condition = threading.Condition()
+        self._thread = None
+        
+        
+    def push(self, repo_name):
+        with self._condition:
+            if repo_name not in self._pending:
+                self._pending[repo_name] = time.time()
+                self._condition.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='UpdateQueue')
+                self._thread.daemon = True
+                self._thread.start()
+                
+                
+    def get_pending(self):
+        with self._condition:
+            return self._pending.keys()
+                
+                
+    def _pop(self):
+        '''
+        Waits until the oldest repository in the queue is due, returning it.
+        '''
+        with self._condition:
+            while True:
+                if self._pending:
+                    repo_name, pushed = next(self._pending.iteritems())
+                    remaining = pushed + self._coalesce_delay - time.time()
+                    if remaining <= 0:
+                        del self._pending[repo_name]
+                        return repo_name
+                    self._condition.wait(remaining)
+                else:
+                    self._condition.wait()
+                    
+                    
+    def _run(self):
+        while True:
+            repo_name = self._pop()
+            try:
+                self._fetch_function(repo_name)
+            except Exception:
+                logging.exception('Fetch of %s failed', repo_name)
+                
+                
+#===================================================================================================
+# fetch
+#===================================================================================================
+FETCH_CHUNK_SIZE = 200
+
+class FetchCancelled(Exception):
+    '''
+    Raised by fetch when its `cancel` event is set, before storing anything else.
+    '''
+    
+
+DEFAULT_DOWNLOAD_WORKERS = 16
+
+def fetch(repo_name, storage, stash, stream, download_executor=None, parse_executor=None,
+          branch_rules=None, metrics=None, progress=None, extractor=None, cancel=None, 
+          branches=None):
+    '''
+    Updates the ToDos of the given repository, scanning only the files changed since the last
+    hash fetched. Changed files whose diffs can't affect their markers aren't even downloaded: 
+    their todos are just moved to their new lines (see shift_todos).
+    
+    The branches scanned are given by `branch_rules` (see select_branches), by default only 
+    DEFAULT_BRANCH. A branch scanned for the first time starts from the todos of DEFAULT_BRANCH, 
+    scanning only the files that differ between both: files shared by the branches are neither 
+    downloaded nor parsed again.
+    
+    File contents are downloaded concurrently using `download_executor`, which should be shared
+    between repositories fetched at the same time so the number of simultaneous downloads against
+    the server is capped globally. If not given, a private executor is created for this fetch.
+    
+    Downloaded contents are parsed using `parse_executor` (see parse_files), while downloads of
+    the following files continue in the background. If not given, contents are parsed in the 
+    calling thread.
+    
+    Fetches of the same repository wait for each other, in this process or any other sharing
+    `storage` (see hold_repo_lock).
+    
+    The time spent in each stage of the fetch is recorded in `metrics` (see FetchMetrics), if 
+    given.
+    
+    Besides the text log written to `stream`, "file" and "branch" events are passed to `progress`
+    as the fetch advances, if given (see progress.ProgressEvents).
+    
+    The files scanned and the markers extracted from them are given by `extractor` (see 
+    ToDoExtractor); by default, ToDo decorators in test_*.py files.
+    
+    If `cancel` (a threading.Event) is set while fetching, FetchCancelled is raised before the 
+    next chunk of todos is stored, and the hash of the branch being fetched is left as it was. It's
+    also set if the lock of the repository is lost.
+    
+    `branches` are the branches of the repository, as returned by RepoSource.get_branches, if they
+    were already obtained.
+    '''
+    if download_executor is None:
+        with futures.ThreadPoolExecutor(max_workers=DEFAULT_DOWNLOAD_WORKERS) as executor:
+            return fetch(repo_name, storage, stash, stream, download_executor=executor, 
+                parse_executor=parse_executor, branch_rules=branch_rules, metrics=metrics,
+                progress=progress, extractor=extractor, cancel=cancel, branches=branches)
+        
+    if metrics is None:
+        metrics = FetchMetrics()
+    if progress is None:
+        progress = lambda event: None
+    if extractor is None:
+        extractor = _DEFAULT_EXTRACTOR
+    if cancel is None:
+        cancel = threading.Event()
+        
+    with hold_repo_lock(storage, repo_name, cancel):
+        with metrics.stage(repo_name, 'sync'):
+            stash.sync_repo(repo_name)
+        if branches is None:
+            with metrics.stage(repo_name, 'branches'):
+                branches = stash.get_branches(repo_name)
+        
+        branch_names = select_branches(repo_name, branches, branch_rules)
+        if not branch_names:
+            print >> stream, 'Skipping: no branch to scan'
+            print >> stream, 'Branches (%d):' % len(branches)
+            for branch in branches:
+                print >> stream, branch
+            return
+        
+        for branch in branch_names:
+            head = branches[BRANCH_REF_PREFIX + branch]
+            _fetch(repo_name, branch, head, storage, stash, stream, download_executor, 
+                parse_executor, metrics, progress, extractor, cancel)
+        
+        
+def _fetch(repo_name, branch, head, storage, stash, stream, download_executor, parse_executor,
+           metrics, progress, extractor, cancel):
+    def short(hash_name):
+        return hash_name[:7]
+    
+    def check_cancel():
+        if cancel.is_set():
+            raise FetchCancelled('Fetch of %s (%s) cancelled' % (repo_name, branch))
+    
+    start_time = time.time()
+    
+    # branches last fetched with another extractor configuration are scanned again from scratch
+    scan_key = extractor.scan_key
+    last_hash = storage.get_last_hash(repo_name, branch, scan_key)
+    if last_hash is None and branch != DEFAULT_BRANCH:
+        base_hash = storage.get_last_hash(repo_name, DEFAULT_BRANCH, scan_key)
+        # the todos of a branch are consistent with its hash only if its last fetch finished
+        if base_hash is not None and storage.get_checkpoint(repo_name, DEFAULT_BRANCH) is None:
+            print >> stream, 'Starting %s (%s) from %s at %s' % (repo_name, branch, 
+                DEFAULT_BRANCH, short(base_hash))
+            with metrics.stage(repo_name, 'storage'):
+                storage.copy_branch_todos(repo_name, DEFAULT_BRANCH, branch, base_hash, scan_key)
+            last_hash = base_hash
+    
+    checkpoint = storage.get_checkpoint(repo_name, branch)
+    if checkpoint is not None and checkpoint['since'] == last_hash and \
+            checkpoint.get('scan_key') == scan_key:
+        # resume an interrupted fetch towards the same hash it was fetching, even if the branch
+        # moved since then: the next fetch picks up from there
+        until = checkpoint['until']
+        skip = checkpoint['count']
+    else:
+        until = head
+        skip = 0
+    
+    if last_hash == until:
+        print >> stream, 'ToDos up-to-date (%s against %s)' % (branch, short(until))
+    else:
+        since = last_hash
+        if since:
+            print >> stream, 'Fetching %s (%s) %s..%s' % (repo_name, branch, short(since), 
+                short(until))
+            listing = stash.iter_file_names(repo_name, since=since, until=until)
+        else:
+            print >> stream, 'Fetching %s ALL (%s at %s)' % (repo_name, branch, short(until))
+            listing = stash.iter_file_names(repo_name, at=until)
+            if not skip:
+                # todos left from a fetch with another configuration may be of files not scanned
+                with metrics.stage(repo_name, 'storage'):
+                    storage.drop_branch_todos(repo_name, branch)
+        
+        # the listing is consumed as it arrives, so downloads start before it finishes; the time 
+        # spent waiting for it is recorded as the listing stage
+        counts = {'changed': 0, 'test': 0, 'shifted': 0}
+        listing = iter(listing)
+        
+        # test files whose changes can't affect their markers aren't downloaded: their todos are
+        # moved to their new lines instead (see shift_todos), or left as they are if they didn't
+        # move (None). Diffs are requested once the first test file is found.
+        shifted = {}
+        diff = {}
+        def shift_file_todos(filename):
+            if not diff:
+                with metrics.stage(repo_name, 'diff'):
+                    try:
+                        diff['hunks'] = stash.get_diff_hunks(repo_name, since, until)
+                    except (RuntimeError, requests.RequestException, ValueError) as e:
+                        # the diff only saves downloads: all files are downloaded without it
+                        print >> stream, 'Diff not available: %s' % e
+                        diff['hunks'] = {}
+                    diff['todos'] = storage.get_file_todos(repo_name, 
+                        [x for x in diff['hunks'] if extractor.matches_filename(x)], branch)
+            if filename in diff['hunks']:
+                todos = diff['todos'][filename]
+                new_todos = shift_todos(todos, diff['hunks'][filename], extractor)
+                if new_todos is not None:
+                    shifted[filename] = new_todos if new_todos != todos else None
+                    counts['shifted'] += 1
+        
+        def iter_test_filenames():
+            while True:
+                with metrics.stage(repo_name, 'listing'):
+                    filename = next(listing, None)
+                if filename is None:
+                    break
+                counts['changed'] += 1
+                if extractor.matches_filename(filename):
+                    counts['test'] += 1
+                    if since:
+                        shift_file_todos(filename)
+                    yield filename
+                
+        filenames = iter_test_filenames()
+        if skip:
+            # listings are always returned in the same order, so the files processed before the
+            # fetch was interrupted are the first ones
+            print >> stream, 'Resuming after %d files' % skip
+            filenames = itertools.islice(filenames, skip, None)
+        
+        # contents are yielded in the same order as filenames, so storage is updated in order
+        # while downloads happen concurrently
+        filenames, filenames_to_download = itertools.tee(filenames)
+        downloads = stash.iter_files_contents(repo_name, 
+            (x for x in filenames_to_download if x not in shifted), until, download_executor)
+        def iter_files():
+            for filename in filenames:
+                if filename in shifted:
+                    yield filename, None
+                else:
+                    yield filename, next(downloads)
+        
+        summary = {}
+        files = iter_files()
+        done = skip
+        while True:
+            # files are parsed and stored in chunks, so parse cache lookups and storage writes are
+            # done in batches; after each chunk is stored, a checkpoint allows resuming from it
+            with metrics.stage(repo_name, 'download'):
+                chunk = list(itertools.islice(files, FETCH_CHUNK_SIZE))
+            if not chunk:
+                break
+            
+            with metrics.stage(repo_name, 'parse'):
+                parsed = iter(parse_files([x for x in chunk if x[0] not in shifted], storage, 
+                    parse_executor, metrics, extractor))
+            results = []
+            for filename, _ in chunk:
+                if filename not in shifted:
+                    _, todos = next(parsed)
+                    results.append((filename, todos))
+                elif shifted[filename] is not None:
+                    todos = shifted[filename]
+                    results.append((filename, todos))
+                else:
+                    todos = diff['todos'][filename]
+                if todos:
+                    stream.write('T')
+                    summary[filename] = len(todos)
+                else:
+                    stream.write('.')
+                done += 1
+                progress({'type': 'file', 'repo': repo_name, 'branch': branch, 
+                    'filename': filename, 'todos': len(todos), 'done': done})
+    
+            checkpoint = {'since': since, 'until': until, 'count': done, 'scan_key': scan_key}
+            check_cancel()
+            with metrics.stage(repo_name, 'storage'):
+                storage.update_repo_todos(repo_name, results, checkpoint=checkpoint, 
+                    branch=branch)
                 
-        storage.set_last_hash(repo_name, master)
+        check_cancel()
+        with metrics.stage(repo_name, 'storage'):
+            storage.update_repo_todos(repo_name, [], hash_value=until, branch=branch, 
+                scan_key=scan_key)
+        
+        seconds = time.time() - start_time
+        progress({'type': 'branch', 'repo': repo_name, 'branch': branch, 
+            'changed': counts['changed'], 'test': counts['test'], 
+            'todos': sum(summary.itervalues()), 'seconds': seconds})
         
         print >> stream
-        print >> stream, '  Summary for %s (took %.2f seconds) ---' % (repo_name, time.time()-start_time)
+        print >> stream, 'Changed Files: %d' % counts['changed']
+        print >> stream, 'Test Files: %d' % counts['test']
+        if counts['shifted']:
+            print >> stream, 'Test Files Not Downloaded: %d' % counts['shifted']
+        print >> stream, '  Summary for %s (%s) (took %.2f seconds) ---' % (repo_name, branch, 
+            seconds)
+        stage_times = sorted(metrics.get_stage_times(repo_name).iteritems())
+        print >> stream, '  Stages: %s' % ', '.join('%s %.2fs' % x for x in stage_times)
         print >> stream, '  ToDos: %d' % sum(summary.itervalues())
         if summary:
             for filename, count in summary.iteritems(): 
                 print >> stream, '  -', filename, count        
                 
         
+#===================================================================================================
+# schedule_repos
+#===================================================================================================
+# repositories are checked again after this fraction of the time they had been idle...
+SCHEDULE_IDLE_FACTOR = 0.1
+
+# ... but at least this often
+SCHEDULE_MAX_INTERVAL = datetime.timedelta(days=1)
+
+def is_repo_due(schedule, now):
+    '''
+    Returns if a repository should be checked for changes at `now`, given its schedule (see 
+    MongoStorage.get_repo_schedules), or None if it was never checked.
+    
+    Repositories are checked again after SCHEDULE_IDLE_FACTOR of the time they had been idle when
+    last checked, up to SCHEDULE_MAX_INTERVAL: repositories changed recently are checked on every 
+    run, while those untouched for weeks are checked about once a day.
+    '''
+    if schedule is None or schedule['checked'] is None or schedule['changed'] is None:
+        return True
+    idle_seconds = (schedule['checked'] - schedule['changed']).total_seconds()
+    interval = datetime.timedelta(seconds=max(idle_seconds, 0.0) * SCHEDULE_IDLE_FACTOR)
+    return now - schedule['checked'] >= min(interval, SCHEDULE_MAX_INTERVAL)
+
+
+def schedule_repos(storage, stash, repos, executor, stream, branch_rules=None, now=None,
+                   extractor=None):
+    '''
+    Returns the repositories out of `repos` to fetch in a fetch_all run, costliest first, along 
+    with a dict mapping each of them to its cost: the seconds taken by its last fetch, and a dict
+    mapping each of them to the branches obtained while checking it, if any, so fetch doesn't 
+    obtain them again.
+    
+    Only repositories due for a check (see is_repo_due) are checked, and only those whose heads 
+    of the branches to scan (see select_branches) moved since their last fetch are returned. Heads 
+    are obtained for each project at once (see RepoSource.get_project_branches), using 
+    `executor` to check many repositories concurrently. The dates checked and changed of the 
+    schedule of each repository are updated. Branches last fetched with another configuration of 
+    `extractor` count as moved, but only once their repository is due.
+    '''
+    if now is None:
+        now = datetime.datetime.today()
+    if extractor is None:
+        extractor = _DEFAULT_EXTRACTOR
+    schedules = storage.get_repo_schedules()
+    due = [x for x in repos if is_repo_due(schedules.get(x), now)]
+    
+    slugs_by_project = collections.OrderedDict()
+    for repo_name in due:
+        project, slug = RepoSource.split_repo_name(repo_name)
+        slugs_by_project.setdefault(project, []).append(slug)
+    # projects are checked one after another, each one checking its repositories concurrently:
+    # checking projects concurrently too could exhaust the executor with tasks waiting for others
+    branches_by_project = [
+        stash.get_project_branches(project, slugs, executor)
+        for project, slugs in slugs_by_project.iteritems()
+    ]
+    
+    last_hashes = storage.get_last_hashes(due, extractor.scan_key)
+    changed = []
+    known_branches = {}
+    for project, branches_by_slug in itertools.izip(slugs_by_project, branches_by_project):
+        for slug, branches in branches_by_slug.iteritems():
+            repo_name = '%s/%s' % (project, slug)
+            if branches is not None:
+                heads = [
+                    (x, branches[BRANCH_REF_PREFIX + x]) 
+                    for x in select_branches(repo_name, branches, branch_rules)
+                ]
+                if all(last_hashes.get((repo_name, x)) == head for x, head in heads):
+                    storage.set_repo_schedule(repo_name, checked=now)
+                    continue
+                known_branches[repo_name] = branches
+            # branches that couldn't be checked are fetched, which reports why
+            storage.set_repo_schedule(repo_name, checked=now, changed=now)
+            changed.append(repo_name)
+    
+    print >> stream, '=== Checked %d of %d repos: %d changed ===' % (len(due), len(repos), 
+        len(changed))
+    costs = dict((x, schedules.get(x, {}).get('cost', 0.0)) for x in changed)
+    changed.sort(key=lambda x: costs[x], reverse=True)
+    return changed, costs, known_branches
+    
+    
 #===================================================================================================
 # fetch_all
 #===================================================================================================
-def fetch_all(git_repo_url, search_projects, auth=None, stream=sys.stdout):
-    storage, stash = _init_fetch(git_repo_url, auth)
+FETCH_ALL_WORKERS = 8
+
+# slugs of repositories never scanned, in any project
+EXCLUDED_SLUGS = frozenset(['etk'])
+
+def fetch_all(git_repo_url, search_projects, auth=None, stream=sys.stdout,
+              download_workers=DEFAULT_DOWNLOAD_WORKERS, parse_workers=0, mirrors_dir=None, 
+              clone_url_format=None, branch_rules=None, rate_limits=None, 
+              repo_workers=FETCH_ALL_WORKERS, progress=None, extractor=None, check_all=False):
+    '''
+    Fetches all repositories of the given projects, `repo_workers` repositories at a time.
+    
+    Only repositories that changed since they were last fetched are fetched, checking those that
+    change often on every run and the others more rarely (see schedule_repos); with `check_all`,
+    every repository is fetched instead. The repositories whose fetches took longest are fetched
+    first.
+    
+    Files of all repositories are downloaded by a pool of `download_workers` threads, and parsed
+    by a pool of `parse_workers` processes. If `parse_workers` is 0, files are parsed by the 
+    threads fetching each repository instead.
+    
+    If `mirrors_dir` is given, repositories are read from local mirrors instead of the Stash api
+    (see GitMirrorSource). Requests to the Stash api adapt to its load and are limited by 
+    `rate_limits` (see StashServer).
+    
+    The branches fetched in each repository are given by `branch_rules` (see select_branches), and
+    the markers extracted from their files by `extractor` (see ToDoExtractor).
+    
+    The progress of each run is stored (see MongoStorage.start_fetch_run): if the previous run 
+    didn't finish, this run resumes it, fetching only the repositories not fetched yet.
+    
+    The log of each repository is written to `stream` as it is produced, each line prefixed by the
+    name of the repository. Progress events are passed to `progress`, if given (see 
+    progress.ProgressEvents).
+    
+    This is a generator, which yields each time a repository is fetched.
+    '''
+    if progress is None:
+        progress = lambda event: None
+    
+    # lines of the repositories fetched concurrently are written whole, so they don't mix
+    stream_lock = threading.Lock()
+    run_stream = _LineStream(stream, stream_lock)
+    
+    # the sessions pool must be large enough to serve both downloads and listings of each repo
+    metrics = FetchMetrics()
+    storage, stash = _init_fetch(git_repo_url, auth, pool_size=download_workers + repo_workers,
+        mirrors_dir=mirrors_dir, clone_url_format=clone_url_format, rate_limits=rate_limits, 
+        metrics=metrics)
+    started = datetime.datetime.today()
     start_time = time.time()
     
-    exclude = set(['etk'])
-    repos = []
-    for project in search_projects:
-        repos += ['{}/{}'.format(project, slug) for slug in stash.iter_repos(project) if slug not in exclude]
+    known_branches = {}
+    unfinished_run = storage.get_unfinished_fetch_run()
+    if unfinished_run is not None:
+        run_id, all_repos = unfinished_run
+        states = storage.get_repo_states(run_id)
+        repos = [x for x in all_repos if states.get(x, {}).get('state') != 'done']
+        storage.requeue_repos(run_id, repos)
+        print >> run_stream, '=== Resuming unfinished run (%d of %d repos left) ===' % (
+            len(repos), len(all_repos))
+    else:
+        repos = []
+        # repositories of all projects are listed and checked concurrently
+        with futures.ThreadPoolExecutor(max_workers=repo_workers) as executor:
+            slugs_by_project = executor.map(lambda x: list(stash.iter_repos(x)), search_projects)
+            for project, slugs in itertools.izip(search_projects, slugs_by_project):
+                repos += ['{}/{}'.format(project, slug) for slug in slugs 
+                    if slug not in EXCLUDED_SLUGS]
+            if check_all:
+                schedules = storage.get_repo_schedules()
+                costs = dict((x, schedules.get(x, {}).get('cost', 0.0)) for x in repos)
+            else:
+                repos, costs, known_branches = schedule_repos(storage, stash, repos, executor, 
+                    run_stream, branch_rules, extractor=extractor)
+        run_id = storage.start_fetch_run(repos, costs)
     
-    with futures.ThreadPoolExecutor(max_workers=8) as executor:
-        
-        # submit fetch jobs for each repo, creating a mapping future => (repo_name, sub_stream)
-        future_to_repo = {}
-        for repo_name in repos:
-            sub_stream = StringIO()
-            future = executor.submit(fetch, repo_name, storage, stash, sub_stream)
-            future_to_repo[future] = (repo_name, sub_stream)
+    # repositories are claimed from the queue of the run, shared with the workers of other 
+    # processes (see run_worker); those fetched here are reported as soon as they finish
+    finished = Queue.Queue()
+    with _fetch_run_workers(storage, stash, run_id, stream, stream_lock, metrics, progress, 
+                            lambda *args: finished.put(args), download_workers, parse_workers, 
+                            repo_workers, branch_rules, extractor, known_branches) as drainers:
         
-        # as fetches get gone, print its status along with sub-stream contents
-        for index, future in enumerate(futures.as_completed(future_to_repo)):
+        # as fetches get done, report their status
+        finished_repos = _iter_finished_repos(storage, run_id, repos, finished, drainers)
+        for index, (repo_name, state) in enumerate(finished_repos):
             percent = int(((index + 1.0) / len(repos)) * 100.0)
-            repo_name, sub_stream = future_to_repo[future]
-            print >> stream, '=== Fetched %s (%d of %d: %d%%) ===' % (repo_name, index + 1, len(repos), percent)
-            print >> stream, sub_stream.getvalue()
+            print >> run_stream, '=== Fetched %s (%d of %d: %d%%) ===' % (repo_name, index + 1, 
+                len(repos), percent)
+            progress({'type': 'repo', 'repo': repo_name, 'state': state, 
+                'index': index + 1, 'total': len(repos), 'percent': percent, 
+                'stages': metrics.get_stage_times(repo_name)})
             yield 
     
-    print >> stream
+    print >> run_stream
     total_seconds = time.time()-start_time
-    print >> stream, 'Total Time:', total_seconds
+    print >> run_stream, 'Total Time:', total_seconds
+    fetched_by = collections.Counter(
+        x['worker'].rsplit(':', 1)[0] for x in storage.get_repo_states(run_id).itervalues() 
+        if x['worker'] is not None and x['state'] == 'done')
+    if fetched_by:
+        print >> run_stream, 'Fetched by: %s' % ', '.join(
+            '%s (%d)' % x for x in sorted(fetched_by.iteritems()))
+    progress({'type': 'done', 'repos': len(repos), 'seconds': total_seconds})
     storage.set_last_fetch_all_status(datetime.datetime.today(), datetime.timedelta(seconds=total_seconds))
+    storage.add_fetch_metrics('fetch_all', started, total_seconds, metrics.to_dict(), run_id=run_id)
+    storage.finish_fetch_run(run_id)
+    
+    
+def _iter_finished_repos(storage, run_id, repos, finished, drainers):
+    '''
+    Iterates over (repo_name, state) as the given repositories of a fetch_all run are fetched: 
+    by this process, as reported to the `finished` queue, or by workers of other processes, as 
+    found polling the states of the run.
+    
+    :param drainers: futures of the threads draining the queue of the run in this process, which
+        only finish once no repository of the run is left queued or running.
+    '''
+    pending = set(repos)
+    last_poll = time.time()
+    while pending:
+        drained = all(x.done() for x in drainers)
+        for drainer in drainers:
+            if drainer.done():
+                drainer.result()  # raises the errors of the thread
+        
+        try:
+            results = [finished.get(block=not drained, timeout=FETCH_POLL_SECONDS)]
+        except Queue.Empty:
+            results = []
+        if not results or time.time() - last_poll >= FETCH_POLL_SECONDS:
+            last_poll = time.time()
+            states = storage.get_repo_states(run_id)
+            results += [
+                (x, states[x]['state']) for x in pending 
+                if states.get(x, {}).get('state') in ('done', 'failed')
+            ]
+            
+        for repo_name, state in results:
+            if repo_name in pending:
+                pending.remove(repo_name)
+                yield repo_name, state
+        if drained and finished.empty():
+            break
     
     
+#===================================================================================================
+# drain_fetch_queue
+#===================================================================================================
+# a claimed repository is fetched again by another worker if its lease isn't renewed for this 
+# long, which happens when its worker dies; repositories whose lease expires this many times fail
+FETCH_LEASE_SECONDS = 120.0
+FETCH_MAX_ATTEMPTS = 3
+
+# seconds between polls of the queue, while other workers fetch its last repositories
+FETCH_POLL_SECONDS = 5.0
+
+def drain_fetch_queue(storage, run_id, worker, fetch_repo, on_finished=None):
+    '''
+    Claims and fetches repositories of a fetch_all run (see MongoStorage.claim_repo), one at a 
+    time, until none of them is left queued or running.
+    
+    While other workers fetch the last repositories of the run, the queue is polled so their 
+    repositories are fetched again if their leases expire. The lease of the repository being 
+    fetched is renewed by a separate thread, so it doesn't expire while the fetch is running.
+    
+    :param worker: identifies this worker (see make_worker_id).
+    :param fetch_repo: called with the name of each repository and an event, set if its lease is
+        lost (see fetch's `cancel`), to fetch it, raising an error if the fetch fails.
+    :param on_finished: called with the name and final state ("done" or "failed") of each 
+        repository fetched, unless another worker claimed it meanwhile.
+    '''
+    while True:
+        repo_name = storage.claim_repo(run_id, worker, FETCH_LEASE_SECONDS, FETCH_MAX_ATTEMPTS)
+        if repo_name is None:
+            if storage.count_unfinished_repos(run_id) == 0:
+                return
+            time.sleep(FETCH_POLL_SECONDS)
+            continue
+        
+        # once the lease is lost, another worker may claim the repository: the fetch is cancelled
+        # so both don't store todos of the same repository
+        stop_heartbeat = threading.Event()
+        cancel = threading.Event()
+        def renew_lease():
+            while not stop_heartbeat.wait(FETCH_LEASE_SECONDS / 3.0):
+                if not storage.renew_repo_lease(run_id, repo_name, worker, FETCH_LEASE_SECONDS):
+                    cancel.set()
+                    break
+        heartbeat = threading.Thread(target=renew_lease, name='heartbeat-%s' % repo_name)
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            fetch_repo(repo_name, cancel)
+        except Exception as e:
+            state, error = 'failed', str(e)
+        else:
+            state, error = 'done', None
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+            
+        # the state isn't set if the lease expired and another worker claimed the repository
+        if storage.set_repo_state(run_id, repo_name, state, error=error, worker=worker):
+            if on_finished is not None:
+                on_finished(repo_name, state)
+                
+                
+def make_worker_id(index):
+    '''
+    Returns an id for the worker thread of the given index in this process, unique among all 
+    processes and machines fetching repositories.
+    '''
+    return '%s:%d:%d' % (socket.gethostname(), os.getpid(), index)
+
+
+@contextmanager
+def _fetch_run_workers(storage, stash, run_id, stream, stream_lock, metrics, progress, 
+                       on_finished, download_workers, parse_workers, repo_workers, branch_rules, 
+                       extractor, known_branches=None):
+    '''
+    Context manager draining the queue of a fetch_all run with `repo_workers` threads (see 
+    drain_fetch_queue), returning their futures. Exits once all of them finish.
+    
+    Repositories in `known_branches` (see schedule_repos) are fetched at the heads given there, 
+    instead of obtaining them again.
+    
+    Files of all repositories are downloaded by a pool of `download_workers` threads, and parsed
+    by a pool of `parse_workers` processes (or by the fetching threads, if 0). The log of each
+    repository is written to `stream`, each line prefixed by its name.
+    '''
+    if known_branches is None:
+        known_branches = {}
+        
+    def fetch_repo(repo_name, cancel):
+        repo_stream = _LineStream(stream, stream_lock, prefix='[%s] ' % repo_name)
+        try:
+            start_time = time.time()
+            fetch(repo_name, storage, stash, repo_stream, download_executor, parse_executor, 
+                branch_rules, metrics, progress, extractor, cancel, 
+                known_branches.pop(repo_name, None))
+            # the cost orders the fetches of the next runs (see schedule_repos)
+            storage.set_repo_schedule(repo_name, cost=time.time() - start_time)
+        except Exception as e:
+            print >> repo_stream
+            print >> repo_stream, 'ERROR:', e
+            progress({'type': 'error', 'repo': repo_name, 'message': str(e)})
+            raise
+        finally:
+            repo_stream.flush()
+    
+    # downloads of all repos share the same executor, capping the total number of concurrent
+    # requests made to the server
+    download_executor = futures.ThreadPoolExecutor(max_workers=download_workers)
+    with download_executor, _parse_executor(parse_workers) as parse_executor, \
+            futures.ThreadPoolExecutor(max_workers=repo_workers) as executor:
+        yield [
+            executor.submit(drain_fetch_queue, storage, run_id, make_worker_id(index), 
+                fetch_repo, on_finished)
+            for index in xrange(repo_workers)
+        ]
+    
+    
+#===================================================================================================
+# run_worker
+#===================================================================================================
+def run_worker(git_repo_url, auth=None, stream=sys.stdout, 
+               download_workers=DEFAULT_DOWNLOAD_WORKERS, parse_workers=0, mirrors_dir=None, 
+               clone_url_format=None, branch_rules=None, rate_limits=None, 
+               repo_workers=FETCH_ALL_WORKERS, extractor=None, idle_timeout=None):
+    '''
+    Runs a fetch worker, which helps fetch_all fetch its repositories: whenever a fetch_all run 
+    is unfinished, repositories are claimed from its queue and fetched, `repo_workers` at a time,
+    alongside the fetch_all process and any number of other workers, on this or other machines. 
+    fetch_all aggregates the results of all workers once the queue is drained. 
+    
+    The options are the same as fetch_all's. The metrics of each run drained are stored as a 
+    "fetch_worker" run (see MongoStorage.add_fetch_metrics).
+    
+    :param idle_timeout: if given, the worker returns after waiting this many seconds without 
+        finding repositories to fetch; by default, it runs forever.
+    '''
+    stream_lock = threading.Lock()
+    run_stream = _LineStream(stream, stream_lock)
+    metrics = FetchMetrics()
+    storage, stash = _init_fetch(git_repo_url, auth, pool_size=download_workers + repo_workers, 
+        mirrors_dir=mirrors_dir, clone_url_format=clone_url_format, rate_limits=rate_limits, 
+        metrics=metrics)
+    idle_since = time.time()
+    while True:
+        unfinished_run = storage.get_unfinished_fetch_run()
+        if unfinished_run is None or storage.count_unfinished_repos(unfinished_run[0]) == 0:
+            if idle_timeout is not None and time.time() - idle_since >= idle_timeout:
+                return
+            time.sleep(FETCH_POLL_SECONDS)
+            continue
+        
+        run_id, _ = unfinished_run
+        print >> run_stream, '=== Fetching repositories of run %s ===' % run_id
+        metrics.reset()
+        started = datetime.datetime.today()
+        start_time = time.time()
+        fetched = []
+        with _fetch_run_workers(storage, stash, run_id, stream, stream_lock, metrics, 
+                                lambda event: None, lambda *args: fetched.append(args),
+                                download_workers, parse_workers, repo_workers, branch_rules, 
+                                extractor) as drainers:
+            for drainer in drainers:
+                drainer.result()
+        
+        total_seconds = time.time() - start_time
+        print >> run_stream, '=== Fetched %d repositories of run %s in %.2f seconds ===' % (
+            len(fetched), run_id, total_seconds)
+        storage.add_fetch_metrics('fetch_worker', started, total_seconds, metrics.to_dict(), 
+            run_id=run_id)
+        idle_since = time.time()
+        
+        
+#===================================================================================================
+# _LineStream
+#===================================================================================================
+class _LineStream(object):
+    '''
+    File-like object that writes whole lines to `stream`, each prefixed by `prefix`, holding `lock`
+    while writing so lines written concurrently by other _LineStreams don't mix. Text is buffered 
+    only until the end of each line.
+    '''
+    
+    def __init__(self, stream, lock, prefix=''):
+        self._stream = stream
+        self._lock = lock
+        self._prefix = prefix
+        self._buffer = []
+        
+        
+    def write(self, text):
+        lines = text.split('\n')
+        if len(lines) == 1:
+            self._buffer.append(text)
+            return
+        self._buffer.append(lines[0])
+        lines[0] = ''.join(self._buffer)
+        self._buffer = [lines[-1]] if lines[-1] else []
+        with self._lock:
+            self._stream.write(''.join(self._prefix + x + '\n' for x in lines[:-1]))
+            
+            
+    def flush(self):
+        '''
+        Writes the last line, if not finished.
+        '''
+        if self._buffer:
+            self.write('\n')
+        
+        
 #===================================================================================================
 # fetch_single
 #===================================================================================================
-def fetch_single(git_repo_url, repo_name, auth=None, stream=sys.stdout):    
-    storage, stash = _init_fetch(git_repo_url, auth)
+def fetch_single(git_repo_url, repo_name, auth=None, stream=sys.stdout,
+                 download_workers=DEFAULT_DOWNLOAD_WORKERS, parse_workers=0, mirrors_dir=None,
+                 clone_url_format=None, branch_rules=None, rate_limits=None, extractor=None):
+    metrics = FetchMetrics()
+    storage, stash = _init_fetch(git_repo_url, auth, pool_size=download_workers, 
+        mirrors_dir=mirrors_dir, clone_url_format=clone_url_format, rate_limits=rate_limits, 
+        metrics=metrics)
+    started = datetime.datetime.today()
+    start_time = time.time()
     print >> stream, '=== Fetching %s ===' % (repo_name)
-    fetch(repo_name, storage, stash, stream)
+    download_executor = futures.ThreadPoolExecutor(max_workers=download_workers)
+    with download_executor, _parse_executor(parse_workers) as parse_executor:
+        fetch(repo_name, storage, stash, stream, download_executor, parse_executor, 
+            branch_rules, metrics, extractor=extractor)
+    storage.add_fetch_metrics('fetch_single', started, time.time() - start_time, 
+        metrics.to_dict())
+
+
+#===================================================================================================
+# get_fetch_options
+#===================================================================================================
+def get_fetch_options(config, repo_workers=False):
+    '''
+    Returns the keyword arguments for fetch_all and fetch_single given by the configuration module.
+    
+    :param repo_workers: if True, also returns the number of repositories fetched at a time, which 
+        is only accepted by fetch_all.
+    '''
+    check_engine(config.engine)
+    result = dict(
+        download_workers=config.download_workers, 
+        parse_workers=config.parse_workers,
+        mirrors_dir=config.git_mirrors_dir, 
+        clone_url_format=config.git_clone_url_format,
+        branch_rules=parse_branch_rules(config.branches),
+        rate_limits=parse_rate_limits(config.rate_limits),
+        extractor=ToDoExtractor.from_config(config.markers, config.file_patterns),
+    )
+    if repo_workers:
+        result['repo_workers'] = config.repo_workers
+    return result
+
+
+#===================================================================================================
+# check_engine
+#===================================================================================================
+ENGINES = ['threads', 'gevent']
+
+def check_engine(engine):
+    '''
+    Checks that the process runs on the given engine, raising RuntimeError otherwise.
+    
+    The "threads" engine runs fetches on regular threads. The "gevent" engine runs the same code on 
+    greenlets, through gevent's monkey patching of threads, sockets and sleeps: it must be applied
+    before anything else is imported, either by running update_gevent.py or by serving the 
+    dashboard with gunicorn's gevent workers ("gunicorn -k gevent"). Greenlets are cheap enough to
+    keep hundreds of requests in flight from a single core, so the number of workers can be much
+    higher than with threads. 
+    '''
+    if engine not in ENGINES:
+        raise RuntimeError('Unknown engine %r (expected one of %s)' % (engine, ', '.join(ENGINES)))
+    if engine == 'gevent':
+        try:
+            from gevent import monkey
+        except ImportError:
+            raise RuntimeError('The gevent engine requires gevent to be installed')
+        if not monkey.is_module_patched('socket') or not monkey.is_module_patched('thread'):
+            raise RuntimeError('The gevent engine requires gevent\'s monkey patching: run '
+                'update_gevent.py, or serve the dashboard with "gunicorn -k gevent"')
 
 
+#===================================================================================================
+# _parse_executor
+#===================================================================================================
+@contextmanager
+def _parse_executor(parse_workers):
+    '''
+    Context manager returning the process pool used to parse files, or None if `parse_workers` is 0
+    and files should be parsed by the fetching threads. 
+    '''
+    if parse_workers > 0:
+        with futures.ProcessPoolExecutor(max_workers=parse_workers) as executor:
+            yield executor
+    else:
+        yield None
+            
+            
 #===================================================================================================
 # _init_fetch
 #===================================================================================================
-def _init_fetch(git_repo_url, auth):
+def _init_fetch(git_repo_url, auth, pool_size=StashServer.DEFAULT_POOL_SIZE, mirrors_dir=None,
+                clone_url_format=None, rate_limits=None, metrics=None):
+    '''
+    Returns the storage and the source of repositories to fetch: the Stash server, or local
+    mirrors of its repositories if `mirrors_dir` is given (see GitMirrorSource).
+    '''
     storage = MongoStorage()
     
-    stash = StashServer(git_repo_url, auth=auth)
+    stash = StashServer(git_repo_url, auth=auth, pool_size=pool_size, rate_limits=rate_limits, 
+        metrics=metrics)
+    if mirrors_dir:
+        if not clone_url_format:
+            clone_url_format = git_repo_url + '/scm/{project}/{slug}.git'
+        stash = GitMirrorSource(mirrors_dir, clone_url_format, repo_lister=stash, auth=auth)
     return storage, stash
     
     
@@ -416,6 +3221,9 @@ def main(argv):
     parser.add_option('--drop', type=str)
     parser.add_option('--drop-all', action='store_true', default=False)
     parser.add_option('--fetch', type=str)
+    parser.add_option('--worker', action='store_true', default=False)
+    parser.add_option('--idle-timeout', type=float)
+    parser.add_option('--check-all', action='store_true', default=False)
     options, _ = parser.parse_args(argv)
 
     import config
@@ -423,12 +3231,17 @@ def main(argv):
     if options.drop:
         drop_todos(options.drop)
     elif options.fetch:
-        fetch_single(config.git_repo_url, options.fetch, auth=config.auth)
+        fetch_single(config.git_repo_url, options.fetch, auth=config.auth, 
+            **get_fetch_options(config))
     elif options.drop_all:
         drop_all()
+    elif options.worker:
+        run_worker(config.git_repo_url, auth=config.auth, idle_timeout=options.idle_timeout,
+            **get_fetch_options(config, repo_workers=True))
     else:
         # ugly hack to consume the entire generator... think of a better way to handle this
-        list(fetch_all(config.git_repo_url, config.search_projects, auth=config.auth))
+        list(fetch_all(config.git_repo_url, config.search_projects, auth=config.auth,
+            check_all=options.check_all, **get_fetch_options(config, repo_workers=True)))
         
     return 0
     
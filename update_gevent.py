@@ -0,0 +1,20 @@
+'''
+Runs update.py on gevent's engine (see update.check_engine), taking the same options. 
+
+gevent's monkey patching must be applied before any other module is imported, which is why this 
+is a separate script.
+'''
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+
+
+#===================================================================================================
+# entry point
+#===================================================================================================
+if __name__ == '__main__':
+    os.environ['TODO_DASHBOARD_ENGINE'] = 'gevent'
+    import update
+    sys.exit(update.main(sys.argv))